@@ -0,0 +1,99 @@
+# avvio_unico.py
+"""
+Avvio dei due bot (autoprotettori e cambi) in un solo processo e in un solo event loop.
+
+Su Render ogni servizio ha il suo interprete, i suoi moduli (PTB, httpx, aiohttp, openpyxl...) e
+le sue ore istanza: qui i due bot condividono
+- il server aiohttp sulla porta PORT: il bot cambi è montato come sotto-app su /cambi
+  (webhook su /cambi/webhook, health-check su /cambi/health, statistiche su /cambi/stats)
+- lo scheduler: i job del bot cambi girano accanto a backup, keep-alive e controlli del bot principale
+- la pipeline di backup su Gist (backup_gist.py: una sessione HTTP, un upload alla volta)
+- il client HTTP verso la Bot API (un solo pool di connessioni, metriche di /metrics per entrambi)
+I database restano separati (autoprotettori_v3.db e cambi_vvf.db), ognuno con la sua persistenza.
+
+Senza BOT_TOKEN_CAMBI parte solo il bot autoprotettori, come `python bot.py`.
+Il bot cambi usa il webhook se il servizio ha un URL pubblico (WEBHOOK_URL/RENDER_EXTERNAL_URL)
+e CAMBI_MODE non è 'polling', altrimenti il polling.
+"""
+import asyncio
+import logging
+import signal
+
+import bot
+import bot_cambi_webhook as cambi
+from metriche import RichiestaTelegramMisurata
+
+PREFISSO_CAMBI = '/cambi'
+
+logger = logging.getLogger("avvio_unico")
+
+
+async def esegui_entrambi(app_bot, app_cambi, modalita_cambi):
+    """Ciclo di vita dei due bot fino a SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    session = bot.crea_sessione_http()
+    bot.registra_lavori(app_bot, session)
+    cambi.registra_lavori_cambi(bot.scheduler)
+
+    await app_bot.initialize()
+    await app_cambi.initialize()
+    await bot.avvia_web_server(app_bot, sotto_app={
+        PREFISSO_CAMBI: lambda: cambi.crea_web_app_cambi(app_cambi, bot.scheduler),
+    })
+    await bot.avvia_ricezione_update(app_bot)
+    await cambi.avvia_ricezione_cambi(
+        app_cambi, modalita_cambi, f"{(bot.WEBHOOK_URL or '').rstrip('/')}{PREFISSO_CAMBI}{cambi.WEBHOOK_PATH}")
+    await app_bot.start()
+    await app_cambi.start()
+    bot.registra_avvio_istanza()
+    bot.scheduler.avvia()
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("🛑 Arresto bot...")
+        await bot.scheduler.ferma()
+        # Ultimo battito: il tempo fino allo spegnimento entra nel conteggio ore
+        bot.battito_istanza()
+        await session.close()
+        for application in (app_bot, app_cambi):
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+        await bot.vista_messaggi.svuota()
+        await bot.ferma_web_server(app_bot)
+        # Il client HTTP condiviso viene chiuso dal primo shutdown, il secondo lo trova già chiuso
+        await app_bot.shutdown()
+        await app_cambi.shutdown()
+        await bot.backup_finale('backup', 'backup_cambi')
+
+
+def main():
+    if not cambi.BOT_TOKEN_CAMBI:
+        logger.warning("⚠️ BOT_TOKEN_CAMBI non configurato: avvio solo il bot autoprotettori")
+        bot.main()
+        return
+
+    if cambi.CAMBI_MODE not in ('webhook', 'polling'):
+        raise SystemExit(f"❌ CAMBI_MODE non valido: {cambi.CAMBI_MODE} (usa 'webhook' o 'polling')")
+    modalita_cambi = cambi.CAMBI_MODE if bot.WEBHOOK_URL else 'polling'
+
+    logger.info("🚀 Avvio Bot Autoprotettori Erba + Bot Gestione Cambi VVF in un solo processo...")
+    bot.prepara_database_avvio()
+    cambi.prepara_database_cambi()
+
+    richiesta = RichiestaTelegramMisurata(connection_pool_size=256)
+    app_bot = bot.crea_application(richiesta)
+    app_cambi = cambi.crea_application_cambi(modalita_cambi, richiesta)
+
+    logger.info("🤖 Bot avviati | porta %d | autoprotettori: %s | cambi: %s su %s",
+                bot.WEB_PORT, bot.BOT_MODE, modalita_cambi, PREFISSO_CAMBI)
+    asyncio.run(esegui_entrambi(app_bot, app_cambi, modalita_cambi))
+
+
+if __name__ == '__main__':
+    main()
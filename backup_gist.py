@@ -0,0 +1,49 @@
+# backup_gist.py
+"""
+Chiamate a GitHub Gist condivise dai backup dei due bot.
+
+Un'unica requests.Session (pool di connessioni verso api.github.com) e un unico lock per ogni
+operazione: quando i bot girano nello stesso processo (avvio_unico.py) i backup passano uno alla
+volta dalla lettura del database all'upload, così il database in memoria e la sua copia base64
+non raddoppiano il picco di RAM. Il lock protegge anche la Session, che non è thread-safe
+(i job di backup girano in thread diversi).
+"""
+import threading
+
+import requests
+
+API_GIST = 'https://api.github.com/gists'
+TIMEOUT = 60
+
+sessione = requests.Session()
+_operazione = threading.Lock()
+
+
+def _intestazioni(token):
+    return {
+        'Authorization': f'token {token}',
+        'Accept': 'application/vnd.github.v3+json'
+    }
+
+
+def scrivi_gist(token, gist_id, prepara_files, descrizione=None):
+    """
+    Aggiorna il Gist `gist_id` (o ne crea uno privato se manca) e restituisce la risposta HTTP.
+    prepara_files() legge il database e costruisce i file: viene chiamata sotto il lock
+    """
+    with _operazione:
+        files = prepara_files()
+        if gist_id:
+            risposta = sessione.patch(f'{API_GIST}/{gist_id}', headers=_intestazioni(token),
+                                      json={'files': files}, timeout=TIMEOUT)
+        else:
+            risposta = sessione.post(API_GIST, headers=_intestazioni(token),
+                                     json={'description': descrizione, 'public': False, 'files': files}, timeout=TIMEOUT)
+        # La richiesta inviata contiene tutta la copia base64: non deve sopravvivere al lock
+        risposta.request.body = None
+        return risposta
+
+
+def leggi_gist(token, gist_id):
+    with _operazione:
+        return sessione.get(f'{API_GIST}/{gist_id}', headers=_intestazioni(token), timeout=TIMEOUT)
@@ -0,0 +1,325 @@
+# benchmark.py
+"""
+Benchmark offline degli handler del bot autoprotettori.
+
+Per ogni taglia di inventario crea un database temporaneo con articoli sintetici distribuiti
+su CATEGORIE, SEDI e stati, poi pilota gli handler veri (handle_message / button_handler)
+con Update e CallbackQuery finti e un bot che non chiama Telegram.
+Per ogni vista riporta latenza p50/p95, query SQL per esecuzione e picco di memoria allocata.
+
+Uso:
+    python benchmark.py                                   # taglie 100, 1k, 10k, 100k
+    python benchmark.py --taglie 100,1000 --ripetizioni 50
+    python benchmark.py --salva benchmark_prima.json
+    python benchmark.py --confronta benchmark_prima.json  # esce con 1 se p95 o query peggiorano
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+# Prima di importare il bot: database di appoggio (l'import esegue init_db) e log solo per gli errori,
+# così i risultati non si mescolano agli avvisi delle query lente
+_cartella = tempfile.TemporaryDirectory(prefix="benchmark_bot_")
+os.environ['DATABASE_NAME'] = os.path.join(_cartella.name, 'import.db')
+os.environ.setdefault('LOG_LIVELLO', 'ERROR')
+
+import bot
+from metriche import conta_sql
+
+TAGLIE_PREDEFINITE = [100, 1_000, 10_000, 100_000]
+RIPETIZIONI_PREDEFINITE = 20
+# La ricostruzione riscrive tutto il database: poche ripetizioni bastano
+RIPETIZIONI_MAX = {"ricostruzione": 5}
+# Distribuzione degli stati negli inventari sintetici (pesi)
+DISTRIBUZIONE_STATI = {
+    "disponibile": 70,
+    "usato": 15,
+    "fuori_uso": 5,
+    "usato_centrale": 7,
+    "fuori_uso_centrale": 3,
+}
+UTENTE_BENCHMARK = bot.ADMIN_IDS[0]
+# Nel confronto una variazione di p95 conta solo se supera anche questa differenza assoluta
+DIFFERENZA_MINIMA_MS = 1.0
+
+
+# === TELEGRAM FINTO ===
+class BotFinto:
+    """Bot senza rete: ogni metodo Bot API è una coroutine che non fa nulla"""
+
+    def __getattr__(self, nome):
+        async def chiamata(*args, **kwargs):
+            return None
+        return chiamata
+
+
+class MessaggioFinto:
+    def __init__(self, testo, chat_id, message_id):
+        self.text = testo
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.risposte = []
+
+    async def reply_text(self, testo, **kwargs):
+        self.risposte.append(testo)
+        return self
+
+    async def reply_document(self, *args, **kwargs):
+        return self
+
+
+class QueryFinta:
+    def __init__(self, data, utente, messaggio):
+        self.data = data
+        self.from_user = utente
+        self.message = messaggio
+        self.inline_message_id = None
+        self.modifiche = []
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, testo, **kwargs):
+        self.modifiche.append(testo)
+        return True
+
+
+_id_update = itertools.count(1)
+_id_messaggio = itertools.count(1)
+
+
+def _update(messaggio, query=None):
+    utente = SimpleNamespace(id=UTENTE_BENCHMARK, first_name="Benchmark", username="benchmark")
+    return SimpleNamespace(
+        update_id=next(_id_update),
+        effective_user=utente,
+        effective_chat=SimpleNamespace(id=UTENTE_BENCHMARK),
+        effective_message=messaggio,
+        message=None if query else messaggio,
+        callback_query=query,
+    )
+
+
+def update_messaggio(testo):
+    return _update(MessaggioFinto(testo, UTENTE_BENCHMARK, next(_id_messaggio)))
+
+
+def update_callback(data):
+    # message_id sempre nuovo: VistaMessaggi non deve saltare né accorpare le modifiche misurate
+    messaggio = MessaggioFinto("", UTENTE_BENCHMARK, next(_id_messaggio))
+    utente = SimpleNamespace(id=UTENTE_BENCHMARK)
+    return _update(messaggio, QueryFinta(data, utente, messaggio))
+
+
+def contesto(user_data=None):
+    return SimpleNamespace(bot=BotFinto(), user_data=dict(user_data or {}), chat_data={})
+
+
+async def esegui(update, context):
+    if update.callback_query is not None:
+        await bot.button_handler(update, context)
+    else:
+        await bot.handle_message(update, context)
+
+
+# === INVENTARI SINTETICI ===
+def popola(percorso, numero, seme=42):
+    """Inventario di `numero` articoli con seriali nel formato del bot (es. BOMB_000042_ERBA)"""
+    rnd = random.Random(seme)
+    stati, pesi = zip(*DISTRIBUZIONE_STATI.items())
+    categorie = list(bot.CATEGORIE)
+    sedi = list(bot.SEDI)
+    righe = []
+    for i in range(numero):
+        categoria = rnd.choice(categorie)
+        sede = rnd.choice(sedi)
+        stato = rnd.choices(stati, pesi)[0]
+        seriale = f"{bot.get_prefisso_categoria(categoria)}_{i:06d}_{sede.upper()}"
+        righe.append((seriale, categoria, sede, stato))
+    conn = sqlite3.connect(percorso)
+    try:
+        with conn:
+            conn.executemany("INSERT INTO articoli (seriale, categoria, sede, stato) VALUES (?, ?, ?, ?)", righe)
+    finally:
+        conn.close()
+
+
+def testo_inventario(percorso):
+    """
+    Inventario nel formato letto da ricostruisci_database_da_inventario (intestazioni di stato
+    senza markdown, righe "• SERIALE - 🌿 Erba"), con gli stessi articoli del database
+    """
+    gruppi = {
+        "🟢 DISPONIBILI": ("disponibile",),
+        "🔴 USATI": ("usato", "usato_centrale"),
+        "⚫ FUORI USO": ("fuori_uso", "fuori_uso_centrale"),
+    }
+    conn = sqlite3.connect(percorso)
+    try:
+        articoli = conn.execute("SELECT seriale, categoria, sede, stato FROM articoli ORDER BY seriale").fetchall()
+    finally:
+        conn.close()
+    righe = []
+    for intestazione, stati in gruppi.items():
+        righe.append(intestazione)
+        for categoria in bot.ORDINE_CATEGORIE:
+            articoli_cat = [a for a in articoli if a[1] == categoria and a[3] in stati]
+            if articoli_cat:
+                righe.append(f"{bot.CATEGORIE[categoria]}:")
+                for seriale, _, sede, stato in articoli_cat:
+                    locazione = " (Centrale)" if stato.endswith("_centrale") else ""
+                    righe.append(f"• {seriale} - {bot.SEDI[sede]}{locazione}")
+    return "\n".join(righe)
+
+
+def viste(testo_inventario):
+    """(nome, costruttore dell'update, user_data iniziale) per ogni vista misurata"""
+    return [
+        ("inventario", lambda: update_messaggio("📋 Inventario"), None),
+        ("disponibili", lambda: update_messaggio("🟢 Disponibili"), None),
+        ("usati", lambda: update_messaggio("🔴 Usati"), None),
+        ("statistiche", lambda: update_messaggio("📊 Statistiche"), None),
+        ("centrale", lambda: update_callback(bot.cb("ci")), None),
+        ("picker_categorie", lambda: update_messaggio("🔴 Segna Usato"), None),
+        ("picker_usato", lambda: update_callback(bot.cb("uc", "bombola")), None),
+        ("picker_fuori_uso", lambda: update_callback(bot.cb("fc", "bombola")), None),
+        ("picker_rimuovi", lambda: update_callback(bot.cb("rc", "bombola")), None),
+        ("ricostruzione", lambda: update_callback(bot.cb("ok")),
+         {'azione': 'conferma_carica_inventario', 'inventario_da_caricare': testo_inventario}),
+    ]
+
+
+# === MISURA ===
+def percentile(valori, q):
+    ordinati = sorted(valori)
+    return ordinati[max(0, math.ceil(q * len(ordinati)) - 1)]
+
+
+async def misura_vista(crea_update, user_data, ripetizioni):
+    # Riscaldamento: cache dei ruoli, statement cache di SQLite, pagine del database
+    await esegui(crea_update(), contesto(user_data))
+
+    latenze = []
+    sql_prima = conta_sql()
+    for _ in range(ripetizioni):
+        update, context = crea_update(), contesto(user_data)
+        inizio = time.perf_counter()
+        await esegui(update, context)
+        latenze.append(time.perf_counter() - inizio)
+    sql = (conta_sql() - sql_prima) / ripetizioni
+
+    # Allocazioni in un passaggio separato: tracemalloc rallenta l'esecuzione e falserebbe le latenze
+    update, context = crea_update(), contesto(user_data)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    await esegui(update, context)
+    picco = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile(latenze, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latenze, 0.95) * 1000, 3),
+        "sql": round(sql, 1),
+        "picco_kib": round((picco - base) / 1024, 1),
+    }
+
+
+async def misura_taglia(numero, ripetizioni):
+    percorso = os.path.join(_cartella.name, f"articoli_{numero}.db")
+    bot.DATABASE_NAME = percorso
+    bot.init_db()
+    bot.invalida_ruolo()
+    popola(percorso, numero)
+
+    risultati = {}
+    # La ricostruzione riscrive gli stessi articoli: il database resta uguale tra una ripetizione e l'altra
+    for nome, crea_update, user_data in viste(testo_inventario(percorso)):
+        volte = min(ripetizioni, RIPETIZIONI_MAX.get(nome, ripetizioni))
+        risultati[nome] = await misura_vista(crea_update, user_data, volte)
+        print(f"  {nome:<18} p50 {risultati[nome]['p50_ms']:>9.2f} ms  p95 {risultati[nome]['p95_ms']:>9.2f} ms  "
+              f"sql {risultati[nome]['sql']:>6.1f}  picco {risultati[nome]['picco_kib']:>9.1f} KiB")
+    os.remove(percorso)
+    return risultati
+
+
+async def esegui_benchmark(taglie, ripetizioni):
+    risultati = {}
+    for numero in taglie:
+        print(f"📦 {numero} articoli")
+        risultati[str(numero)] = await misura_taglia(numero, ripetizioni)
+    return risultati
+
+
+# === CONFRONTO ===
+def confronta(attuali, precedenti, soglia):
+    """Stampa le variazioni rispetto a un'esecuzione salvata; restituisce il numero di regressioni (p95 o query)"""
+    regressioni = 0
+    print(f"\n📈 Confronto con {precedenti['meta']['data']} (soglia regressione p95: +{soglia:g}%)")
+    for taglia, viste_attuali in attuali["taglie"].items():
+        viste_precedenti = precedenti["taglie"].get(taglia)
+        if not viste_precedenti:
+            continue
+        for nome, ora in viste_attuali.items():
+            prima = viste_precedenti.get(nome)
+            if not prima or not prima["p95_ms"]:
+                continue
+            delta = (ora["p95_ms"] - prima["p95_ms"]) / prima["p95_ms"] * 100
+            # Sotto il millisecondo le differenze sono rumore; il numero di query invece è deterministico
+            rilevante = abs(ora["p95_ms"] - prima["p95_ms"]) >= DIFFERENZA_MINIMA_MS
+            peggiorata = (delta > soglia and rilevante) or ora["sql"] > prima["sql"]
+            segno = "🔴" if peggiorata else "🟢" if delta < -soglia and rilevante else "⚪"
+            if peggiorata:
+                regressioni += 1
+            print(f"  {segno} {taglia:>7} {nome:<18} p95 {prima['p95_ms']:>9.2f} -> {ora['p95_ms']:>9.2f} ms ({delta:+.0f}%)"
+                  f"  sql {prima['sql']:g} -> {ora['sql']:g}  picco {prima['picco_kib']:g} -> {ora['picco_kib']:g} KiB")
+    return regressioni
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline degli handler del bot autoprotettori")
+    parser.add_argument("--taglie", default=",".join(map(str, TAGLIE_PREDEFINITE)),
+                        help="numeri di articoli separati da virgola")
+    parser.add_argument("--ripetizioni", type=int, default=RIPETIZIONI_PREDEFINITE)
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--confronta", help="file JSON di un'esecuzione precedente")
+    parser.add_argument("--soglia", type=float, default=20.0, help="peggioramento p95 in %% considerato regressione")
+    argomenti = parser.parse_args()
+
+    taglie = [int(t) for t in argomenti.taglie.split(",") if t.strip()]
+    risultati = {
+        "meta": {
+            "data": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "piattaforma": platform.platform(),
+            "ripetizioni": argomenti.ripetizioni,
+        },
+        "taglie": asyncio.run(esegui_benchmark(taglie, argomenti.ripetizioni)),
+    }
+
+    if argomenti.salva:
+        with open(argomenti.salva, "w", encoding="utf-8") as f:
+            json.dump(risultati, f, ensure_ascii=False, indent=2)
+        print(f"💾 Risultati salvati in {argomenti.salva}")
+
+    if argomenti.confronta:
+        with open(argomenti.confronta, encoding="utf-8") as f:
+            precedenti = json.load(f)
+        if confronta(risultati, precedenti, argomenti.soglia):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
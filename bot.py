@@ -1,22 +1,55 @@
 import logging
 import sqlite3
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from datetime import datetime, timedelta
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, InlineQueryHandler, TypeHandler, ContextTypes, filters
+from datetime import datetime, timedelta, timezone
 import asyncio
 import os
-from flask import Flask
-import threading
-import requests
+from aiohttp import web
+from scheduler import Scheduler
+from persistenza import PersistenzaSQLite
+from metriche import registro, ConnessioneMisurata, RichiestaTelegramMisurata, report_sql, azzera_statistiche_sql
+from log_strutturato import configura_logging, registra_contesto_update
+from registrazione import RegistratoreUpdate, CodaUpdateRegistrata
+from backup_gist import scrivi_gist, leggi_gist
+import aiohttp
 import time
 import psutil
 import base64
 import json
+import hmac
+import secrets
+import signal
+import hashlib
+import csv
+import io
+import tempfile
+import cProfile
+import pstats
+import tracemalloc
+from collections import OrderedDict, deque
+import openpyxl
 
 # === CONFIGURAZIONE ===
-DATABASE_NAME = 'autoprotettori_v3.db'  # ⬅️ COSTANTE UNICA PER TUTTO IL DATABASE
+# ⬅️ COSTANTE UNICA PER TUTTO IL DATABASE (DATABASE_NAME nell'ambiente solo per benchmark e test di carico)
+DATABASE_NAME = os.environ.get('DATABASE_NAME', 'autoprotettori_v3.db')
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_IDS = [1816045269, 653425963, 693843502, 6622015744]
+STATUS_SERVER_ADMIN_ID = 1816045269  # unico admin che vede "🖥️ Status Server"
+
+# Modalità ricezione update: 'webhook' (update sulla stessa porta del server web) o 'polling'
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL') or os.environ.get('RENDER_EXTERNAL_URL')  # URL pubblico del servizio
+WEBHOOK_PATH = '/telegram'
+# Se non configurato genero un segreto per ogni avvio: il webhook viene comunque reimpostato a ogni boot
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# Token opzionale per /metrics (vuoto = endpoint aperto, come /status)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Bot API alternativa (vuoto = Telegram): usata dai test di carico con finto_telegram.py
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+# File JSONL in cui registrare gli update in arrivo per replay.py (vuoto = nessuna registrazione)
+REGISTRA_UPDATE = os.environ.get('REGISTRA_UPDATE', '')
 
 # Configurazione backup GitHub
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')  # Token GitHub personale
@@ -29,13 +62,24 @@ SOGLIE_BOMBOLE = {
     "preallarme": 10        # =10 (TOTALE Erba + Centrale)
 }
 
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Log strutturati (JSON) scritti da un thread dedicato: nessuna print() nel loop
+configura_logging()
+logger = logging.getLogger("bot")
+log_database = logging.getLogger("bot.database")
+log_backup = logging.getLogger("bot.backup")
+log_keepalive = logging.getLogger("bot.keepalive")
+log_inventario = logging.getLogger("bot.inventario")
 
 # === DATABASE ===
-def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
-    c = conn.cursor()
+def connetti():
+    """Connessione al database: ogni query viene misurata (istogramma per istruzione su /metrics)"""
+    return sqlite3.connect(DATABASE_NAME, factory=ConnessioneMisurata)
 
+# Versione dello schema salvata in PRAGMA user_version: ogni migrazione porta il database alla versione indicata
+SCHEMA_VERSION = 5
+
+def _migrazione_1(c):
+    """Schema base: articoli e utenti"""
     c.execute('''CREATE TABLE IF NOT EXISTS articoli
                  (id INTEGER PRIMARY KEY,
                   seriale TEXT UNIQUE,
@@ -52,6 +96,85 @@ def init_db():
                   data_richiesta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   data_approvazione TIMESTAMP)''')
 
+def _migrazione_2(c):
+    """Chi ha fatto l'ultimo cambio di stato (per i messaggi di conflitto)"""
+    colonne = {row[1] for row in c.execute("PRAGMA table_info(articoli)")}
+    if "aggiornato_da" not in colonne:
+        c.execute("ALTER TABLE articoli ADD COLUMN aggiornato_da INTEGER")
+    if "aggiornato_il" not in colonne:
+        c.execute("ALTER TABLE articoli ADD COLUMN aggiornato_il TIMESTAMP")
+
+def _migrazione_3(c):
+    """Indice FTS5 a trigrammi sui seriali (ricerca per frammento), sincronizzato da trigger"""
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS articoli_fts
+                     USING fts5(seriale, content='articoli', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError as e:
+        # Il tokenizer trigram richiede SQLite >= 3.34 compilato con FTS5: senza, niente indice né trigger
+        # e la ricerca usa solo il prefisso (cerca_articoli). La migrazione non viene ritentata
+        log_database.warning("⚠️ Indice FTS5 trigram non disponibile (SQLite %s: %s) - ricerca solo per prefisso",
+                             sqlite3.sqlite_version, e)
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS articoli_fts_ai AFTER INSERT ON articoli BEGIN
+                     INSERT INTO articoli_fts(rowid, seriale) VALUES (new.id, new.seriale);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS articoli_fts_ad AFTER DELETE ON articoli BEGIN
+                     INSERT INTO articoli_fts(articoli_fts, rowid, seriale) VALUES ('delete', old.id, old.seriale);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS articoli_fts_au AFTER UPDATE OF seriale ON articoli BEGIN
+                     INSERT INTO articoli_fts(articoli_fts, rowid, seriale) VALUES ('delete', old.id, old.seriale);
+                     INSERT INTO articoli_fts(rowid, seriale) VALUES (new.id, new.seriale);
+                 END''')
+    # Indicizza gli articoli già presenti
+    c.execute("INSERT INTO articoli_fts(articoli_fts) VALUES ('rebuild')")
+
+def _migrazione_4(c):
+    """Ore di attività dell'istanza aggregate per giorno (UTC), per il limite mensile di Render"""
+    c.execute('''CREATE TABLE IF NOT EXISTS ore_istanza
+                 (giorno TEXT PRIMARY KEY,
+                  secondi REAL NOT NULL DEFAULT 0,
+                  avvii INTEGER NOT NULL DEFAULT 0)''')
+
+def _migrazione_5(c):
+    """Indice sui seriali senza distinzione maiuscole/minuscole (ricerca per prefisso)"""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_articoli_seriale_nocase ON articoli(seriale COLLATE NOCASE)")
+
+# Elenco ordinato delle migrazioni: (versione, descrizione, funzione)
+MIGRAZIONI = [
+    (1, "schema base articoli/utenti", _migrazione_1),
+    (2, "autore ultimo cambio stato articoli", _migrazione_2),
+    (3, "indice di ricerca sui seriali", _migrazione_3),
+    (4, "ore istanza giornaliere", _migrazione_4),
+    (5, "indice seriali senza maiuscole/minuscole", _migrazione_5),
+]
+
+# Colonne attese per ogni tabella alla versione SCHEMA_VERSION
+SCHEMA_ATTESO = {
+    "articoli": {"id", "seriale", "categoria", "sede", "stato", "data_inserimento", "aggiornato_da", "aggiornato_il"},
+    "utenti": {"user_id", "username", "nome", "ruolo", "data_richiesta", "data_approvazione"},
+    "ore_istanza": {"giorno", "secondi", "avvii"},
+}
+
+def applica_migrazioni(conn):
+    """Porta il database all'ultima versione dello schema, restituisce la versione finale"""
+    c = conn.cursor()
+    versione = c.execute("PRAGMA user_version").fetchone()[0]
+    for numero, descrizione, migrazione in MIGRAZIONI:
+        if numero <= versione:
+            continue
+        migrazione(c)
+        c.execute(f"PRAGMA user_version = {numero}")
+        conn.commit()
+        versione = numero
+        log_database.info("🔧 Migrazione %d applicata: %s", numero, descrizione)
+    return versione
+
+def init_db():
+    conn = connetti()
+    c = conn.cursor()
+
+    applica_migrazioni(conn)
+
     for admin_id in ADMIN_IDS:
         c.execute('''INSERT OR IGNORE INTO utenti 
                      (user_id, nome, ruolo, data_approvazione) 
@@ -62,54 +185,149 @@ def init_db():
 
 init_db()
 
-# === SISTEMA DI EMERGENZA PER RICREARE TABELLE ===
-def emergency_recreate_database():
-    """Ricrea le tabelle se non esistono - sistema di emergenza"""
-    conn = sqlite3.connect(DATABASE_NAME)
+# === VERIFICA INTEGRITÀ DATABASE (A LIVELLI) ===
+# 1) all'avvio: PRAGMA quick_check + validazione schema/versione (nessuna scansione COUNT delle tabelle)
+# 2) periodica: integrity_check completo di UNA tabella per volta, solo quando il bot è inattivo
+STATO_INTEGRITA = {
+    "avvio": None,       # esito dell'ultimo quick_check all'avvio
+    "schema": None,      # esito della validazione schema/versione
+    "periodica": {},     # tabella -> esito dell'ultimo integrity_check incrementale
+    "prossima_tabella": 0,
+}
+INTERVALLO_INTEGRITA = 600     # secondi tra due controlli incrementali
+SOGLIA_INATTIVITA = 120        # secondi senza update prima di considerare il bot inattivo
+ULTIMA_ATTIVITA = time.monotonic()
+
+def _registra_esito(ok, dettaglio, inizio):
+    return {
+        "ok": ok,
+        "dettaglio": dettaglio,
+        "durata_ms": (time.perf_counter() - inizio) * 1000,
+        "quando": datetime.now(),
+    }
+
+def verifica_schema(conn):
+    """Confronta versione e colonne con SCHEMA_ATTESO, restituisce (ok, dettaglio)"""
     c = conn.cursor()
-    
+    versione = c.execute("PRAGMA user_version").fetchone()[0]
+    if versione != SCHEMA_VERSION:
+        return False, f"versione schema {versione}, attesa {SCHEMA_VERSION}"
+
+    for tabella, colonne_attese in SCHEMA_ATTESO.items():
+        colonne = {row[1] for row in c.execute(f"PRAGMA table_info({tabella})")}
+        if not colonne:
+            return False, f"tabella {tabella} mancante"
+        mancanti = colonne_attese - colonne
+        if mancanti:
+            return False, f"colonne mancanti in {tabella}: {', '.join(sorted(mancanti))}"
+
+    return True, f"schema v{versione} valido"
+
+def quick_check_avvio():
+    """Controllo leggero all'avvio: quick_check + schema. Restituisce (integro, schema_ok)"""
+    inizio = time.perf_counter()
+    conn = connetti()
     try:
-        # Verifica se le tabelle esistono
-        c.execute("SELECT 1 FROM articoli LIMIT 1")
-        c.execute("SELECT 1 FROM utenti LIMIT 1")
-        print("✅ Tabelle database verificate")
-    except sqlite3.OperationalError:
-        print("🚨 TABELLE NON TROVATE! Ricreo il database di emergenza...")
-        init_db()  # Richiama init_db per ricreare tutto
-        print("✅ Database ricreato con successo!")
-    
-    conn.close()
+        righe = [row[0] for row in conn.execute("PRAGMA quick_check")]
+        integro = righe == ["ok"]
+        STATO_INTEGRITA["avvio"] = _registra_esito(integro, "ok" if integro else "; ".join(righe[:5]), inizio)
+
+        inizio = time.perf_counter()
+        schema_ok, dettaglio = verifica_schema(conn)
+        STATO_INTEGRITA["schema"] = _registra_esito(schema_ok, dettaglio, inizio)
+        return integro, schema_ok
+    except sqlite3.DatabaseError as e:
+        STATO_INTEGRITA["avvio"] = _registra_esito(False, str(e), inizio)
+        # File illeggibile: lo schema non è verificabile (niente esito della verifica precedente)
+        STATO_INTEGRITA["schema"] = _registra_esito(False, "schema non verificabile", inizio)
+        return False, False
+    finally:
+        conn.close()
+
+def _metti_da_parte(suffisso):
+    """Sposta il file del database accanto a sé (es. autoprotettori_v3.db.corrotto-20250101120000)"""
+    destinazione = f"{DATABASE_NAME}.{suffisso}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    os.replace(DATABASE_NAME, destinazione)
+    return destinazione
+
+def verifica_integrita_avvio():
+    """Verifica all'avvio e, se serve, ripara: file corrotto -> restore/nuovo DB, schema vecchio -> migrazioni"""
+    integro, schema_ok = quick_check_avvio()
+
+    if not integro:
+        dettaglio = STATO_INTEGRITA["avvio"]["dettaglio"]
+        destinazione = _metti_da_parte("corrotto")
+        log_database.error("🚨 Database corrotto (%s) - spostato in %s, ripristino dal Gist", dettaglio, destinazione)
+        if not restore_database_from_gist():
+            init_db()
+        integro, schema_ok = quick_check_avvio()
+
+        if not integro:
+            # Anche il backup è corrotto: un altro restore scaricherebbe lo stesso file
+            destinazione = _metti_da_parte("backup-corrotto")
+            log_database.critical("🚨 Anche il database ripristinato è corrotto (%s) - spostato in %s, "
+                                  "riparto da un database VUOTO", STATO_INTEGRITA["avvio"]["dettaglio"], destinazione)
+            init_db()
+            integro, schema_ok = quick_check_avvio()
+
+    if not schema_ok:
+        log_database.warning("🔄 Schema non valido (%s) - applico migrazioni", STATO_INTEGRITA['schema']['dettaglio'])
+        init_db()
+        integro, schema_ok = quick_check_avvio()
+
+    log_database.info("✅ Verifica avvio: quick_check %s, %s", 'ok' if integro else 'FALLITO', STATO_INTEGRITA['schema']['dettaglio'])
+    return integro and schema_ok
 
-# === VERIFICA INTEGRITÀ DATABASE ===
-def check_database_integrity():
-    """Verifica che il database sia integro e funzionante"""
+def integrity_check_incrementale(tabella):
+    """integrity_check completo limitato a una sola tabella (e ai suoi indici)"""
+    inizio = time.perf_counter()
+    conn = connetti()
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        c = conn.cursor()
-        
-        # Verifica se le tabelle esistono e hanno dati
-        c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name IN ('articoli', 'utenti')")
-        table_count = c.fetchone()[0]
-        
-        if table_count < 2:
-            print("🚨 Database corrotto - tabelle mancanti!")
-            conn.close()
-            return False
-            
-        # Verifica alcuni dati
-        c.execute("SELECT COUNT(*) FROM articoli")
-        articoli_count = c.fetchone()[0]
-        
-        c.execute("SELECT COUNT(*) FROM utenti WHERE ruolo = 'admin'")
-        admin_count = c.fetchone()[0]
-        
-        print(f"✅ Database integro - Tabelle: {table_count}, Articoli: {articoli_count}, Admin: {admin_count}")
+        try:
+            righe = [row[0] for row in conn.execute(f"PRAGMA integrity_check({tabella})")]
+        except sqlite3.OperationalError:
+            # SQLite < 3.33 non accetta il nome tabella: ripiega sul quick_check globale
+            righe = [row[0] for row in conn.execute("PRAGMA quick_check")]
+        ok = righe == ["ok"]
+        esito = _registra_esito(ok, "ok" if ok else "; ".join(righe[:5]), inizio)
+    except sqlite3.DatabaseError as e:
+        esito = _registra_esito(False, str(e), inizio)
+    finally:
         conn.close()
-        return True
-        
-    except Exception as e:
-        print(f"🚨 Errore verifica database: {e}")
-        return False
+
+    STATO_INTEGRITA["periodica"][tabella] = esito
+    if not esito["ok"]:
+        log_database.error("🚨 integrity_check %s fallito: %s", tabella, esito['dettaglio'])
+    return esito["ok"]
+
+def controllo_integrita_periodico():
+    """Job dello scheduler: controlla una tabella alla volta a rotazione, solo durante i periodi di inattività"""
+    if time.monotonic() - ULTIMA_ATTIVITA < SOGLIA_INATTIVITA:
+        return None  # bot in uso: rimando al prossimo giro
+    tabelle = list(SCHEMA_ATTESO)
+    tabella = tabelle[STATO_INTEGRITA["prossima_tabella"] % len(tabelle)]
+    STATO_INTEGRITA["prossima_tabella"] += 1
+    return integrity_check_incrementale(tabella)
+
+async def segna_attivita(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Registra l'ultimo update ricevuto (usato per capire quando il bot è inattivo)"""
+    global ULTIMA_ATTIVITA
+    ULTIMA_ATTIVITA = time.monotonic()
+
+def get_integrity_status():
+    """Riassunto dei controlli di integrità per lo Status Server"""
+    def riga(nome, esito):
+        if not esito:
+            return f"• {nome}: ⏳ non ancora eseguito\n"
+        icona = "✅" if esito["ok"] else "🚨"
+        return f"• {nome}: {icona} {esito['dettaglio']} ({esito['durata_ms']:.0f}ms, {esito['quando'].strftime('%d/%m %H:%M')})\n"
+
+    msg = "🔒 **INTEGRITÀ DATABASE:**\n"
+    msg += riga("Quick check avvio", STATO_INTEGRITA["avvio"])
+    msg += riga("Schema", STATO_INTEGRITA["schema"])
+    for tabella in SCHEMA_ATTESO:
+        msg += riga(f"Check {tabella}", STATO_INTEGRITA["periodica"].get(tabella))
+    return msg
 
 # === CATEGORIE E SEDI ===
 CATEGORIE = {
@@ -131,28 +349,49 @@ STATI_CENTRALE = {
     "fuori_uso_centrale": "⚫ Fuori Uso (Centrale)"
 }
 
+# Etichette degli stati per i messaggi di conflitto
+ETICHETTE_STATI = {
+    "disponibile": "🟢 DISPONIBILE",
+    "usato": "🔴 USATO",
+    "fuori_uso": "⚫ FUORI USO",
+    "usato_centrale": "🔴 USATO (Centrale)",
+    "fuori_uso_centrale": "⚫ FUORI USO (Centrale)",
+}
+
 # ORDINE DELLE CATEGORIE PER L'INVENTARIO
 ORDINE_CATEGORIE = ["bombola", "maschera", "erogatore", "spallaccio", "seconda_utenza"]  # AGGIUNTA
 
 # === FUNZIONI UTILITY ===
+# Cache dei ruoli: la tabella utenti cambia solo tramite questo processo (start/approva/rifiuta),
+# che invalida la voce interessata. Evita una query per ogni messaggio ricevuto.
+_cache_ruoli = {}
+
+def get_ruolo(user_id):
+    """Ruolo dell'utente ('admin', 'user', 'in_attesa') o None se sconosciuto"""
+    if user_id not in _cache_ruoli:
+        conn = connetti()
+        c = conn.cursor()
+        c.execute("SELECT ruolo FROM utenti WHERE user_id = ?", (user_id,))
+        result = c.fetchone()
+        conn.close()
+        _cache_ruoli[user_id] = result[0] if result else None
+    return _cache_ruoli[user_id]
+
+def invalida_ruolo(user_id=None):
+    """Da chiamare dopo ogni modifica alla tabella utenti (None = svuota tutta la cache)"""
+    if user_id is None:
+        _cache_ruoli.clear()
+    else:
+        _cache_ruoli.pop(user_id, None)
+
 def is_admin(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
-    c = conn.cursor()
-    c.execute("SELECT ruolo FROM utenti WHERE user_id = ?", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result and result[0] == 'admin'
+    return get_ruolo(user_id) == 'admin'
 
 def is_user_approved(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
-    c = conn.cursor()
-    c.execute("SELECT ruolo FROM utenti WHERE user_id = ? AND ruolo IN ('admin', 'user')", (user_id,))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+    return get_ruolo(user_id) in ('admin', 'user')
 
 def get_richieste_in_attesa():
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute('''SELECT user_id, username, nome, data_richiesta 
                  FROM utenti WHERE ruolo = 'in_attesa' ORDER BY data_richiesta''')
@@ -161,75 +400,58 @@ def get_richieste_in_attesa():
     return result
 
 def approva_utente(user_id):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute('''UPDATE utenti SET ruolo = 'user', data_approvazione = CURRENT_TIMESTAMP 
-                 WHERE user_id = ?''', (user_id,))
+                 WHERE user_id = ? AND ruolo = 'in_attesa' ''', (user_id,))
+    conn.commit()
+    approvato = c.rowcount == 1
+    conn.close()
+    invalida_ruolo(user_id)
+    return approvato
+
+def rifiuta_utente(user_id):
+    conn = connetti()
+    c = conn.cursor()
+    # Solo richieste ancora in attesa: un utente già approvato da un altro admin non viene cancellato
+    c.execute("DELETE FROM utenti WHERE user_id = ? AND ruolo = 'in_attesa'", (user_id,))
     conn.commit()
+    rifiutato = c.rowcount == 1
     conn.close()
+    invalida_ruolo(user_id)
+    return rifiutato
 
 # === FUNZIONI GESTIONE CENTRALE ===
-def sposta_in_centrale(seriale):
-    """Sposta un articolo in centrale mantenendo lo stato originale"""
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+def sposta_in_centrale(seriale, user_id=None):
+    """Sposta un articolo in centrale mantenendo lo stato originale (solo se usato o fuori uso)"""
+    conn = connetti()
     c = conn.cursor()
-    
-    # Prima ottieni lo stato attuale
-    c.execute("SELECT stato FROM articoli WHERE seriale = ?", (seriale,))
-    risultato = c.fetchone()
-    
-    if risultato:
-        stato_attuale = risultato[0]
-        nuovo_stato = ""
-        
-        if stato_attuale == "usato":
-            nuovo_stato = "usato_centrale"
-        elif stato_attuale == "fuori_uso":
-            nuovo_stato = "fuori_uso_centrale"
-        else:
-            conn.close()
-            return False  # Non si può spostare in centrale se non è usato o fuori uso
-        
-        c.execute("UPDATE articoli SET stato = ? WHERE seriale = ?", (nuovo_stato, seriale))
-        conn.commit()
-        conn.close()
-        return True
-    
+    # Lettura e scrittura in un'unica UPDATE condizionale: nessuna finestra tra controllo e modifica
+    c.execute('''UPDATE articoli
+                 SET stato = CASE stato WHEN 'usato' THEN 'usato_centrale' ELSE 'fuori_uso_centrale' END,
+                     aggiornato_da = ?, aggiornato_il = CURRENT_TIMESTAMP
+                 WHERE seriale = ? AND stato IN ('usato', 'fuori_uso')''', (user_id, seriale))
+    conn.commit()
+    spostato = c.rowcount == 1
     conn.close()
-    return False
+    return spostato
 
-def ripristina_da_centrale(seriale):
-    """Ripristina un articolo da centrale a Erba"""
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+def ripristina_da_centrale(seriale, user_id=None):
+    """Ripristina un articolo da centrale a Erba (solo se è in centrale)"""
+    conn = connetti()
     c = conn.cursor()
-    
-    # Prima ottieni lo stato attuale
-    c.execute("SELECT stato FROM articoli WHERE seriale = ?", (seriale,))
-    risultato = c.fetchone()
-    
-    if risultato:
-        stato_attuale = risultato[0]
-        nuovo_stato = ""
-        
-        if stato_attuale == "usato_centrale":
-            nuovo_stato = "usato"
-        elif stato_attuale == "fuori_uso_centrale":
-            nuovo_stato = "fuori_uso"
-        else:
-            conn.close()
-            return False  # Non è in centrale
-        
-        c.execute("UPDATE articoli SET stato = ? WHERE seriale = ?", (nuovo_stato, seriale))
-        conn.commit()
-        conn.close()
-        return True
-    
+    c.execute('''UPDATE articoli
+                 SET stato = CASE stato WHEN 'usato_centrale' THEN 'usato' ELSE 'fuori_uso' END,
+                     aggiornato_da = ?, aggiornato_il = CURRENT_TIMESTAMP
+                 WHERE seriale = ? AND stato IN ('usato_centrale', 'fuori_uso_centrale')''', (user_id, seriale))
+    conn.commit()
+    ripristinato = c.rowcount == 1
     conn.close()
-    return False
+    return ripristinato
 
 def get_articoli_in_centrale():
     """Restituisce tutti gli articoli attualmente in centrale"""
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute("SELECT seriale, categoria, sede, stato FROM articoli WHERE stato IN ('usato_centrale', 'fuori_uso_centrale')")
     result = c.fetchall()
@@ -238,7 +460,7 @@ def get_articoli_in_centrale():
 
 def get_articoli_per_stato_centrale(stato, escludi_centrale=True):
     """Restituisce articoli per stato in centrale, escludendo quelli già in centrale"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = connetti()
     c = conn.cursor()
     
     if escludi_centrale:
@@ -260,19 +482,20 @@ def get_articoli_per_stato_centrale(stato, escludi_centrale=True):
 def backup_database_to_gist():
     """Salva il database su GitHub Gist"""
     if not GITHUB_TOKEN:
-        print("❌ Token GitHub non configurato - backup disabilitato")
+        log_backup.warning("❌ Token GitHub non configurato - backup disabilitato")
         return False
     
-    try:
+    def prepara_files():
         # Leggi il database CORRETTO
         with open(DATABASE_NAME, 'rb') as f:  # ⬅️ USA LA COSTANTE
             db_content = f.read()
+        BACKUP_DIMENSIONE.set(len(db_content))
         
         # Converti in base64 per Gist
         db_base64 = base64.b64encode(db_content).decode('utf-8')
         
         # Prepara i dati per Gist
-        files = {
+        return {
             'autoprotettori_backup.json': {
                 'content': json.dumps({
                     'timestamp': datetime.now().isoformat(),
@@ -282,59 +505,39 @@ def backup_database_to_gist():
                 })
             }
         }
-        
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        
-        # Se abbiamo un GIST_ID, aggiornalo, altrimenti creane uno nuovo
-        if GIST_ID:
-            url = f'https://api.github.com/gists/{GIST_ID}'
-            data = {'files': files}
-            response = requests.patch(url, headers=headers, json=data)
-        else:
-            url = 'https://api.github.com/gists'
-            data = {
-                'description': f'Backup Autoprotettori Bot - {datetime.now().strftime("%Y-%m-%d %H:%M")}',
-                'public': False,
-                'files': files
-            }
-            response = requests.post(url, headers=headers, json=data)
+    
+    try:
+        # Lettura, codifica e upload sotto il lock di backup_gist. Se abbiamo un GIST_ID, aggiornalo, altrimenti creane uno nuovo
+        response = scrivi_gist(GITHUB_TOKEN, GIST_ID, prepara_files,
+                               descrizione=f'Backup Autoprotettori Bot - {datetime.now().strftime("%Y-%m-%d %H:%M")}')
         
         if response.status_code in [200, 201]:
             result = response.json()
-            print(f"✅ Backup su Gist completato: {result['html_url']}")
+            log_backup.info("✅ Backup su Gist completato: %s", result['html_url'])
             
             # Salva il GIST_ID per futuri aggiornamenti
             if not GIST_ID:
                 with open('gist_id.txt', 'w') as f:
                     f.write(result['id'])
-                print(f"📝 Nuovo Gist ID salvato: {result['id']}")
+                log_backup.info("📝 Nuovo Gist ID salvato: %s", result['id'])
             
             return True
         else:
-            print(f"❌ Errore backup Gist: {response.status_code} - {response.text}")
+            log_backup.error("❌ Errore backup Gist: %s - %s", response.status_code, response.text)
             return False
             
     except Exception as e:
-        print(f"❌ Errore durante backup: {str(e)}")
+        log_backup.exception("❌ Errore durante backup: %s", e)
         return False
 
 def restore_database_from_gist():
     """Ripristina il database da GitHub Gist"""
     if not GITHUB_TOKEN or not GIST_ID:
-        print("❌ Token o Gist ID non configurati - restore disabilitato")
+        log_backup.warning("❌ Token o Gist ID non configurati - restore disabilitato")
         return False
     
     try:
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        
-        url = f'https://api.github.com/gists/{GIST_ID}'
-        response = requests.get(url, headers=headers)
+        response = leggi_gist(GITHUB_TOKEN, GIST_ID)
         
         if response.status_code == 200:
             gist_data = response.json()
@@ -350,178 +553,405 @@ def restore_database_from_gist():
                 with open(DATABASE_NAME, 'wb') as f:  # ⬅️ USA LA COSTANTE
                     f.write(db_content)
                 
-                print(f"✅ Database ripristinato da backup: {timestamp}")
+                log_backup.info("✅ Database ripristinato da backup: %s", timestamp)
                 return True
             else:
-                print("❌ File di backup non trovato nel Gist")
+                log_backup.warning("❌ File di backup non trovato nel Gist")
                 return False
         else:
-            print(f"❌ Errore recupero Gist: {response.status_code}")
+            log_backup.error("❌ Errore recupero Gist: %s", response.status_code)
             return False
             
     except Exception as e:
-        print(f"❌ Errore durante restore: {str(e)}")
+        log_backup.exception("❌ Errore durante restore: %s", e)
         return False
 
 def restore_on_startup():
     """Tenta il ripristino del database all'avvio"""
     if not GITHUB_TOKEN or not GIST_ID:
-        print("❌ Token o Gist ID non configurati - restore disabilitato")
+        log_backup.warning("❌ Token o Gist ID non configurati - restore disabilitato")
         return False
     
-    print("🔄 Tentativo di ripristino database da backup...")
+    log_backup.info("🔄 Tentativo di ripristino database da backup...")
     if restore_database_from_gist():
-        print("✅ Database ripristinato dal backup GitHub!")
+        log_backup.info("✅ Database ripristinato dal backup GitHub!")
         return True
     else:
-        print("❌ Ripristino fallito, si parte con database nuovo")
+        log_backup.warning("❌ Ripristino fallito, si parte con database nuovo")
         # Ricrea almeno gli admin
         init_db()
         return False
 
-# === BACKUP AUTOMATICO OGNI 25 MINUTI ===
-def backup_scheduler():
-    """Scheduler per backup automatici migliorato"""
-    print("🔄 Scheduler backup avviato (ogni 25 minuti)")
-    
-    # Backup immediato all'avvio
-    time.sleep(10)
-    print("🔄 Backup iniziale in corso...")
-    backup_database_to_gist()
-    
-    # Backup ogni 25 minuti per sicurezza
-    while True:
-        time.sleep(1500)  # 25 minuti invece di 30 per sicurezza
-        print("🔄 Backup automatico in corso...")
-        if backup_database_to_gist():
-            print("✅ Backup completato con successo")
+# === LAVORI PERIODICI ===
+# Backup, keep-alive e controlli integrità girano tutti sullo stesso scheduler asyncio (vedi scheduler.py)
+INTERVALLO_BACKUP = 1500   # 25 minuti invece di 30 per sicurezza
+scheduler = Scheduler()
+# Stato dei wizard (user_data) salvato nel database: sopravvive a redeploy e riavvii
+persistenza = PersistenzaSQLite(DATABASE_NAME)
+
+# === METRICHE (/metrics) ===
+# Etichette solo da insiemi chiusi (route registrate, codici callback, esiti): niente id utente o seriali
+HANDLER_DURATA = registro.istogramma(
+    "handler_durata_secondi", "Durata di handle_message / button_handler per route", ("tipo", "route"))
+BACKUP_DURATA = registro.istogramma(
+    "backup_durata_secondi", "Durata del backup su Gist", bucket=(0.5, 1, 2.5, 5, 10, 30, 60, 120))
+BACKUP_ESITI = registro.contatore("backup_totali", "Backup eseguiti per esito", ("esito",))
+BACKUP_DIMENSIONE = registro.gauge("backup_dimensione_byte", "Dimensione del database all'ultimo backup")
+# Letti al momento dello scrape: la funzione viene collegata in esegui_bot
+CODA_UPDATE = registro.gauge("update_coda_profondita", "Update ricevuti in attesa del turno della chat o di un posto libero")
+UPDATE_IN_CORSO = registro.gauge("update_in_elaborazione", "Update in elaborazione in questo momento")
+
+def esegui_backup():
+    """Backup su Gist con durata ed esito registrati nelle metriche"""
+    with BACKUP_DURATA.misura():
+        esito = backup_database_to_gist()
+    BACKUP_ESITI.inc(esito="ok" if esito else "errore")
+    return esito
+
+TIMEOUT_BACKUP_FINALE = 20   # Render concede 30 secondi tra SIGTERM e SIGKILL
+
+async def backup_finale(*jobs):
+    """Allo spegnimento, dopo l'ultimo battito e il flush della persistenza: i job di backup indicati
+    girano un'ultima volta, così ore istanza e stato dei wizard arrivano sul Gist prima del deploy"""
+    async def esegui_tutti():
+        for nome in jobs:
+            job = scheduler.jobs[nome]
+            # Un backup già in corso potrebbe aver letto il database prima dell'ultimo battito: lo aspetto
+            async with job.lock:
+                pass
+            await scheduler.esegui_ora(nome)
+
+    try:
+        await asyncio.wait_for(esegui_tutti(), TIMEOUT_BACKUP_FINALE)
+    except asyncio.TimeoutError:
+        log_backup.warning("⏳ Backup finale non concluso entro %ds", TIMEOUT_BACKUP_FINALE)
+
+# === SISTEMA KEEP-ALIVE ADATTIVO ===
+# Render (piano free) spegne il servizio dopo KEEPALIVE_IDLE_TIMEOUT secondi senza richieste HTTP in ingresso.
+# Il ping parte solo quando serve (metà del timeout dall'ultima richiesta ricevuta), su un solo endpoint
+# economico con fallback "hedged", e non termina mai il processo: dopo N fallimenti consecutivi
+# controlla il server in locale e, se è lui il problema, lo riavvia.
+KEEPALIVE_BASE_URL = (os.environ.get('KEEPALIVE_URL') or WEBHOOK_URL or "https://telegram-bot-autoprotettori.onrender.com").rstrip('/')
+KEEPALIVE_IDLE_TIMEOUT = int(os.environ.get('KEEPALIVE_IDLE_TIMEOUT', 900))  # 15 minuti su Render free
+KEEPALIVE_SOGLIA_GUASTO = 3        # fallimenti consecutivi prima del self-check locale
+KEEPALIVE_ATTESA_FALLBACK = 3      # secondi prima di lanciare in parallelo la richiesta di fallback
+KEEPALIVE_RITENTA_MIN = 30         # attesa minima tra due tentativi dopo un fallimento
+KEEPALIVE_TICK = 30                # ogni quanto lo scheduler valuta se serve un ping
+
+ULTIMA_RICHIESTA_WEB = time.monotonic()   # ultima richiesta HTTP arrivata dall'esterno
+STATO_KEEPALIVE = {
+    "stato": "avvio",            # avvio / ok / esterno_irraggiungibile / server_riavviato
+    "attesa": KEEPALIVE_IDLE_TIMEOUT / 2,
+    "ultimo_tentativo": time.monotonic(),
+    "fallimenti_consecutivi": 0,
+    "ultimo_ping": None,
+    "ultimo_esito": None,
+    "ping_totali": 0,
+    "ping_saltati": 0,
+}
+
+def intervallo_keepalive():
+    """Metà del timeout di inattività: lascia margine per un secondo tentativo prima dello spin-down"""
+    return KEEPALIVE_IDLE_TIMEOUT / 2
+
+async def _get_ok(session, url):
+    try:
+        async with session.get(url) as response:
+            return response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+async def ping_esterno(session):
+    """GET su /health; se non risponde entro pochi secondi parte in parallelo /ping, vince il primo successo"""
+    primario = asyncio.create_task(_get_ok(session, f"{KEEPALIVE_BASE_URL}/health"))
+    done, _ = await asyncio.wait({primario}, timeout=KEEPALIVE_ATTESA_FALLBACK)
+    if primario in done and primario.result():
+        return True
+
+    in_corso = {primario} - done
+    in_corso.add(asyncio.create_task(_get_ok(session, f"{KEEPALIVE_BASE_URL}/ping")))
+    try:
+        while in_corso:
+            done, in_corso = await asyncio.wait(in_corso, return_when=asyncio.FIRST_COMPLETED)
+            if any(task.result() for task in done):
+                return True
+        return False
+    finally:
+        for task in in_corso:
+            task.cancel()
+
+async def self_check_locale(session):
+    """Verifica che il server web risponda sulla porta locale (esclude problemi di rete/DNS esterni)"""
+    return await _get_ok(session, f"http://127.0.0.1:{WEB_PORT}/health")
+
+def _cambia_stato_keepalive(nuovo_stato, messaggio):
+    if STATO_KEEPALIVE["stato"] != nuovo_stato:
+        log_keepalive.log(logging.INFO if nuovo_stato == "ok" else logging.WARNING, messaggio)
+    STATO_KEEPALIVE["stato"] = nuovo_stato
+
+async def keep_alive_tick(application, session):
+    """Job dello scheduler: pinga solo quando nessuna richiesta esterna ha già tenuto sveglio il servizio"""
+    adesso = time.monotonic()
+    if adesso < STATO_KEEPALIVE["ultimo_tentativo"] + STATO_KEEPALIVE["attesa"]:
+        return None
+    if adesso < ULTIMA_RICHIESTA_WEB + STATO_KEEPALIVE["attesa"]:
+        # Il servizio è già stato tenuto sveglio da traffico esterno: riparto da quella richiesta
+        STATO_KEEPALIVE["ping_saltati"] += 1
+        STATO_KEEPALIVE["ultimo_tentativo"] = ULTIMA_RICHIESTA_WEB
+        return None
+
+    ok = await ping_esterno(session)
+    STATO_KEEPALIVE["ultimo_tentativo"] = time.monotonic()
+    STATO_KEEPALIVE["ping_totali"] += 1
+    STATO_KEEPALIVE["ultimo_ping"] = datetime.now()
+    STATO_KEEPALIVE["ultimo_esito"] = ok
+
+    if ok:
+        STATO_KEEPALIVE["fallimenti_consecutivi"] = 0
+        STATO_KEEPALIVE["attesa"] = intervallo_keepalive()
+        _cambia_stato_keepalive("ok", "✅ Keep-alive: ping esterni di nuovo OK")
+        return True
+
+    STATO_KEEPALIVE["fallimenti_consecutivi"] += 1
+    # Dopo un fallimento ritento più spesso, senza scendere sotto il minimo
+    STATO_KEEPALIVE["attesa"] = max(KEEPALIVE_RITENTA_MIN, STATO_KEEPALIVE["attesa"] / 2)
+
+    if STATO_KEEPALIVE["fallimenti_consecutivi"] >= KEEPALIVE_SOGLIA_GUASTO:
+        if await self_check_locale(session):
+            _cambia_stato_keepalive(
+                "esterno_irraggiungibile",
+                f"⚠️ Keep-alive: {STATO_KEEPALIVE['fallimenti_consecutivi']} ping esterni falliti ma il server locale risponde - continuo"
+            )
         else:
-            print("❌ Backup fallito, riprovo al prossimo ciclo")
-
-# === SISTEMA KEEP-ALIVE ULTRA-AGGRESSIVO ===
-def keep_alive_aggressive():
-    """Keep-alive ultra-aggressivo per evitare spin-down"""
-    urls = [
-        "https://telegram-bot-autoprotettori.onrender.com/health",
-        "https://telegram-bot-autoprotettori.onrender.com/", 
-        "https://telegram-bot-autoprotettori.onrender.com/ping",
-        "https://telegram-bot-autoprotettori.onrender.com/status",
-        "https://telegram-bot-autoprotettori.onrender.com/keep-alive"
-    ]
-    
-    print("🔄 Sistema keep-alive ULTRA-AGGRESSIVO avviato! Ping ogni 5 minuti...")
-    
-    while True:
-        success_count = 0
-        for url in urls:
-            try:
-                response = requests.get(url, timeout=15)
-                if response.status_code == 200:
-                    print(f"✅ Ping riuscito - {datetime.now().strftime('%H:%M:%S')} - {url}")
-                    success_count += 1
-                else:
-                    print(f"⚠️  Ping {url} - Status: {response.status_code}")
-            except Exception as e:
-                print(f"❌ Errore ping {url}: {e}")
-        
-        print(f"📊 Ping completati: {success_count}/{len(urls)} successi")
-        
-        if success_count == 0:
-            print("🚨 CRITICO: Tutti i ping falliti! Riavvio in 30 secondi...")
-            time.sleep(30)
-            # Forza il riavvio
-            os._exit(1)
-        
-        # Aspetta solo 5 minuti (300 secondi) - molto meno di 15 minuti!
-        time.sleep(300)
+            log_keepalive.error("🚨 Keep-alive: il server web non risponde nemmeno in locale - lo riavvio")
+            await ferma_web_server(application)
+            # Senza argomenti: le sotto-app (es. bot cambi in avvio_unico.py) vengono da bot_data
+            await avvia_web_server(application)
+            _cambia_stato_keepalive("server_riavviato", "🔄 Keep-alive: server web riavviato")
+    return False
+
+def get_keepalive_status():
+    """Riassunto keep-alive per lo Status Server"""
+    ultimo = STATO_KEEPALIVE["ultimo_ping"]
+    msg = "🔄 **KEEP-ALIVE:**\n"
+    msg += f"• Stato: {STATO_KEEPALIVE['stato']}\n"
+    msg += f"• Ultimo ping: {ultimo.strftime('%H:%M:%S') if ultimo else 'mai'}"
+    if ultimo:
+        msg += " ✅" if STATO_KEEPALIVE["ultimo_esito"] else " ❌"
+    msg += f"\n• Ping eseguiti/saltati: {STATO_KEEPALIVE['ping_totali']}/{STATO_KEEPALIVE['ping_saltati']}\n"
+    msg += f"• Fallimenti consecutivi: {STATO_KEEPALIVE['fallimenti_consecutivi']}\n"
+    return msg
 
 # === FUNZIONI SERVER STATUS ===
+# === ORE ISTANZA (piano free Render: 750 ore/mese) ===
+# All'avvio si conta un riavvio, poi ogni INTERVALLO_BATTITO secondi il tempo trascorso viene sommato
+# alla riga del giorno (UTC, come la fatturazione). Il contatore sta nel database, che su Render
+# sopravvive a un deploy solo tramite il backup su Gist: allo spegnimento si fanno l'ultimo battito
+# e un backup finale (backup_finale). Un arresto senza SIGTERM (crash, OOM) perde il tempo dall'ultimo
+# backup riuscito, cioè fino a INTERVALLO_BACKUP.
+LIMITE_ORE_MESE = 750
+INTERVALLO_BATTITO = 60
+_ultimo_battito = None   # time.time() dell'ultimo tempo già sommato nel database
+
+def _giorno_utc(istante):
+    return datetime.fromtimestamp(istante, timezone.utc).date()
+
+def _somma_secondi(c, inizio, fine):
+    """Ripartisce l'intervallo [inizio, fine) sui giorni UTC che attraversa"""
+    while inizio < fine:
+        giorno = _giorno_utc(inizio)
+        mezzanotte = datetime.combine(giorno + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp()
+        tratto = min(fine, mezzanotte) - inizio
+        c.execute('''INSERT INTO ore_istanza (giorno, secondi) VALUES (?, ?)
+                     ON CONFLICT(giorno) DO UPDATE SET secondi = secondi + excluded.secondi''',
+                  (giorno.isoformat(), tratto))
+        inizio += tratto
+
+def registra_avvio_istanza():
+    global _ultimo_battito
+    _ultimo_battito = time.time()
+    conn = connetti()
+    conn.execute('''INSERT INTO ore_istanza (giorno, avvii) VALUES (?, 1)
+                    ON CONFLICT(giorno) DO UPDATE SET avvii = avvii + 1''',
+                 (_giorno_utc(_ultimo_battito).isoformat(),))
+    conn.commit()
+    conn.close()
+
+def battito_istanza():
+    """Job periodico (e ultimo battito allo spegnimento): somma il tempo dall'ultimo battito"""
+    global _ultimo_battito
+    if _ultimo_battito is None:
+        return False
+    adesso = time.time()
+    conn = connetti()
+    _somma_secondi(conn.cursor(), _ultimo_battito, adesso)
+    conn.commit()
+    conn.close()
+    _ultimo_battito = adesso
+    return True
+
 def get_render_usage_simple():
-    """
-    Versione semplificata che stima l'uso basandosi sul tempo di attività
-    e mostra informazioni sul consumo mensile
-    """
+    """Consumo ore del mese misurato dalla tabella ore_istanza (una riga per giorno: risposta immediata)"""
     try:
-        # Calcola giorni nel mese corrente
-        today = datetime.now()
-        first_day_next_month = datetime(today.year, today.month % 12 + 1, 1)
-        last_day_current_month = first_day_next_month - timedelta(days=1)
-        days_in_month = last_day_current_month.day
-        days_passed = today.day
-        days_remaining = days_in_month - days_passed
-        
-        # Stima ore usate basandosi sui giorni passati
-        # Assumendo che il bot sia sempre attivo (24/7)
-        hours_in_day = 24
-        estimated_hours_used = days_passed * hours_in_day
-        monthly_limit = 750  # Ore incluse nel piano di Render
-        
-        # Calcola proiezione mensile
-        projected_monthly_usage = (estimated_hours_used / days_passed) * days_in_month
-        hours_remaining = monthly_limit - projected_monthly_usage
-        
-        # Calcola percentuali
-        usage_percentage = (estimated_hours_used / monthly_limit) * 100
-        projected_percentage = (projected_monthly_usage / monthly_limit) * 100
-        
+        adesso = datetime.now(timezone.utc)
+        inizio_mese = datetime(adesso.year, adesso.month, 1, tzinfo=timezone.utc)
+        inizio_mese_prossimo = datetime(adesso.year + adesso.month // 12, adesso.month % 12 + 1, 1, tzinfo=timezone.utc)
+        days_in_month = (inizio_mese_prossimo - inizio_mese).days
+
+        conn = connetti()
+        c = conn.cursor()
+        c.execute('''SELECT COALESCE(SUM(secondi), 0), COALESCE(SUM(avvii), 0), MIN(giorno)
+                     FROM ore_istanza WHERE giorno >= ?''', (inizio_mese.date().isoformat(),))
+        secondi, riavvii, primo_giorno = c.fetchone()
+        c.execute("SELECT avvii FROM ore_istanza WHERE giorno = ?", (adesso.date().isoformat(),))
+        riavvii_oggi = (c.fetchone() or (0,))[0]
+        conn.close()
+
+        # Più il tempo non ancora sommato dall'ultimo battito
+        if _ultimo_battito is not None:
+            secondi += time.time() - _ultimo_battito
+        ore_usate = secondi / 3600
+
+        # Proiezione al ritmo misurato, dall'inizio del mese o dal primo giorno registrato
+        inizio_misura = inizio_mese
+        if primo_giorno:
+            inizio_misura = max(inizio_mese, datetime.fromisoformat(primo_giorno).replace(tzinfo=timezone.utc))
+        ore_trascorse = max((adesso - inizio_misura).total_seconds() / 3600, 1 / 60)
+        ore_rimanenti_mese = (inizio_mese_prossimo - adesso).total_seconds() / 3600
+        ritmo = min(ore_usate / ore_trascorse, 1.0)   # frazione del tempo in cui l'istanza è attiva
+        proiezione = ore_usate + ritmo * ore_rimanenti_mese
+
+        usage_percentage = ore_usate / LIMITE_ORE_MESE * 100
+        projected_percentage = proiezione / LIMITE_ORE_MESE * 100
+
         status_msg = "🖥️ **STATUS SERVER RENDER**\n\n"
-        status_msg += f"📅 **MESE CORRENTE:** {today.strftime('%B %Y')}\n"
-        status_msg += f"• Giorni passati: {days_passed}/{days_in_month}\n"
-        status_msg += f"• Giorni rimanenti: {days_remaining}\n\n"
-        
-        status_msg += "⏰ **CONSUMO ORE (STIMA):**\n"
-        status_msg += f"• Ore stimate usate: {estimated_hours_used:.1f}h\n"
-        status_msg += f"• Proiezione mensile: {projected_monthly_usage:.1f}h/750h\n"
-        status_msg += f"• Ore stimate rimanenti: {hours_remaining:.1f}h\n\n"
-        
+        status_msg += f"📅 **MESE CORRENTE:** {adesso.strftime('%B %Y')} (UTC)\n"
+        status_msg += f"• Giorni passati: {adesso.day}/{days_in_month}\n"
+        status_msg += f"• Giorni rimanenti: {days_in_month - adesso.day}\n\n"
+
+        status_msg += "⏰ **CONSUMO ORE (MISURATO):**\n"
+        status_msg += f"• Ore usate: {ore_usate:.1f}h"
+        if inizio_misura > inizio_mese:
+            status_msg += f" (misurate dal {inizio_misura.strftime('%d/%m')})"
+        status_msg += "\n"
+        status_msg += f"• Attività: {ritmo * 100:.1f}% del tempo\n"
+        status_msg += f"• Proiezione mensile: {proiezione:.1f}h/{LIMITE_ORE_MESE}h\n"
+        status_msg += f"• Ore rimanenti a fine mese: {LIMITE_ORE_MESE - proiezione:.1f}h\n"
+        status_msg += f"• Riavvii: {riavvii} nel mese, {riavvii_oggi} oggi\n\n"
+
         status_msg += "📊 **PERCENTUALI:**\n"
         status_msg += f"• Consumo attuale: {usage_percentage:.1f}%\n"
         status_msg += f"• Proiezione finale: {projected_percentage:.1f}%\n\n"
-        
+
         # Aggiungi avvisi se il consumo è alto
-        if projected_percentage > 80:
-            status_msg += "🚨 **ATTENZIONE:** Consumo elevato previsto!\n"
-        elif projected_percentage > 60:
-            status_msg += "⚠️ **NOTA:** Consumo nella norma\n"
+        if projected_percentage > 100:
+            status_msg += "🚨 **ATTENZIONE:** Al ritmo attuale si supera il limite mensile!\n"
+        elif projected_percentage > 80:
+            status_msg += "⚠️ **NOTA:** Consumo vicino al limite\n"
         else:
             status_msg += "✅ **OK:** Consumo sotto controllo\n"
-            
-        status_msg += f"\n🕒 Aggiornato: {today.strftime('%d/%m/%Y %H:%M')}"
-        
+
+        status_msg += f"\n🕒 Aggiornato: {adesso.strftime('%d/%m/%Y %H:%M')} UTC"
+
         return status_msg
-        
+
     except Exception as e:
         return f"❌ Errore nel calcolo: {str(e)}"
 
+# === CAMPIONATORE METRICHE DI SISTEMA ===
+# Un job dello scheduler legge CPU, memoria, file descriptor e ritardo dell'event loop ogni
+# CAMPIONAMENTO_SISTEMA secondi in un buffer circolare di un'ora: chi le mostra non aspetta mai.
+CAMPIONAMENTO_SISTEMA = 5
+FINESTRE_SISTEMA = {"1m": 60, "15m": 900, "1h": 3600}
+campioni_sistema = deque(maxlen=FINESTRE_SISTEMA["1h"] // CAMPIONAMENTO_SISTEMA)   # (timestamp, {grandezza: valore})
+
+# grandezza -> (etichetta, unità)
+GRANDEZZE_SISTEMA = {
+    "cpu_bot": ("CPU Bot", "%"),
+    "cpu_sistema": ("CPU Sistema", "%"),
+    "rss_mb": ("RAM Bot", "MB"),
+    "memoria_percento": ("RAM Sistema", "%"),
+    "file_aperti": ("File aperti", ""),
+    "lag_loop_ms": ("Ritardo event loop", "ms"),
+}
+
+_processo = psutil.Process(os.getpid())
+# cpu_percent(None) misura dal campione precedente: la prima chiamata serve solo da riferimento
+_processo.cpu_percent(None)
+psutil.cpu_percent(None)
+
+async def campiona_sistema():
+    """Job periodico: un campione nel buffer (nessuna attesa bloccante)"""
+    loop = asyncio.get_running_loop()
+    # Ritardo del loop: quanto in ritardo si risveglia un breve sleep rispetto al previsto
+    previsto = loop.time() + 0.01
+    await asyncio.sleep(0.01)
+    lag_ms = max(0.0, loop.time() - previsto) * 1000
+
+    with _processo.oneshot():
+        cpu_bot = _processo.cpu_percent(None)
+        rss_mb = _processo.memory_info().rss / 1024 / 1024
+        try:
+            file_aperti = _processo.num_fds()
+        except AttributeError:
+            # Windows: niente file descriptor, uso gli handle
+            file_aperti = _processo.num_handles()
+
+    campioni_sistema.append((time.time(), {
+        "cpu_bot": cpu_bot,
+        "cpu_sistema": psutil.cpu_percent(None),
+        "rss_mb": rss_mb,
+        "memoria_percento": psutil.virtual_memory().percent,
+        "file_aperti": file_aperti,
+        "lag_loop_ms": lag_ms,
+    }))
+
+def statistiche_sistema(secondi):
+    """{grandezza: (min, media, max)} sui campioni degli ultimi `secondi` secondi"""
+    limite = time.time() - secondi
+    valori = {grandezza: [] for grandezza in GRANDEZZE_SISTEMA}
+    # Il buffer è in ordine di tempo: si scorre dal più recente e ci si ferma al primo troppo vecchio
+    for quando, campione in reversed(campioni_sistema):
+        if quando < limite:
+            break
+        for grandezza, valore in campione.items():
+            valori[grandezza].append(valore)
+    return {grandezza: (min(lista), sum(lista) / len(lista), max(lista))
+            for grandezza, lista in valori.items() if lista}
+
+def serie_sistema_per_metrics():
+    """Serie per il gauge di /metrics: (grandezza, finestra, statistica) -> valore"""
+    serie = {}
+    for finestra, secondi in FINESTRE_SISTEMA.items():
+        for grandezza, terna in statistiche_sistema(secondi).items():
+            for statistica, valore in zip(("min", "media", "max"), terna):
+                serie[(grandezza, finestra, statistica)] = valore
+    return serie
+
+SISTEMA_FINESTRE = registro.gauge(
+    "sistema_finestra", "Min/media/max delle metriche di sistema su 1m/15m/1h",
+    ("grandezza", "finestra", "statistica"), funzione=serie_sistema_per_metrics)
+
 def get_system_metrics():
-    """Ottiene metriche di sistema base"""
-    try:
-        # Metriche di memoria
-        process = psutil.Process(os.getpid())
-        process_memory = process.memory_info().rss / 1024 / 1024  # MB
-        
-        system_memory = psutil.virtual_memory()
-        total_memory_used = system_memory.used / 1024 / 1024  # MB
-        total_memory_total = system_memory.total / 1024 / 1024  # MB
-        memory_percent = system_memory.percent
-        
-        # Metriche di CPU
-        cpu_percent = psutil.cpu_percent(interval=1)
-        
-        # Uptime del sistema
-        boot_time = datetime.fromtimestamp(psutil.boot_time())
-        uptime = datetime.now() - boot_time
-        
-        metrics_msg = "📊 **METRICHE DI SISTEMA:**\n"
-        metrics_msg += f"• RAM Bot: {process_memory:.1f}MB\n"
-        metrics_msg += f"• RAM Sistema: {total_memory_used:.1f}MB / {total_memory_total:.1f}MB ({memory_percent:.1f}%)\n"
-        metrics_msg += f"• CPU: {cpu_percent:.1f}%\n"
-        metrics_msg += f"• Uptime: {str(uptime).split('.')[0]}\n"
-        
-        return metrics_msg
-        
-    except Exception as e:
-        return f"📊 Errore metriche: {str(e)}"
+    """Metriche di sistema dal buffer del campionatore: ultimo valore e min/media/max per finestra"""
+    if not campioni_sistema:
+        return "📊 **METRICHE DI SISTEMA:**\n• ⏳ Primo campione in arrivo...\n"
+
+    ultimo = campioni_sistema[-1][1]
+    finestre = {nome: statistiche_sistema(secondi) for nome, secondi in FINESTRE_SISTEMA.items()}
+    system_memory = psutil.virtual_memory()
+    uptime = datetime.now() - datetime.fromtimestamp(psutil.boot_time())
+
+    metrics_msg = "📊 **METRICHE DI SISTEMA** (ora | min/media/max 1m · 15m · 1h):\n"
+    for grandezza, (etichetta, unita) in GRANDEZZE_SISTEMA.items():
+        riepilogo = " · ".join(
+            "/".join(f"{valore:.1f}" for valore in finestre[nome][grandezza])
+            for nome in FINESTRE_SISTEMA if grandezza in finestre[nome])
+        metrics_msg += f"• {etichetta}: {ultimo[grandezza]:.1f}{unita} | {riepilogo}\n"
+    metrics_msg += f"• Memoria usata: {system_memory.used / 1024 / 1024:.1f}MB / {system_memory.total / 1024 / 1024:.1f}MB\n"
+    metrics_msg += f"• Uptime: {str(uptime).split('.')[0]}\n"
+    metrics_msg += f"• Campioni: {len(campioni_sistema)} (ogni {CAMPIONAMENTO_SISTEMA}s)\n"
+    return metrics_msg
 
 # === FUNZIONI ARTICOLI ===
 def get_prefisso_categoria(categoria):
@@ -536,7 +966,7 @@ def get_prefisso_categoria(categoria):
     return prefissi.get(categoria, "ART")
 
 def insert_articolo(seriale, categoria, sede, stato="disponibile"):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     try:
         c.execute('''INSERT INTO articoli (seriale, categoria, sede, stato) 
@@ -549,29 +979,128 @@ def insert_articolo(seriale, categoria, sede, stato="disponibile"):
         conn.close()
 
 def get_articolo(seriale):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute("SELECT * FROM articoli WHERE seriale = ?", (seriale,))
     result = c.fetchone()
     conn.close()
     return result
 
-def update_stato(seriale, stato):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+def get_articolo_by_id(articolo_id):
+    conn = connetti()
+    c = conn.cursor()
+    c.execute("SELECT * FROM articoli WHERE id = ?", (articolo_id,))
+    result = c.fetchone()
+    conn.close()
+    return result
+
+def get_id_articoli(seriali):
+    """Mappa seriale -> id per i seriali richiesti (usata per i callback compatti)"""
+    mappa = {}
+    conn = connetti()
+    c = conn.cursor()
+    # A blocchi per restare sotto il limite di parametri di SQLite
+    for inizio in range(0, len(seriali), 500):
+        blocco = seriali[inizio:inizio + 500]
+        segnaposti = ",".join("?" * len(blocco))
+        c.execute(f"SELECT seriale, id FROM articoli WHERE seriale IN ({segnaposti})", blocco)
+        mappa.update(c.fetchall())
+    conn.close()
+    return mappa
+
+RISULTATI_RICERCA_MAX = 10
+FTS_DISPONIBILE = True   # diventa False alla prima ricerca se articoli_fts non è utilizzabile
+
+def cerca_articoli(testo, limite=RISULTATI_RICERCA_MAX):
+    """
+    Ricerca per seriale senza distinzione maiuscole/minuscole, restituisce righe
+    (id, seriale, categoria, sede, stato):
+    1) seriali che iniziano con `testo`: range scan sull'indice NOCASE di seriale
+    2) se non bastano, seriali che lo contengono: indice FTS5 a trigrammi (da 3 caratteri),
+       se la versione di SQLite lo supporta (vedi _migrazione_3)
+    """
+    global FTS_DISPONIBILE
+    testo = testo.strip()
+    if not testo:
+        return []
+
+    conn = connetti()
+    c = conn.cursor()
+    # I seriali sono salvati come inseriti (anche misti, es. "2aUT..."): il confronto avviene nello spazio
+    # NOCASE, che ripiega solo A-Z su a-z. Intervallo [x, x+1) invece di LIKE 'x%' per usare l'indice
+    inizio = "".join(ch.lower() if 'A' <= ch <= 'Z' else ch for ch in testo)
+    successivo = chr(ord(inizio[-1]) + 1)
+    if 'A' <= successivo <= 'Z':
+        # '@' + 1 = 'A', che NOCASE confronta come 'a': il carattere che segue '@' in quello spazio è '['
+        successivo = '['
+    c.execute('''SELECT id, seriale, categoria, sede, stato FROM articoli
+                 WHERE seriale COLLATE NOCASE >= ? AND seriale COLLATE NOCASE < ?
+                 ORDER BY seriale COLLATE NOCASE LIMIT ?''',
+              (inizio, inizio[:-1] + successivo, limite))
+    risultati = c.fetchall()
+
+    if len(risultati) < limite and len(testo) >= 3 and FTS_DISPONIBILE:
+        trovati = {r[0] for r in risultati}
+        frammento = '"' + testo.replace('"', '""') + '"'
+        try:
+            c.execute('''SELECT a.id, a.seriale, a.categoria, a.sede, a.stato
+                         FROM articoli_fts JOIN articoli a ON a.id = articoli_fts.rowid
+                         WHERE articoli_fts MATCH ? LIMIT ?''', (frammento, limite + len(trovati)))
+            risultati += [r for r in c.fetchall() if r[0] not in trovati][:limite - len(risultati)]
+        except sqlite3.OperationalError as e:
+            # Tabella articoli_fts assente (migrazione saltata) o modulo fts5 mancante: non ci riprovo
+            FTS_DISPONIBILE = False
+            log_database.warning("⚠️ Ricerca per frammento disattivata (%s): resta quella per prefisso", e)
+    conn.close()
+    return risultati
+
+def update_stato(seriale, stato, stati_attesi, user_id=None):
+    """
+    Compare-and-set: cambia stato solo se quello attuale è tra stati_attesi.
+    Restituisce True se la modifica è avvenuta, False se qualcun altro è arrivato prima.
+    """
+    conn = connetti()
     c = conn.cursor()
-    c.execute("UPDATE articoli SET stato = ? WHERE seriale = ?", (stato, seriale))
+    segnaposti = ",".join("?" * len(stati_attesi))
+    c.execute(f'''UPDATE articoli SET stato = ?, aggiornato_da = ?, aggiornato_il = CURRENT_TIMESTAMP
+                  WHERE seriale = ? AND stato IN ({segnaposti})''', (stato, user_id, seriale, *stati_attesi))
     conn.commit()
+    aggiornato = c.rowcount == 1
+    conn.close()
+    return aggiornato
+
+def descrivi_conflitto(seriale):
+    """Messaggio per chi perde una modifica concorrente: stato attuale e chi l'ha impostato"""
+    conn = connetti()
+    c = conn.cursor()
+    c.execute('''SELECT a.stato, u.nome, a.aggiornato_il FROM articoli a
+                 LEFT JOIN utenti u ON u.user_id = a.aggiornato_da
+                 WHERE a.seriale = ?''', (seriale,))
+    risultato = c.fetchone()
     conn.close()
 
+    if risultato is None:
+        return f"⚠️ {seriale} non è più in inventario"
+    stato, nome, quando = risultato
+    msg = f"⚠️ {seriale} già segnato {ETICHETTE_STATI.get(stato, stato)}"
+    if nome:
+        msg += f" da {nome}"
+    if quando:
+        msg += f" ({quando})"
+    return msg
+
 def delete_articolo(seriale):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    """Restituisce False se l'articolo era già stato rimosso"""
+    conn = connetti()
     c = conn.cursor()
     c.execute("DELETE FROM articoli WHERE seriale = ?", (seriale,))
     conn.commit()
+    eliminato = c.rowcount == 1
     conn.close()
+    return eliminato
 
 def get_articoli_per_stato(stato):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     
     # Gestisce sia stati base che stati combinati
@@ -591,15 +1120,23 @@ def get_articoli_per_stato(stato):
     return result
 
 def get_articoli_per_categoria(categoria):
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute("SELECT seriale, categoria, sede, stato FROM articoli WHERE categoria = ?", (categoria,))
     result = c.fetchall()
     conn.close()
     return result
 
+def conta_articoli():
+    conn = connetti()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM articoli")
+    risultato = c.fetchone()[0]
+    conn.close()
+    return risultato
+
 def get_tutti_articoli():
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute("SELECT seriale, categoria, sede, stato FROM articoli")
     result = c.fetchall()
@@ -608,7 +1145,7 @@ def get_tutti_articoli():
 
 def conta_bombole_disponibili():
     """CONTA TOTALE BOMBOLE (Erba + Centrale) - NUOVA VERSIONE"""
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute('''SELECT COUNT(*) FROM articoli 
                  WHERE categoria = 'bombola' AND stato = 'disponibile' ''')
@@ -618,7 +1155,7 @@ def conta_bombole_disponibili():
 
 def get_categorie_con_articoli(stato=None):
     """Restituisce le categorie che hanno articoli in un determinato stato"""
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     
     if stato:
@@ -657,7 +1194,7 @@ def ricostruisci_database_da_inventario(testo_inventario):
     """
     try:
         # Pulisce il database esistente (mantiene solo utenti)
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = connetti()
         c = conn.cursor()
         c.execute("DELETE FROM articoli")
         
@@ -688,25 +1225,25 @@ def ricostruisci_database_da_inventario(testo_inventario):
         errori = 0
         articoli_invalidi = []
         
-        print(f"🔍 Analizzando {len(lines)} righe...")  # DEBUG
+        log_inventario.debug("🔍 Analizzando %d righe...", len(lines))
         
         for i, line in enumerate(lines):
             line = line.strip()
-            #print(f"Riga {i}: {line}")  # DEBUG
+            log_inventario.debug("Riga %d: %s", i, line)
             
             # Controlla se è un header di STATO (DISPONIBILI, USATI, FUORI USO)
             for stato_testo, stato_db in mappatura_stati.items():
                 if stato_testo in line:
                     stato_corrente = stato_db
                     categoria_corrente = None
-                    print(f"📌 Trovato stato: {stato_testo} -> {stato_db}")  # DEBUG
+                    log_inventario.debug("📌 Trovato stato: %s -> %s", stato_testo, stato_db)
                     break
             
             # Controlla se è un header di CATEGORIA (Bombola, Maschera, etc.)
             for cat_testo, cat_db in mappatura_categorie.items():
                 if cat_testo in line and ":" in line:  # Cerca ":" che indica una categoria
                     categoria_corrente = cat_db
-                    print(f"📌 Trovata categoria: {cat_testo} -> {cat_db}")  # DEBUG
+                    log_inventario.debug("📌 Trovata categoria: %s -> %s", cat_testo, cat_db)
                     break
             
             # Se è un articolo (inizia con • e abbiamo stato e categoria)
@@ -720,7 +1257,7 @@ def ricostruisci_database_da_inventario(testo_inventario):
                         # Se non c'è " - ", prendi tutto dopo il •
                         seriale = line[2:].strip()
                     
-                    print(f"🔍 Trovato articolo: {seriale}")  # DEBUG
+                    log_inventario.debug("🔍 Trovato articolo: %s", seriale)
                     
                     # Estrai la sede dal testo
                     sede_trovata = None
@@ -745,7 +1282,7 @@ def ricostruisci_database_da_inventario(testo_inventario):
                             elif stato_corrente == "fuori_uso":
                                 stato_finale = "fuori_uso_centrale"
                         
-                        print(f"✅ Inserendo: {seriale}, {categoria_corrente}, {sede_trovata}, {stato_finale}")  # DEBUG
+                        log_inventario.debug("✅ Inserendo: %s, %s, %s, %s", seriale, categoria_corrente, sede_trovata, stato_finale)
                         
                         # Inserisci nel database
                         c.execute('''INSERT OR IGNORE INTO articoli (seriale, categoria, sede, stato) 
@@ -753,24 +1290,24 @@ def ricostruisci_database_da_inventario(testo_inventario):
                         
                         if c.rowcount > 0:
                             articoli_inseriti += 1
-                            print(f"✅ Articolo inserito: {seriale}")  # DEBUG
+                            log_inventario.debug("✅ Articolo inserito: %s", seriale)
                         else:
                             errori += 1  # Duplicato o errore
-                            print(f"❌ Duplicato/salto: {seriale}")  # DEBUG
+                            log_inventario.debug("❌ Duplicato/salto: %s", seriale)
                     else:
                         errori += 1
                         articoli_invalidi.append(f"{seriale} (sede non trovata)")
-                        print(f"❌ Sede non trovata per: {seriale}")  # DEBUG
+                        log_inventario.debug("❌ Sede non trovata per: %s", seriale)
                             
                 except Exception as e:
                     errori += 1
                     articoli_invalidi.append(line)
-                    print(f"❌ Errore elaborazione riga: {line} - {e}")
+                    log_inventario.warning("❌ Errore elaborazione riga: %s - %s", line, e)
         
         conn.commit()
         conn.close()
         
-        print(f"📊 Ricostruzione completata: {articoli_inseriti} inseriti, {errori} errori")  # DEBUG
+        log_inventario.info("📊 Ricostruzione completata: %d inseriti, %d errori", articoli_inseriti, errori)
         
         messaggio = f"✅ Database ricostruito con successo!\n• Articoli inseriti: {articoli_inseriti}\n• Errori/duplicati: {errori}"
         
@@ -784,9 +1321,7 @@ def ricostruisci_database_da_inventario(testo_inventario):
         return True, messaggio
         
     except Exception as e:
-        import traceback
-        print(f"🚨 Errore grave durante ricostruzione: {str(e)}")
-        print(traceback.format_exc())
+        log_inventario.exception("🚨 Errore grave durante ricostruzione: %s", e)
         return False, f"❌ Errore durante la ricostruzione: {str(e)}"
 
 # === FUNZIONE HELP ===
@@ -804,6 +1339,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 🟢 Controllare disponibilità in tempo reale
 • 📊 Monitorare stati (disponibili/usati/fuori uso)
 • 📍 Gestire articoli in centrale
+• 🔎 Cercare un articolo: /cerca <seriale o parte> (anche inline: @nome_bot seriale)
 
 👨‍💻 **COME ADMIN:**
 • ➕ Aggiungere nuovi articoli all'inventario
@@ -813,52 +1349,82 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • ⚠️ Ricevere allarmi automatici per scorte bombole
 • 👥 Gestire richieste accesso nuovi utenti
 • 📤 Caricare inventario per ricostruire database
+• 📥 Esportare l'inventario: /export csv | jsonl | xlsx
+• 🗄️ Statistiche query e query lente: /sql [N] (o /sql azzera)
+• ⏱️ Profilazione: /profila [secondi], /memoria avvia|snapshot|diff|ferma
 
 🔄 **SISTEMA SEMPRE ATTIVO:**
-• ✅ Ping automatici ogni 5 minuti
+• ✅ Ping automatici adattivi anti spin-down
 • ✅ Backup automatico ogni 25 minuti
 • ✅ Zero tempi di attesa
 • ✅ Servizio 24/7 garantito
 """
 
-    await update.message.reply_text(help_text, reply_markup=crea_tastiera_fisica(user_id))
+    await update.message.reply_text(help_text, reply_markup=tastiera_se_cambiata(user_id))
 
 # === TASTIERA FISICA ===
-def crea_tastiera_fisica(user_id):
-    if not is_user_approved(user_id):
-        return ReplyKeyboardMarkup([[KeyboardButton("🚀 Richiedi Accesso")]], resize_keyboard=True)
-
-    tastiera = [
+# Le varianti possibili sono poche: costruite una volta all'avvio e scelte in base al ruolo in cache
+def _costruisci_tastiere():
+    tastiera_utente = [
         [KeyboardButton("📋 Inventario"), KeyboardButton("🔴 Segna Usato")],
         [KeyboardButton("🟢 Disponibili"), KeyboardButton("🔴 Usati")],
         [KeyboardButton("⚫ Fuori Uso"), KeyboardButton("📍 In Centrale")],
         [KeyboardButton("🆘 Help")]
     ]
+    tastiera_admin = tastiera_utente + [
+        [KeyboardButton("➕ Aggiungi"), KeyboardButton("➖ Rimuovi")],
+        [KeyboardButton("🔄 Ripristina"), KeyboardButton("📊 Statistiche")],
+        [KeyboardButton("👥 Gestisci Richieste")],
+        [KeyboardButton("📤 Carica Inventario")],
+    ]
+    # Pulsante status server solo per l'admin specifico
+    tastiera_status_server = tastiera_admin + [[KeyboardButton("🖥️ Status Server")]]
+
+    return {
+        'in_attesa': ReplyKeyboardMarkup([[KeyboardButton("🚀 Richiedi Accesso")]], resize_keyboard=True),
+        'user': ReplyKeyboardMarkup(tastiera_utente, resize_keyboard=True, is_persistent=True),
+        'admin': ReplyKeyboardMarkup(tastiera_admin, resize_keyboard=True, is_persistent=True),
+        'status_server': ReplyKeyboardMarkup(tastiera_status_server, resize_keyboard=True, is_persistent=True),
+    }
 
-    if is_admin(user_id):
-        tastiera.append([KeyboardButton("➕ Aggiungi"), KeyboardButton("➖ Rimuovi")])
-        tastiera.append([KeyboardButton("🔄 Ripristina"), KeyboardButton("📊 Statistiche")])
-        tastiera.append([KeyboardButton("👥 Gestisci Richieste")])
-        tastiera.append([KeyboardButton("📤 Carica Inventario")])  # NUOVO PULSANTE
-        
-        # AGGIUNGI QUESTO: pulsante status server solo per l'admin specifico
-        if user_id == 1816045269:
-            tastiera.append([KeyboardButton("🖥️ Status Server")])
+TASTIERE = _costruisci_tastiere()
+
+# Variante dell'ultima tastiera inviata a ogni utente: Telegram la mantiene finché non ne arriva un'altra
+_tastiera_inviata = {}
 
-    return ReplyKeyboardMarkup(tastiera, resize_keyboard=True, is_persistent=True)
+def variante_tastiera(user_id):
+    ruolo = get_ruolo(user_id)
+    if ruolo == 'admin':
+        return 'status_server' if user_id == STATUS_SERVER_ADMIN_ID else 'admin'
+    return 'user' if ruolo == 'user' else 'in_attesa'
+
+def crea_tastiera_fisica(user_id):
+    """Tastiera del ruolo attuale, da inviare comunque (es. /start)"""
+    variante = variante_tastiera(user_id)
+    _tastiera_inviata[user_id] = variante
+    return TASTIERE[variante]
+
+def tastiera_se_cambiata(user_id):
+    """Tastiera solo se il ruolo è cambiato dall'ultimo invio, altrimenti None (il client tiene quella che ha)"""
+    variante = variante_tastiera(user_id)
+    if _tastiera_inviata.get(user_id) == variante:
+        return None
+    _tastiera_inviata[user_id] = variante
+    return TASTIERE[variante]
 
 # === HANDLER START ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name
     
-    conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    conn = connetti()
     c = conn.cursor()
     c.execute('''INSERT OR IGNORE INTO utenti (user_id, username, nome, ruolo) 
                  VALUES (?, ?, ?, 'in_attesa')''', 
                  (user_id, update.effective_user.username, user_name))
     conn.commit()
     conn.close()
+    invalida_ruolo(user_id)
 
     if not is_user_approved(user_id):
         richieste = get_richieste_in_attesa()
@@ -902,8 +1468,8 @@ async def gestisci_richieste(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     keyboard = [
         [
-            InlineKeyboardButton("✅ Approva", callback_data=f"approva_{user_id_rich}"),
-            InlineKeyboardButton("❌ Rifiuta", callback_data=f"rifiuta_{user_id_rich}")
+            InlineKeyboardButton("✅ Approva", callback_data=cb("ap", user_id_rich)),
+            InlineKeyboardButton("❌ Rifiuta", callback_data=cb("rf", user_id_rich))
         ]
     ]
 
@@ -922,670 +1488,1383 @@ async def gestisci_richieste(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup=reply_markup
     )
 
-# === HANDLER MESSAGGI PRINCIPALE ===
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    text = update.message.text.strip()
-
-    if not is_user_approved(user_id):
-        if text == "🚀 Richiedi Accesso":
-            await start(update, context)
+# === HANDLER PULSANTI E STATI WIZARD ===
+# INVENTARIO - NUOVA VERSIONE ORGANIZZATA
+async def mostra_inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Inventario completo organizzato per stato e categoria"""
+    articoli = get_tutti_articoli()
+    if not articoli:
+        await update.message.reply_text("📦 Inventario vuoto")
         return
 
-    # INVENTARIO - NUOVA VERSIONE ORGANIZZATA
-    elif text == "📋 Inventario":
-        articoli = get_tutti_articoli()
-        if not articoli:
-            await update.message.reply_text("📦 Inventario vuoto")
-            return
-
-        msg = "📋 **INVENTARIO COMPLETO**\n\n"
-        
-        # ORGANIZZA PER STATO E CATEGORIA
-        disponibili = [a for a in articoli if a[3] == 'disponibile']
-        usati = [a for a in articoli if a[3] in ['usato', 'usato_centrale']]
-        fuori_uso = [a for a in articoli if a[3] in ['fuori_uso', 'fuori_uso_centrale']]
-        
-        # DISPONIBILI
-        if disponibili:
-            msg += f"🟢 **DISPONIBILI** ({len(disponibili)}):\n"
-            disponibili_organizzati = organizza_articoli_per_categoria(disponibili)
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = disponibili_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, _ in articoli_cat:
-                        msg += f"• {seriale} - {SEDI[sede]}\n"
-            msg += "\n"
-        
-        # USATI
-        if usati:
-            msg += f"🔴 **USATI** ({len(usati)}):\n"
-            usati_organizzati = organizza_articoli_per_categoria(usati)
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = usati_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, stato in articoli_cat:
-                        locazione = " (Centrale)" if stato == 'usato_centrale' else ""
-                        msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
-            msg += "\n"
-        
-        # FUORI USO
-        if fuori_uso:
-            msg += f"⚫ **FUORI USO** ({len(fuori_uso)}):\n"
-            fuori_uso_organizzati = organizza_articoli_per_categoria(fuori_uso)
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = fuori_uso_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, stato in articoli_cat:
-                        locazione = " (Centrale)" if stato == 'fuori_uso_centrale' else ""
-                        msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
-        
-        msg += f"\n📊 **Totale articoli:** {len(articoli)}"
-        await update.message.reply_text(msg)
-
-    # SEGNA USATO - NUOVA VERSIONE CON SELEZIONE CATEGORIA
-    elif text == "🔴 Segna Usato":
-        # Prima mostra le categorie che hanno articoli disponibili
-        categorie_con_articoli = get_categorie_con_articoli('disponibile')
-        
-        if not categorie_con_articoli:
-            await update.message.reply_text("✅ Nessun articolo da segnare come usato")
-            return
-
-        keyboard = []
-        for categoria in categorie_con_articoli:
-            if categoria in CATEGORIE:
-                keyboard.append([InlineKeyboardButton(CATEGORIE[categoria], callback_data=f"usato_cat_{categoria}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("🔴 Seleziona categoria per segnare como USATO:", reply_markup=reply_markup)
-
+    msg = "📋 **INVENTARIO COMPLETO**\n\n"
+    
+    # ORGANIZZA PER STATO E CATEGORIA
+    disponibili = [a for a in articoli if a[3] == 'disponibile']
+    usati = [a for a in articoli if a[3] in ['usato', 'usato_centrale']]
+    fuori_uso = [a for a in articoli if a[3] in ['fuori_uso', 'fuori_uso_centrale']]
+    
     # DISPONIBILI
-    elif text == "🟢 Disponibili":
-        articoli = get_articoli_per_stato('disponibile')
-        if not articoli:
-            await update.message.reply_text("🟢 Nessun articolo disponibile")
-            return
-        
-        msg = f"🟢 **ARTICOLI DISPONIBILI** ({len(articoli)})\n\n"
-        articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'disponibile') for a in articoli])
+    if disponibili:
+        msg += f"🟢 **DISPONIBILI** ({len(disponibili)}):\n"
+        disponibili_organizzati = organizza_articoli_per_categoria(disponibili)
         
         for categoria in ORDINE_CATEGORIE:
-            articoli_cat = articoli_organizzati[categoria]
+            articoli_cat = disponibili_organizzati[categoria]
             if articoli_cat:
-                msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
                 for seriale, sede, _ in articoli_cat:
                     msg += f"• {seriale} - {SEDI[sede]}\n"
-                msg += "\n"
-        
-        await update.message.reply_text(msg)
-
+        msg += "\n"
+    
     # USATI
-    elif text == "🔴 Usati":
-        articoli = get_articoli_per_stato('usato')
-        if not articoli:
-            await update.message.reply_text("🔴 Nessun articolo usato")
-            return
-        
-        msg = f"🔴 **ARTICOLI USATI** ({len(articoli)})\n\n"
-        articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'usato') for a in articoli])
+    if usati:
+        msg += f"🔴 **USATI** ({len(usati)}):\n"
+        usati_organizzati = organizza_articoli_per_categoria(usati)
         
         for categoria in ORDINE_CATEGORIE:
-            articoli_cat = articoli_organizzati[categoria]
+            articoli_cat = usati_organizzati[categoria]
             if articoli_cat:
-                msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                for seriale, sede, _ in articoli_cat:
-                    locazione = " (Centrale)" if any(a[0] == seriale and a[3] == 'usato_centrale' for a in get_tutti_articoli()) else ""
+                msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                for seriale, sede, stato in articoli_cat:
+                    locazione = " (Centrale)" if stato == 'usato_centrale' else ""
                     msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
-                msg += "\n"
+        msg += "\n"
+    
+    # FUORI USO
+    if fuori_uso:
+        msg += f"⚫ **FUORI USO** ({len(fuori_uso)}):\n"
+        fuori_uso_organizzati = organizza_articoli_per_categoria(fuori_uso)
         
-        await update.message.reply_text(msg)
-
-    # FUORI USO - CORRETTO: PER CREARE FUORI USO
-    elif text == "⚫ Fuori Uso":
-        # Per utenti normali: solo visualizzazione
-        if not is_admin(user_id):
-            articoli_fuori_uso = get_articoli_per_stato('fuori_uso')
-            if not articoli_fuori_uso:
-                await update.message.reply_text("⚫ Nessun articolo fuori uso")
-                return
-            
-            msg = f"⚫ **ARTICOLI FUORI USO** ({len(articoli_fuori_uso)})\n\n"
-            articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'fuori_uso') for a in articoli_fuori_uso])
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = articoli_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, _ in articoli_cat:
-                        locazione = " (Centrale)" if any(a[0] == seriale and a[3] == 'fuori_uso_centrale' for a in get_tutti_articoli()) else ""
-                        msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
-                    msg += "\n"
-            
-            msg += "ℹ️ Solo gli amministratori possono modificare lo stato."
-            await update.message.reply_text(msg)
-            return
+        for categoria in ORDINE_CATEGORIE:
+            articoli_cat = fuori_uso_organizzati[categoria]
+            if articoli_cat:
+                msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                for seriale, sede, stato in articoli_cat:
+                    locazione = " (Centrale)" if stato == 'fuori_uso_centrale' else ""
+                    msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
+    
+    msg += f"\n📊 **Totale articoli:** {len(articoli)}"
+    await update.message.reply_text(msg)
+
+# SEGNA USATO - NUOVA VERSIONE CON SELEZIONE CATEGORIA
+async def menu_segna_usato(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mostra le categorie con articoli disponibili da segnare come usati"""
+    # Prima mostra le categorie che hanno articoli disponibili
+    categorie_con_articoli = get_categorie_con_articoli('disponibile')
+    
+    if not categorie_con_articoli:
+        await update.message.reply_text("✅ Nessun articolo da segnare come usato")
+        return
 
-        # Per admin: CREARE FUORI USO - prima mostra categorie con articoli disponibili/usati
-        categorie_con_articoli = get_categorie_con_articoli('disponibile') + get_categorie_con_articoli('usato')
-        categorie_con_articoli = list(set(categorie_con_articoli))  # Rimuovi duplicati
-        
-        if not categorie_con_articoli:
-            await update.message.reply_text("⚫ Nessun articolo da segnare como fuori uso")
-            return
+    keyboard = []
+    for categoria in categorie_con_articoli:
+        if categoria in CATEGORIE:
+            keyboard.append([InlineKeyboardButton(CATEGORIE[categoria], callback_data=cb("uc", categoria))])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text("🔴 Seleziona categoria per segnare como USATO:", reply_markup=reply_markup)
+
+# DISPONIBILI
+async def mostra_disponibili(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Elenco articoli disponibili"""
+    articoli = get_articoli_per_stato('disponibile')
+    if not articoli:
+        await update.message.reply_text("🟢 Nessun articolo disponibile")
+        return
+    
+    msg = f"🟢 **ARTICOLI DISPONIBILI** ({len(articoli)})\n\n"
+    articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'disponibile') for a in articoli])
+    
+    for categoria in ORDINE_CATEGORIE:
+        articoli_cat = articoli_organizzati[categoria]
+        if articoli_cat:
+            msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+            for seriale, sede, _ in articoli_cat:
+                msg += f"• {seriale} - {SEDI[sede]}\n"
+            msg += "\n"
+    
+    await update.message.reply_text(msg)
+
+# USATI
+async def mostra_usati(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Elenco articoli usati"""
+    articoli = get_articoli_per_stato('usato')
+    if not articoli:
+        await update.message.reply_text("🔴 Nessun articolo usato")
+        return
+    
+    msg = f"🔴 **ARTICOLI USATI** ({len(articoli)})\n\n"
+    articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'usato') for a in articoli])
+    # Una sola query per sapere quali sono in centrale (prima: tutto l'inventario riletto per ogni riga)
+    in_centrale = {a[0] for a in get_articoli_per_stato('usato_centrale')}
+    
+    for categoria in ORDINE_CATEGORIE:
+        articoli_cat = articoli_organizzati[categoria]
+        if articoli_cat:
+            msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+            for seriale, sede, _ in articoli_cat:
+                locazione = " (Centrale)" if seriale in in_centrale else ""
+                msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
+            msg += "\n"
+    
+    await update.message.reply_text(msg)
 
-        keyboard = []
-        for categoria in categorie_con_articoli:
-            if categoria in CATEGORIE:
-                keyboard.append([InlineKeyboardButton(CATEGORIE[categoria], callback_data=f"crea_fuori_uso_cat_{categoria}")])
+# FUORI USO - CORRETTO: PER CREARE FUORI USO
+async def menu_fuori_uso(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Utenti: elenco fuori uso. Admin: selezione categoria per segnare fuori uso"""
+    user_id = update.effective_user.id
+    # Per utenti normali: solo visualizzazione
+    if not is_admin(user_id):
+        articoli_fuori_uso = get_articoli_per_stato('fuori_uso')
+        if not articoli_fuori_uso:
+            await update.message.reply_text("⚫ Nessun articolo fuori uso")
+            return
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("⚫ Seleziona categoria per SEGNARE como FUORI USO:", reply_markup=reply_markup)
-
-    # AGGIUNGI (solo admin)
-    elif text == "➕ Aggiungi" and is_admin(user_id):
-        context.user_data['azione'] = 'aggiungi_categoria'
-        keyboard = [
-            [InlineKeyboardButton(CATEGORIE[cat], callback_data=f"nuovo_cat_{cat}")] 
-            for cat in CATEGORIE
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("📦 Seleziona categoria:", reply_markup=reply_markup)
-
-    # RIMUOVI (solo admin)
-    elif text == "➖ Rimuovi" and is_admin(user_id):
-        context.user_data['azione'] = 'rimuovi_categoria'
-        keyboard = [
-            [InlineKeyboardButton(CATEGORIE[cat], callback_data=f"rimuovi_cat_{cat}")] 
-            for cat in CATEGORIE
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("➖ Seleziona categoria:", reply_markup=reply_markup)
+        msg = f"⚫ **ARTICOLI FUORI USO** ({len(articoli_fuori_uso)})\n\n"
+        articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], 'fuori_uso') for a in articoli_fuori_uso])
+        # Una sola query per sapere quali sono in centrale (come in mostra_usati)
+        in_centrale = {a[0] for a in get_articoli_per_stato('fuori_uso_centrale')}
+        
+        for categoria in ORDINE_CATEGORIE:
+            articoli_cat = articoli_organizzati[categoria]
+            if articoli_cat:
+                msg += f"**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                for seriale, sede, _ in articoli_cat:
+                    locazione = " (Centrale)" if seriale in in_centrale else ""
+                    msg += f"• {seriale} - {SEDI[sede]}{locazione}\n"
+                msg += "\n"
+        
+        msg += "ℹ️ Solo gli amministratori possono modificare lo stato."
+        await update.message.reply_text(msg)
+        return
 
-    # RIPRISTINA (solo admin)
-    elif text == "🔄 Ripristina" and is_admin(user_id):
-        articoli_usati = get_articoli_per_stato('usato')
-        articoli_fuori_uso = get_articoli_per_stato('fuori_uso')
-        articoli = articoli_usati + articoli_fuori_uso
+    # Per admin: CREARE FUORI USO - prima mostra categorie con articoli disponibili/usati
+    categorie_con_articoli = get_categorie_con_articoli('disponibile') + get_categorie_con_articoli('usato')
+    categorie_con_articoli = list(set(categorie_con_articoli))  # Rimuovi duplicati
+    
+    if not categorie_con_articoli:
+        await update.message.reply_text("⚫ Nessun articolo da segnare como fuori uso")
+        return
 
-        if not articoli:
-            await update.message.reply_text("✅ Nessun articolo da ripristinare")
-            return
+    keyboard = []
+    for categoria in categorie_con_articoli:
+        if categoria in CATEGORIE:
+            keyboard.append([InlineKeyboardButton(CATEGORIE[categoria], callback_data=cb("fc", categoria))])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text("⚫ Seleziona categoria per SEGNARE como FUORI USO:", reply_markup=reply_markup)
 
-        keyboard = []
-        for seriale, cat, sed in articoli:
-            stato_attuale = "usato" if (seriale, cat, sed) in articoli_usati else "fuori uso"
-            nome = f"{seriale} - {CATEGORIE[cat]} ({stato_attuale})"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"ripristina_{seriale}")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("🔄 Seleziona articolo da ripristinare:", reply_markup=reply_markup)
-
-    # STATISTICHE (solo admin) - NUOVA VERSIONE CON BOMBOLE COMBINATE
-    elif text == "📊 Statistiche" and is_admin(user_id):
-        articoli = get_tutti_articoli()
-        totale = len(articoli)
-        disponibili = len([a for a in articoli if a[3] == 'disponibile'])
-        usati = len([a for a in articoli if a[3] in ['usato', 'usato_centrale']])
-        fuori_uso = len([a for a in articoli if a[3] in ['fuori_uso', 'fuori_uso_centrale']])
-
-        # NUOVO: BOMBOLE COMBINATE (Erba + Centrale)
-        bombole_totali = conta_bombole_disponibili()
-
-        msg = "📊 **STATISTICHE COMPLETE**\n\n"
-        msg += f"📦 **Totale articoli:** {totale}\n"
-        msg += f"🟢 **Disponibili:** {disponibili}\n"
-        msg += f"🔴 **Usati:** {usati}\n"
-        msg += f"⚫ **Fuori uso:** {fuori_uso}\n\n"
-
-        msg += "⚗️ **BOMBOLE DISPONIBILI (TOTALE):**\n"
-        msg += f"🌿🏢 **Combinate (Erba + Centrale):** {bombole_totali}"
-        if bombole_totali <= SOGLIE_BOMBOLE["sotto_scorta"]:
-            msg += " 🚨 **SOTTO SCORTA!**"
-        elif bombole_totali <= SOGLIE_BOMBOLE["allarme_scorta"]:
-            msg += " 🟡 **ALLARME SCORTA!**"
-        elif bombole_totali <= SOGLIE_BOMBOLE["preallarme"]:
-            msg += " 🔶 **PREALLARME!**"
-        else:
-            msg += " ✅ **Ok**"
+# AGGIUNGI (solo admin)
+async def menu_aggiungi(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Avvia il wizard di aggiunta articolo"""
+    context.user_data['azione'] = 'aggiungi_categoria'
+    keyboard = [
+        [InlineKeyboardButton(CATEGORIE[cat], callback_data=cb("nc", cat))] 
+        for cat in CATEGORIE
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text("📦 Seleziona categoria:", reply_markup=reply_markup)
 
-        await update.message.reply_text(msg)
+# RIMUOVI (solo admin)
+async def menu_rimuovi(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Selezione categoria per la rimozione"""
+    context.user_data['azione'] = 'rimuovi_categoria'
+    keyboard = [
+        [InlineKeyboardButton(CATEGORIE[cat], callback_data=cb("rc", cat))] 
+        for cat in CATEGORIE
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text("➖ Seleziona categoria:", reply_markup=reply_markup)
+
+# RIPRISTINA (solo admin)
+async def menu_ripristina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Selezione articolo usato/fuori uso da ripristinare"""
+    articoli_usati = get_articoli_per_stato('usato')
+    articoli_fuori_uso = get_articoli_per_stato('fuori_uso')
+    articoli = articoli_usati + articoli_fuori_uso
+
+    if not articoli:
+        await update.message.reply_text("✅ Nessun articolo da ripristinare")
+        return
+
+    seriali_usati = {a[0] for a in articoli_usati}
+    etichetta = lambda a: f"{a[0]} - {CATEGORIE[a[1]]} ({'usato' if a[0] in seriali_usati else 'fuori uso'})"
+    reply_markup = tastiera_articoli(articoli, "rp", etichetta)
+    await update.message.reply_text("🔄 Seleziona articolo da ripristinare:", reply_markup=reply_markup)
+
+# STATISTICHE (solo admin) - NUOVA VERSIONE CON BOMBOLE COMBINATE
+async def mostra_statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Statistiche complete con soglie bombole"""
+    articoli = get_tutti_articoli()
+    totale = len(articoli)
+    disponibili = len([a for a in articoli if a[3] == 'disponibile'])
+    usati = len([a for a in articoli if a[3] in ['usato', 'usato_centrale']])
+    fuori_uso = len([a for a in articoli if a[3] in ['fuori_uso', 'fuori_uso_centrale']])
+
+    # NUOVO: BOMBOLE COMBINATE (Erba + Centrale)
+    bombole_totali = conta_bombole_disponibili()
+
+    msg = "📊 **STATISTICHE COMPLETE**\n\n"
+    msg += f"📦 **Totale articoli:** {totale}\n"
+    msg += f"🟢 **Disponibili:** {disponibili}\n"
+    msg += f"🔴 **Usati:** {usati}\n"
+    msg += f"⚫ **Fuori uso:** {fuori_uso}\n\n"
+
+    msg += "⚗️ **BOMBOLE DISPONIBILI (TOTALE):**\n"
+    msg += f"🌿🏢 **Combinate (Erba + Centrale):** {bombole_totali}"
+    if bombole_totali <= SOGLIE_BOMBOLE["sotto_scorta"]:
+        msg += " 🚨 **SOTTO SCORTA!**"
+    elif bombole_totali <= SOGLIE_BOMBOLE["allarme_scorta"]:
+        msg += " 🟡 **ALLARME SCORTA!**"
+    elif bombole_totali <= SOGLIE_BOMBOLE["preallarme"]:
+        msg += " 🔶 **PREALLARME!**"
+    else:
+        msg += " ✅ **Ok**"
 
-    # GESTIONE RICHIESTE (solo admin)
-    elif text == "👥 Gestisci Richieste" and is_admin(user_id):
-        await gestisci_richieste(update, context)
+    await update.message.reply_text(msg)
 
-    # NUOVO: CARICA INVENTARIO (solo admin)
-    elif text == "📤 Carica Inventario" and is_admin(user_id):
-        context.user_data['azione'] = 'carica_inventario'
+# NUOVO: CARICA INVENTARIO (solo admin)
+async def menu_carica_inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Chiede il testo dell'inventario per ricostruire il database"""
+    context.user_data['azione'] = 'carica_inventario'
+    await update.message.reply_text(
+        "📤 **CARICA INVENTARIO PER RICOSTRUIRE DATABASE**\n\n"
+        "Incolla il testo completo dell'inventario (come generato dal bot).\n\n"
+        "⚠️ **ATTENZIONE:** Questa operazione SOSTITUIRÀ completamente il database attuale!\n"
+        "✅ Assicurati che il testo sia esattamente come generato dal comando '📋 Inventario'.\n\n"
+        "Incolla ora il testo dell'inventario:"
+    )
+
+# IN CENTRALE - NUOVA FUNZIONALITÀ
+async def menu_centrale(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Menu gestione articoli in centrale"""
+    # Mostra il menu principale per la gestione centrale
+    keyboard = [
+        [InlineKeyboardButton("📤 Sposta Usati in Centrale", callback_data=cb("cu"))],
+        [InlineKeyboardButton("📤 Sposta Fuori Uso in Centrale", callback_data=cb("cf"))],
+        [InlineKeyboardButton("📋 Inventario Centrale", callback_data=cb("ci"))],
+        [InlineKeyboardButton("📥 Ripristina da Centrale", callback_data=cb("cr"))]
+    ]
+    
+    # Conta gli articoli in centrale per il riassunto
+    articoli_centrale = get_articoli_in_centrale()
+    usati_centrale = len([a for a in articoli_centrale if a[3] == 'usato_centrale'])
+    fuori_uso_centrale = len([a for a in articoli_centrale if a[3] == 'fuori_uso_centrale'])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    messaggio = f"🏢 **GESTIONE ARTICOLI IN CENTRALE**\n\n"
+    messaggio += f"📊 **Attualmente in centrale:**\n"
+    messaggio += f"• 🔴 Usati: {usati_centrale}\n"
+    messaggio += f"• ⚫ Fuori uso: {fuori_uso_centrale}\n"
+    messaggio += f"• 📦 Totale: {len(articoli_centrale)}\n\n"
+    messaggio += "Seleziona un'operazione:"
+    
+    await update.message.reply_text(messaggio, reply_markup=reply_markup)
+
+# STATUS SERVER (SOLO PER ADMIN SPECIFICO)
+async def mostra_status_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stato del server, consumo stimato e job pianificati"""
+    # Mostra lo stato del server e il consumo estimato
+    usage_info = get_render_usage_simple()
+    system_info = get_system_metrics()
+    integrity_info = get_integrity_status()
+    keepalive_info = get_keepalive_status()
+    jobs_info = scheduler.riepilogo()
+    modifiche_info = (f"✏️ **MODIFICHE MESSAGGI:** inviate {vista_messaggi.inviate}, "
+                      f"saltate {vista_messaggi.saltate}, accorpate {vista_messaggi.accorpate}")
+    
+    status_msg = (f"{usage_info}\n\n{system_info}\n{integrity_info}\n{keepalive_info}\n{jobs_info}\n"
+                  f"{modifiche_info}\n{persistenza.riepilogo()}")
+    await update.message.reply_text(status_msg)
+
+# INSERIMENTO NUMERO
+async def stato_inserisci_numero(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Wizard aggiunta: riceve le 3 cifre del seriale"""
+    text = update.message.text.strip()
+    numero = text.strip()
+    categoria = context.user_data['categoria_da_aggiungere']
+    sede = context.user_data['sede_da_aggiungere']
+    
+    # NUOVA VERIFICA: deve avere esattamente 3 cifre
+    if not numero.isdigit() or len(numero) != 3:
         await update.message.reply_text(
-            "📤 **CARICA INVENTARIO PER RICOSTRUIRE DATABASE**\n\n"
-            "Incolla il testo completo dell'inventario (come generato dal bot).\n\n"
-            "⚠️ **ATTENZIONE:** Questa operazione SOSTITUIRÀ completamente il database attuale!\n"
-            "✅ Assicurati che il testo sia esattamente come generato dal comando '📋 Inventario'.\n\n"
-            "Incolla ora il testo dell'inventario:"
+            "❌ Formato numero non valido!\n"
+            "Inserisci esattamente 3 cifre (es. 001, 123, 999)\n\n"
+            "Riprova:"
         )
+        return
+    
+    prefisso = get_prefisso_categoria(categoria)
+    seriale = f"{prefisso}_{numero}_{sede.upper()}"
+    
+    if insert_articolo(seriale, categoria, sede):
+        await update.message.reply_text(
+            f"✅ ARTICOLO AGGIUNTO!\n\nSeriale: {seriale}\nCategoria: {CATEGORIE[categoria]}\nSede: {SEDI[sede]}"
+        )
+        
+        if categoria == 'bombola':
+            await controlla_allarme_bombole(context)
+    else:
+        await update.message.reply_text(f"❌ {seriale} già esistente!")
+    
+    for key in ['azione', 'categoria_da_aggiungere', 'sede_da_aggiungere']:
+        if key in context.user_data:
+            del context.user_data[key]
+
+# NUOVO: GESTIONE CARICA INVENTARIO
+async def stato_carica_inventario(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Riceve il testo dell'inventario e chiede conferma"""
+    text = update.message.text.strip()
+    testo_inventario = text.strip()
+    
+    # Conferma prima di procedere
+    context.user_data['inventario_da_caricare'] = testo_inventario
+    context.user_data['azione'] = 'conferma_carica_inventario'
+    
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ CONFERMA Ricostruzione", callback_data=cb("ok")),
+            InlineKeyboardButton("❌ ANNULLA", callback_data=cb("no"))
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(
+        "⚠️ **CONFERMA RICOSTRUZIONE DATABASE**\n\n"
+        "Sei sicuro di voler RICOSTRUIRE il database dall'inventario?\n\n"
+        "❌ **TUTTI GLI ARTICOLI ATTUALE SARANNO ELIMINATI!**\n"
+        "✅ Verranno ricreati basandosi sul testo dell'inventario.\n\n"
+        "Questa operazione è IRREVERSIBILE!",
+        reply_markup=reply_markup
+    )
+
+# === ROUTER MESSAGGI ===
+# Tabella testo pulsante -> handler e tabella stato wizard (context.user_data['azione']) -> handler.
+# Ogni route dichiara il ruolo minimo: il controllo avviene una sola volta nel middleware di handle_message.
+LIVELLO_RUOLO = {'user': 1, 'admin': 2}
+
+ROUTE_PULSANTI = {}   # testo -> (handler, ruolo_minimo, utenti_ammessi)
+ROUTE_STATI = {}      # azione -> (handler, ruolo_minimo, utenti_ammessi)
+
+def _registra_route(tabella, chiave, handler, ruolo, utenti):
+    if chiave in tabella:
+        raise ValueError(f"Route già registrata: {chiave}")
+    tabella[chiave] = (handler, ruolo, frozenset(utenti) if utenti else None)
+
+def registra_pulsante(testo, handler, ruolo='user', utenti=None):
+    _registra_route(ROUTE_PULSANTI, testo, handler, ruolo, utenti)
+
+def registra_stato(azione, handler, ruolo='user', utenti=None):
+    _registra_route(ROUTE_STATI, azione, handler, ruolo, utenti)
+
+def route_autorizzata(route, user_id, ruolo_utente):
+    """Middleware di autorizzazione: ruolo minimo ed eventuale lista di utenti ammessi"""
+    _, ruolo_minimo, utenti = route
+    if LIVELLO_RUOLO.get(ruolo_utente, 0) < LIVELLO_RUOLO[ruolo_minimo]:
+        return False
+    return utenti is None or user_id in utenti
+
+registra_pulsante("📋 Inventario", mostra_inventario)
+registra_pulsante("🔴 Segna Usato", menu_segna_usato)
+registra_pulsante("🟢 Disponibili", mostra_disponibili)
+registra_pulsante("🔴 Usati", mostra_usati)
+registra_pulsante("⚫ Fuori Uso", menu_fuori_uso)
+registra_pulsante("📍 In Centrale", menu_centrale)
+registra_pulsante("🆘 Help", help_command)
+registra_pulsante("➕ Aggiungi", menu_aggiungi, ruolo='admin')
+registra_pulsante("➖ Rimuovi", menu_rimuovi, ruolo='admin')
+registra_pulsante("🔄 Ripristina", menu_ripristina, ruolo='admin')
+registra_pulsante("📊 Statistiche", mostra_statistiche, ruolo='admin')
+registra_pulsante("👥 Gestisci Richieste", gestisci_richieste, ruolo='admin')
+registra_pulsante("📤 Carica Inventario", menu_carica_inventario, ruolo='admin')
+registra_pulsante("🖥️ Status Server", mostra_status_server, ruolo='admin', utenti=[STATUS_SERVER_ADMIN_ID])
+
+registra_stato('inserisci_numero', stato_inserisci_numero, ruolo='admin')
+registra_stato('carica_inventario', stato_carica_inventario, ruolo='admin')
+
+# === HANDLER MESSAGGI PRINCIPALE ===
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    text = update.message.text.strip()
+    ruolo = get_ruolo(user_id)
+
+    if ruolo not in LIVELLO_RUOLO:
+        if text == "🚀 Richiedi Accesso":
+            await start(update, context)
+        return
 
-    # HELP
-    elif text == "🆘 Help":
-        await help_command(update, context)
+    # 1) pulsanti della tastiera: lookup diretto sul testo
+    route = ROUTE_PULSANTI.get(text)
+    # 2) altrimenti, se c'è un wizard in corso, lo stato decide chi gestisce il testo libero
+    if route is None and 'azione' in context.user_data:
+        route = ROUTE_STATI.get(context.user_data['azione'])
+
+    if route is not None and route_autorizzata(route, user_id, ruolo):
+        with HANDLER_DURATA.misura(tipo="messaggio", route=route[0].__name__):
+            await route[0](update, context)
+    else:
+        await update.message.reply_text("ℹ️ Usa i pulsanti per navigare.", reply_markup=tastiera_se_cambiata(user_id))
+
+# === VISTA MESSAGGI (edit-diffing) ===
+class VistaMessaggi:
+    """
+    Strato sottile sopra edit_message_text:
+    - ricorda l'impronta (testo + tastiera) dell'ultimo contenuto mostrato per (chat, messaggio)
+      e salta le modifiche identiche, che Telegram rifiuterebbe con "message is not modified"
+    - se arrivano più modifiche allo stesso messaggio entro `finestra` secondi dalla precedente,
+      le accorpa e invia solo l'ultima alla chiusura della finestra
+    Le modifiche accorpate partono in task tenuti in self._task: gli errori vengono loggati
+    e all'arresto svuota() invia subito quelle ancora in attesa.
+    """
 
-    # IN CENTRALE - NUOVA FUNZIONALITÀ
-    elif text == "📍 In Centrale":
-        if not is_user_approved(user_id):
-            await update.message.reply_text("❌ Accesso non autorizzato")
+    def __init__(self, finestra=0.3, capacita=2048):
+        self.finestra = finestra
+        self.capacita = capacita
+        self._impronte = OrderedDict()  # (chat, messaggio) -> impronta ultimo contenuto
+        self._finestre = {}             # (chat, messaggio) -> modifica in attesa (o None)
+        self._timer = {}                # (chat, messaggio) -> chiusura programmata della finestra
+        self._task = set()              # invii delle modifiche accorpate non ancora conclusi
+        self.inviate = 0
+        self.saltate = 0
+        self.accorpate = 0
+
+    @staticmethod
+    def _chiave(query):
+        if query.message is not None:
+            return (query.message.chat_id, query.message.message_id)
+        return (query.inline_message_id, None)
+
+    @staticmethod
+    def _impronta(testo, reply_markup):
+        markup = json.dumps(reply_markup.to_dict(), sort_keys=True) if reply_markup else ""
+        return hashlib.blake2b(f"{testo}\x00{markup}".encode('utf-8'), digest_size=16).digest()
+
+    def _ricorda(self, chiave, impronta):
+        self._impronte[chiave] = impronta
+        self._impronte.move_to_end(chiave)
+        while len(self._impronte) > self.capacita:
+            self._impronte.popitem(last=False)
+
+    async def modifica(self, query, testo, reply_markup=None):
+        chiave = self._chiave(query)
+        impronta = self._impronta(testo, reply_markup)
+
+        if chiave in self._finestre:
+            # Finestra aperta: vince l'ultimo contenuto, inviato alla chiusura
+            if self._finestre[chiave] is not None:
+                self.accorpate += 1
+            self._finestre[chiave] = (query, testo, reply_markup)
             return
 
-        # Mostra il menu principale per la gestione centrale
-        keyboard = [
-            [InlineKeyboardButton("📤 Sposta Usati in Centrale", callback_data="centrale_sposta_usati")],
-            [InlineKeyboardButton("📤 Sposta Fuori Uso in Centrale", callback_data="centrale_sposta_fuori_uso")],
-            [InlineKeyboardButton("📋 Inventario Centrale", callback_data="centrale_inventario")],
-            [InlineKeyboardButton("📥 Ripristina da Centrale", callback_data="centrale_ripristina")]
-        ]
-        
-        # Conta gli articoli in centrale per il riassunto
-        articoli_centrale = get_articoli_in_centrale()
-        usati_centrale = len([a for a in articoli_centrale if a[3] == 'usato_centrale'])
-        fuori_uso_centrale = len([a for a in articoli_centrale if a[3] == 'fuori_uso_centrale'])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        messaggio = f"🏢 **GESTIONE ARTICOLI IN CENTRALE**\n\n"
-        messaggio += f"📊 **Attualmente in centrale:**\n"
-        messaggio += f"• 🔴 Usati: {usati_centrale}\n"
-        messaggio += f"• ⚫ Fuori uso: {fuori_uso_centrale}\n"
-        messaggio += f"• 📦 Totale: {len(articoli_centrale)}\n\n"
-        messaggio += "Seleziona un'operazione:"
-        
-        await update.message.reply_text(messaggio, reply_markup=reply_markup)
+        if self._impronte.get(chiave) == impronta:
+            self.saltate += 1
+            return
 
-    # STATUS SERVER (SOLO PER ADMIN SPECIFICO)
-    elif text == "🖥️ Status Server" and user_id == 1816045269:
-        # Mostra lo stato del server e il consumo estimato
-        usage_info = get_render_usage_simple()
-        system_info = get_system_metrics()
-        
-        status_msg = f"{usage_info}\n\n{system_info}"
-        await update.message.reply_text(status_msg)
-
-    # INSERIMENTO NUMERO
-    elif context.user_data.get('azione') == 'inserisci_numero':
-        numero = text.strip()
-        categoria = context.user_data['categoria_da_aggiungere']
-        sede = context.user_data['sede_da_aggiungere']
-        
-        # NUOVA VERIFICA: deve avere esattamente 3 cifre
-        if not numero.isdigit() or len(numero) != 3:
-            await update.message.reply_text(
-                "❌ Formato numero non valido!\n"
-                "Inserisci esattamente 3 cifre (es. 001, 123, 999)\n\n"
-                "Riprova:"
-            )
+        self._finestre[chiave] = None
+        try:
+            await query.edit_message_text(testo, reply_markup=reply_markup)
+            self.inviate += 1
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                del self._finestre[chiave]
+                raise
+            self.saltate += 1
+        self._ricorda(chiave, impronta)
+        self._timer[chiave] = asyncio.get_running_loop().call_later(self.finestra, self._chiudi_finestra, chiave)
+
+    def _chiudi_finestra(self, chiave):
+        self._timer.pop(chiave, None)
+        in_attesa = self._finestre.pop(chiave, None)
+        if in_attesa is not None:
+            task = asyncio.get_running_loop().create_task(self.modifica(*in_attesa))
+            self._task.add(task)
+            task.add_done_callback(self._fine_invio)
+
+    def _fine_invio(self, task):
+        self._task.discard(task)
+        if task.cancelled():
             return
+        errore = task.exception()
+        if isinstance(errore, TelegramError):
+            logger.warning("❌ Modifica messaggio accorpata fallita: %s", errore)
+        elif errore is not None:
+            logger.error("❌ Modifica messaggio accorpata fallita", exc_info=errore)
+
+    async def svuota(self, timeout=10):
+        """All'arresto: chiude subito le finestre aperte, invia le modifiche in attesa e le aspetta"""
+        for chiave, timer in list(self._timer.items()):
+            timer.cancel()
+            self._chiudi_finestra(chiave)
+        if self._task:
+            _, pendenti = await asyncio.wait(set(self._task), timeout=timeout)
+            for task in pendenti:
+                task.cancel()
+        # Le modifiche appena inviate hanno riaperto una finestra: non serve più
+        for timer in self._timer.values():
+            timer.cancel()
+        self._timer.clear()
+        self._finestre.clear()
+
+vista_messaggi = VistaMessaggi()
+
+# === CALLBACK ROUTER ===
+# callback_data compatto: "<codice>" oppure "<codice>:<valore>".
+# I codici sono dichiarati una volta sola e non possono essere uno prefisso dell'altro: la risoluzione
+# percorre un trie carattere per carattere (costo = lunghezza del codice) e non dipende dall'ordine.
+# Gli articoli sono referenziati dal loro id intero in base 36, mai dal seriale: resta ben sotto i 64 byte.
+CALLBACK_MAX_BYTES = 64
+_ALFABETO_36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def base36(numero):
+    if numero < 0:
+        return "-" + base36(-numero)
+    cifre = ""
+    while True:
+        numero, resto = divmod(numero, 36)
+        cifre = _ALFABETO_36[resto] + cifre
+        if numero == 0:
+            return cifre
+
+def _valida_articolo(valore):
+    articolo = get_articolo_by_id(int(valore, 36))
+    if articolo is None:
+        raise LookupError("articolo non più presente")
+    return articolo
+
+def _valida_chiave(dizionario):
+    def valida(valore):
+        if valore not in dizionario:
+            raise ValueError(f"valore non ammesso: {valore}")
+        return valore
+    return valida
+
+# Tipi di argomento ammessi: come codificarli nel pulsante e come validarli prima dell'handler
+TIPI_ARGOMENTO = {
+    "articolo": (lambda articolo_id: base36(articolo_id), _valida_articolo),
+    "intero": (lambda numero: base36(numero), lambda valore: int(valore, 36)),
+    "categoria": (str, _valida_chiave(CATEGORIE)),
+    "sede": (str, _valida_chiave(SEDI)),
+}
+
+_trie_callback = {}     # carattere -> sotto-nodo; la chiave None contiene la route
+ROUTE_CALLBACK = {}     # codice -> (handler, tipo_argomento, ruolo_minimo, idempotente)
+
+def registra_callback(codice, handler, argomento=None, ruolo='user', idempotente=False):
+    """
+    Dichiara una route: il codice non deve sovrapporsi (come prefisso) a nessun codice esistente.
+    idempotente=True per le azioni che modificano dati: un secondo tap sullo stesso pulsante
+    riceve la risposta memorizzata invece di rieseguire l'azione.
+    """
+    if ':' in codice or not codice:
+        raise ValueError(f"Codice callback non valido: {codice!r}")
+    for esistente in ROUTE_CALLBACK:
+        if esistente.startswith(codice) or codice.startswith(esistente):
+            raise ValueError(f"Codice callback {codice!r} si sovrappone a {esistente!r}")
+    if argomento is not None and argomento not in TIPI_ARGOMENTO:
+        raise ValueError(f"Tipo argomento sconosciuto: {argomento}")
+
+    nodo = _trie_callback
+    for carattere in codice:
+        nodo = nodo.setdefault(carattere, {})
+    nodo[None] = codice
+    ROUTE_CALLBACK[codice] = (handler, argomento, ruolo, idempotente)
+
+def cb(codice, valore=None):
+    """Costruisce il callback_data per una route registrata"""
+    argomento = ROUTE_CALLBACK[codice][1]
+    if argomento is None:
+        data = codice
+    else:
+        data = f"{codice}:{TIPI_ARGOMENTO[argomento][0](valore)}"
+    if len(data.encode('utf-8')) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"callback_data oltre {CALLBACK_MAX_BYTES} byte: {data}")
+    return data
+
+class CacheTTL:
+    """LRU con scadenza: al massimo `capacita` voci, ognuna valida per `ttl` secondi"""
+
+    def __init__(self, capacita, ttl):
+        self.capacita = capacita
+        self.ttl = ttl
+        self._voci = OrderedDict()  # chiave -> (scadenza, valore)
+
+    def get(self, chiave):
+        voce = self._voci.get(chiave)
+        if voce is None:
+            return None
+        if voce[0] < time.monotonic():
+            del self._voci[chiave]
+            return None
+        self._voci.move_to_end(chiave)
+        return voce[1]
+
+    def set(self, chiave, valore):
+        self._voci[chiave] = (time.monotonic() + self.ttl, valore)
+        self._voci.move_to_end(chiave)
+        while len(self._voci) > self.capacita:
+            self._voci.popitem(last=False)
+
+# Risposte delle azioni già eseguite, per (chat, messaggio, callback_data)
+risposte_callback = CacheTTL(capacita=1024, ttl=120)
+
+def chiave_callback(query):
+    if query.message is not None:
+        return (query.message.chat_id, query.message.message_id, query.data)
+    return (query.inline_message_id, None, query.data)
+
+def risolvi_callback(data):
+    """Percorre il trie fino a ':' o fine stringa. Restituisce (codice, valore_grezzo) o None"""
+    nodo = _trie_callback
+    for posizione, carattere in enumerate(data):
+        if carattere == ':':
+            codice = nodo.get(None)
+            return (codice, data[posizione + 1:]) if codice else None
+        nodo = nodo.get(carattere)
+        if nodo is None:
+            return None
+    codice = nodo.get(None)
+    return (codice, None) if codice else None
+
+# === HANDLER PULSANTI INLINE ===
+def tastiera_articoli(articoli, codice, etichetta):
+    """Una riga per articolo con callback compatto per id; articoli = righe (seriale, ...)"""
+    ids = get_id_articoli([a[0] for a in articoli])
+    keyboard = []
+    for articolo in articoli:
+        if articolo[0] in ids:
+            keyboard.append([InlineKeyboardButton(etichetta(articolo), callback_data=cb(codice, ids[articolo[0]]))])
+    return InlineKeyboardMarkup(keyboard)
+
+# SEGNA USATO - SELEZIONE CATEGORIA
+async def cb_usato_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    query = update.callback_query
+    articoli = get_articoli_per_stato('disponibile')
+    articoli_categoria = [a for a in articoli if a[1] == categoria]
+    
+    if not articoli_categoria:
+        await vista_messaggi.modifica(query, f"❌ Nessun articolo disponibile per {CATEGORIE[categoria]}")
+        return
+
+    reply_markup = tastiera_articoli(articoli_categoria, "us", lambda a: f"{a[0]} - {SEDI[a[2]]}")
+    await vista_messaggi.modifica(query, f"🔴 Seleziona {CATEGORIE[categoria]} da segnare como USATO:", reply_markup=reply_markup)
+
+# SEGNA USATO - CONFERMA
+async def cb_usato(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    if update_stato(seriale, "usato", ("disponibile",), update.effective_user.id):
+        testo = f"🔴 {seriale} segnato como USATO ✅"
+    else:
+        testo = descrivi_conflitto(seriale)
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# CREA FUORI USO - SELEZIONE CATEGORIA (PER ADMIN)
+async def cb_fuori_uso_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    query = update.callback_query
+    articoli_disponibili = get_articoli_per_stato('disponibile')
+    articoli_usati = get_articoli_per_stato('usato')
+    articoli_categoria = [a for a in articoli_disponibili + articoli_usati if a[1] == categoria]
+    
+    if not articoli_categoria:
+        await vista_messaggi.modifica(query, f"❌ Nessun articolo per {CATEGORIE[categoria]}")
+        return
+
+    reply_markup = tastiera_articoli(articoli_categoria, "fu", lambda a: f"{a[0]} - {SEDI[a[2]]}")
+    await vista_messaggi.modifica(query, f"⚫ Seleziona {CATEGORIE[categoria]} da segnare como FUORI USO:", reply_markup=reply_markup)
+
+# SEGNA FUORI USO - CONFERMA
+async def cb_fuori_uso(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    if update_stato(seriale, "fuori_uso", ("disponibile", "usato"), update.effective_user.id):
+        testo = f"⚫ {seriale} segnato como FUORI USO ✅"
+    else:
+        testo = descrivi_conflitto(seriale)
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# RIPRISTINA
+async def cb_ripristina(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    stati_ripristinabili = ("usato", "usato_centrale", "fuori_uso", "fuori_uso_centrale")
+    if update_stato(seriale, "disponibile", stati_ripristinabili, update.effective_user.id):
+        testo = f"🔄 {seriale} ripristinato a DISPONIBILE ✅"
+    else:
+        testo = descrivi_conflitto(seriale)
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# APPROVA UTENTE (UNO ALLA VOLTA)
+async def cb_approva(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_approvare):
+    if not approva_utente(user_id_approvare):
+        # Già approvato (o rifiutato) da un altro admin: nessun secondo messaggio all'utente
+        testo = f"ℹ️ Richiesta di {user_id_approvare} già gestita."
+        await vista_messaggi.modifica(update.callback_query, testo)
+        return testo
+    
+    try:
+        await context.bot.send_message(
+            user_id_approvare,
+            "✅ ACCESSO APPROVATO! Ora puoi usare tutte le funzioni del bot.\nUsa /start per iniziare.",
+            # Il ruolo è cambiato: la nuova tastiera arriva subito con questo messaggio
+            reply_markup=crea_tastiera_fisica(user_id_approvare)
+        )
+    except:
+        pass
         
-        prefisso = get_prefisso_categoria(categoria)
-        seriale = f"{prefisso}_{numero}_{sede.upper()}"
-        
-        if insert_articolo(seriale, categoria, sede):
-            await update.message.reply_text(
-                f"✅ ARTICOLO AGGIUNTO!\n\nSeriale: {seriale}\nCategoria: {CATEGORIE[categoria]}\nSede: {SEDI[sede]}"
-            )
-            
-            if categoria == 'bombola':
-                await controlla_allarme_bombole(context)
-        else:
-            await update.message.reply_text(f"❌ {seriale} già esistente!")
+    # Dopo l'approvazione, mostra se ci sono altre richieste
+    richieste_rimanenti = get_richieste_in_attesa()
+    if richieste_rimanenti:
+        messaggio_aggiuntivo = f"\n\n📋 Ci sono ancora {len(richieste_rimanenti)} richieste in attesa.\nUsa nuovamente '👥 Gestisci Richieste' per continuare."
+    else:
+        messaggio_aggiuntivo = "\n\n✅ Tutte le richieste sono state gestite."
+        
+    testo = f"✅ Utente {user_id_approvare} approvato!{messaggio_aggiuntivo}"
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# RIFIUTA UTENTE (UNO ALLA VOLTA)
+async def cb_rifiuta(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id_rifiutare):
+    if not rifiuta_utente(user_id_rifiutare):
+        # Già approvato (o rifiutato) da un altro admin
+        testo = f"ℹ️ Richiesta di {user_id_rifiutare} già gestita."
+        await vista_messaggi.modifica(update.callback_query, testo)
+        return testo
+    
+    # Dopo il rifiuto, mostra se ci sono altre richieste
+    richieste_rimanenti = get_richieste_in_attesa()
+    if richieste_rimanenti:
+        messaggio_aggiuntivo = f"\n\n📋 Ci sono ancora {len(richieste_rimanenti)} richieste in attesa.\nUsa nuovamente '👥 Gestisci Richieste' para continuare."
+    else:
+        messaggio_aggiuntivo = "\n\n✅ Tutte le richieste sono stata gestite."
         
-        for key in ['azione', 'categoria_da_aggiungere', 'sede_da_aggiungere']:
-            if key in context.user_data:
-                del context.user_data[key]
+    testo = f"❌ Utente {user_id_rifiutare} rifiutato!{messaggio_aggiuntivo}"
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
 
-    # NUOVO: GESTIONE CARICA INVENTARIO
-    elif context.user_data.get('azione') == 'carica_inventario':
-        if not is_admin(user_id):
-            return
-            
-        testo_inventario = text.strip()
-        
-        # Conferma prima di procedere
-        context.user_data['inventario_da_caricare'] = testo_inventario
-        context.user_data['azione'] = 'conferma_carica_inventario'
+# SELEZIONE CATEGORIA PER AGGIUNTA
+async def cb_nuovo_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    context.user_data['nuova_categoria'] = categoria
+    context.user_data['azione'] = 'aggiungi_sede'
+    
+    keyboard = [
+        [InlineKeyboardButton(SEDI[sede], callback_data=cb("ns", sede))] 
+        for sede in SEDI
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await vista_messaggi.modifica(update.callback_query, f"🏢 Seleziona sede per {CATEGORIE[categoria]}:", reply_markup=reply_markup)
+
+# SELEZIONE SEDE PER AGGIUNTA
+async def cb_nuovo_sede(update: Update, context: ContextTypes.DEFAULT_TYPE, sede):
+    categoria = context.user_data.get('nuova_categoria')
+    if categoria is None:
+        await vista_messaggi.modifica(update.callback_query, "❌ Procedura scaduta, usa di nuovo ➕ Aggiungi")
+        return
+    
+    context.user_data['azione'] = 'inserisci_numero'
+    context.user_data['categoria_da_aggiungere'] = categoria
+    context.user_data['sede_da_aggiungere'] = sede
+    
+    prefisso = get_prefisso_categoria(categoria)
+    await vista_messaggi.modifica(
+        update.callback_query,
+        f"📝 Inserisci NUMERO per {CATEGORIE[categoria]} - {SEDI[sede]}:\n\n"
+        f"Prefisso: {prefisso}\n"
+        f"📌 Formato richiesto: **3 cifre** (es. 001, 123, 999)\n\n"
+        f"Inserisci le 3 cifre:"
+    )
+
+# RIMOZIONE ARTICOLO - SELEZIONE CATEGORIA
+async def cb_rimuovi_categoria(update: Update, context: ContextTypes.DEFAULT_TYPE, categoria):
+    query = update.callback_query
+    articoli = get_articoli_per_stato('disponibile') + get_articoli_per_stato('usato') + get_articoli_per_stato('fuori_uso')
+    articoli_categoria = [a for a in articoli if a[1] == categoria]
+    
+    if not articoli_categoria:
+        await vista_messaggi.modifica(query, f"❌ Nessun articolo per {CATEGORIE[categoria]}")
+        return
+    
+    reply_markup = tastiera_articoli(articoli_categoria, "el", lambda a: f"{a[0]} - {SEDI[a[2]]}")
+    await vista_messaggi.modifica(query, f"➖ Seleziona articolo da ELIMINARE:", reply_markup=reply_markup)
+
+# RIMOZIONE ARTICOLO - CONFERMA ELIMINAZIONE
+async def cb_elimina(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    if delete_articolo(seriale):
+        testo = f"✅ {seriale} rimosso dall'inventario!"
+    else:
+        testo = f"❌ {seriale} già rimosso!"
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# GESTIONE CENTRALE - MENU PRINCIPALE
+async def cb_centrale_sposta_usati(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    query = update.callback_query
+    # Esclude quelli già in centrale
+    articoli_usati = get_articoli_per_stato_centrale('usato', escludi_centrale=True)
+    if not articoli_usati:
+        await vista_messaggi.modifica(query, "❌ Nessun articolo usato da spostare in centrale (o tutti già in centrale)")
+        return
+
+    reply_markup = tastiera_articoli(articoli_usati, "cs", lambda a: f"{a[0]} - {SEDI[a[2]]}")
+    await vista_messaggi.modifica(query, "📤 Seleziona articolo USATO da spostare in CENTRALE:", reply_markup=reply_markup)
+
+async def cb_centrale_sposta_fuori_uso(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    query = update.callback_query
+    # Esclude quelli già in centrale
+    articoli_fuori_uso = get_articoli_per_stato_centrale('fuori_uso', escludi_centrale=True)
+    if not articoli_fuori_uso:
+        await vista_messaggi.modifica(query, "❌ Nessun articolo fuori uso da spostare in centrale (o tutti già in centrale)")
+        return
+
+    reply_markup = tastiera_articoli(articoli_fuori_uso, "cs", lambda a: f"{a[0]} - {SEDI[a[2]]}")
+    await vista_messaggi.modifica(query, "📤 Seleziona articolo FUORI USO da spostare in CENTRALE:", reply_markup=reply_markup)
+
+async def cb_centrale_sposta(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    if sposta_in_centrale(seriale, update.effective_user.id):
+        testo = f"✅ {seriale} spostato in CENTRALE!"
+    else:
+        testo = descrivi_conflitto(seriale)
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+async def cb_centrale_inventario(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    query = update.callback_query
+    articoli_centrale = get_articoli_in_centrale()
+    if not articoli_centrale:
+        await vista_messaggi.modifica(query, "🏢 **INVENTARIO CENTRALE**\n\n📦 Nessun articolo in centrale al momento")
+        return
+
+    msg = "🏢 **INVENTARIO CENTRALE**\n\n"
+    
+    # USATI IN CENTRALE
+    usati_centrale = [a for a in articoli_centrale if a[3] == 'usato_centrale']
+    if usati_centrale:
+        msg += f"🔴 **USATI IN CENTRALE** ({len(usati_centrale)}):\n"
+        usati_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], a[3]) for a in usati_centrale])
         
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ CONFERMA Ricostruzione", callback_data="conferma_ricostruzione"),
-                InlineKeyboardButton("❌ ANNULLA", callback_data="annulla_ricostruzione")
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        for categoria in ORDINE_CATEGORIE:
+            articoli_cat = usati_organizzati[categoria]
+            if articoli_cat:
+                msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                for seriale, sede, _ in articoli_cat:
+                    msg += f"• {seriale}\n"
+        msg += "\n"
+    
+    # FUORI USO IN CENTRALE
+    fuori_uso_centrale = [a for a in articoli_centrale if a[3] == 'fuori_uso_centrale']
+    if fuori_uso_centrale:
+        msg += f"⚫ **FUORI USO IN CENTRALE** ({len(fuori_uso_centrale)}):\n"
+        fuori_uso_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], a[3]) for a in fuori_uso_centrale])
         
-        await update.message.reply_text(
-            "⚠️ **CONFERMA RICOSTRUZIONE DATABASE**\n\n"
-            "Sei sicuro di voler RICOSTRUIRE il database dall'inventario?\n\n"
-            "❌ **TUTTI GLI ARTICOLI ATTUALE SARANNO ELIMINATI!**\n"
-            "✅ Verranno ricreati basandosi sul testo dell'inventario.\n\n"
-            "Questa operazione è IRREVERSIBILE!",
-            reply_markup=reply_markup
-        )
+        for categoria in ORDINE_CATEGORIE:
+            articoli_cat = fuori_uso_organizzati[categoria]
+            if articoli_cat:
+                msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
+                for seriale, sede, _ in articoli_cat:
+                    msg += f"• {seriale}\n"
+    
+    # RIASSUNTO
+    msg += f"\n📊 **RIASSUNTO CENTRALE:**\n"
+    msg += f"• 🔴 Usati: {len(usati_centrale)}\n"
+    msg += f"• ⚫ Fuori uso: {len(fuori_uso_centrale)}\n"
+    msg += f"• 📦 Totale: {len(articoli_centrale)}"
+    
+    await vista_messaggi.modifica(query, msg)
+
+async def cb_centrale_ripristina_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    query = update.callback_query
+    articoli_centrale = get_articoli_in_centrale()
+    if not articoli_centrale:
+        await vista_messaggi.modifica(query, "❌ Nessun articolo in centrale da ripristinare")
+        return
+
+    etichetta = lambda a: f"{a[0]} - {'USATO' if a[3] == 'usato_centrale' else 'FUORI USO'}"
+    reply_markup = tastiera_articoli(articoli_centrale, "cx", etichetta)
+    await vista_messaggi.modifica(query, "📥 Seleziona articolo da RIPRISTINARE da CENTRALE a ERBA:", reply_markup=reply_markup)
 
+async def cb_centrale_ripristina(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    seriale = articolo[1]
+    if ripristina_da_centrale(seriale, update.effective_user.id):
+        testo = f"✅ {seriale} ripristinato da CENTRALE a ERBA!"
     else:
-        await update.message.reply_text("ℹ️ Usa i pulsanti per navigare.", reply_markup=crea_tastiera_fisica(user_id))
+        testo = descrivi_conflitto(seriale)
+    await vista_messaggi.modifica(update.callback_query, testo)
+    return testo
+
+# GESTIONE RICOSTRUZIONE DATABASE
+async def cb_conferma_ricostruzione(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    query = update.callback_query
+    testo_inventario = context.user_data.get('inventario_da_caricare', '')
+    if not testo_inventario:
+        await vista_messaggi.modifica(query, "❌ Nessun testo inventario trovato!")
+        return
+        
+    # Esegui la ricostruzione
+    successo, messaggio = ricostruisci_database_da_inventario(testo_inventario)
+    
+    # Pulisci i dati temporanei
+    for key in ['azione', 'inventario_da_caricare']:
+        if key in context.user_data:
+            del context.user_data[key]
+            
+    await vista_messaggi.modifica(query, messaggio)
+
+async def cb_annulla_ricostruzione(update: Update, context: ContextTypes.DEFAULT_TYPE, _=None):
+    # Pulisci i dati temporanei
+    for key in ['azione', 'inventario_da_caricare']:
+        if key in context.user_data:
+            del context.user_data[key]
+            
+    await vista_messaggi.modifica(update.callback_query, "❌ Ricostruzione database annullata.")
+
+registra_callback("uc", cb_usato_categoria, argomento="categoria")
+registra_callback("us", cb_usato, argomento="articolo", idempotente=True)
+registra_callback("fc", cb_fuori_uso_categoria, argomento="categoria", ruolo='admin')
+registra_callback("fu", cb_fuori_uso, argomento="articolo", ruolo='admin', idempotente=True)
+registra_callback("rp", cb_ripristina, argomento="articolo", ruolo='admin', idempotente=True)
+registra_callback("ap", cb_approva, argomento="intero", ruolo='admin', idempotente=True)
+registra_callback("rf", cb_rifiuta, argomento="intero", ruolo='admin', idempotente=True)
+registra_callback("nc", cb_nuovo_categoria, argomento="categoria", ruolo='admin')
+registra_callback("ns", cb_nuovo_sede, argomento="sede", ruolo='admin')
+registra_callback("rc", cb_rimuovi_categoria, argomento="categoria", ruolo='admin')
+registra_callback("el", cb_elimina, argomento="articolo", ruolo='admin', idempotente=True)
+registra_callback("cu", cb_centrale_sposta_usati)
+registra_callback("cf", cb_centrale_sposta_fuori_uso)
+registra_callback("cs", cb_centrale_sposta, argomento="articolo", idempotente=True)
+registra_callback("ci", cb_centrale_inventario)
+registra_callback("cr", cb_centrale_ripristina_menu)
+registra_callback("cx", cb_centrale_ripristina, argomento="articolo", idempotente=True)
+registra_callback("ok", cb_conferma_ricostruzione, ruolo='admin')
+registra_callback("no", cb_annulla_ricostruzione, ruolo='admin')
 
 # === GESTIONE BOTTONI INLINE ===
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
     user_id = query.from_user.id
 
-    # SEGNA USATO - SELEZIONE CATEGORIA
-    if data.startswith("usato_cat_"):
-        categoria = data[10:]
-        articoli = get_articoli_per_stato('disponibile')
-        articoli_categoria = [a for a in articoli if a[1] == categoria]
-        
-        if not articoli_categoria:
-            await query.edit_message_text(f"❌ Nessun articolo disponibile per {CATEGORIE[categoria]}")
-            return
+    risolto = risolvi_callback(query.data or "")
+    if risolto is None:
+        # Pulsanti di vecchie versioni del bot o dati manomessi
+        await query.answer("⚠️ Pulsante non più valido, riapri il menu.", show_alert=True)
+        return
 
-        keyboard = []
-        for seriale, cat, sed in articoli_categoria:
-            nome = f"{seriale} - {SEDI[sed]}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"usato_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"🔴 Seleziona {CATEGORIE[categoria]} da segnare como USATO:", reply_markup=reply_markup)
-
-    # SEGNA USATO - CONFERMA
-    elif data.startswith("usato_"):
-        seriale = data[6:]
-        update_stato(seriale, "usato")
-        await query.edit_message_text(f"🔴 {seriale} segnato como USATO ✅")
-
-    # CREA FUORI USO - SELEZIONE CATEGORIA (PER ADMIN)
-    elif data.startswith("crea_fuori_uso_cat_"):
-        if not is_admin(user_id):
-            await query.answer("❌ Solo gli amministratori possono mettere articoli fuori uso!", show_alert=True)
-            return
-            
-        categoria = data[19:]
-        articoli_disponibili = get_articoli_per_stato('disponibile')
-        articoli_usati = get_articoli_per_stato('usato')
-        articoli_categoria = [a for a in articoli_disponibili + articoli_usati if a[1] == categoria]
-        
-        if not articoli_categoria:
-            await query.edit_message_text(f"❌ Nessun articolo per {CATEGORIE[categoria]}")
+    codice, valore = risolto
+    handler, argomento, ruolo, idempotente = ROUTE_CALLBACK[codice]
+
+    # Doppio tap / riconsegna: stessa risposta, nessuna scrittura DB né modifica del messaggio
+    if idempotente:
+        risposta = risposte_callback.get(chiave_callback(query))
+        if risposta is not None:
+            await query.answer(risposta[:200])
             return
 
-        keyboard = []
-        for seriale, cat, sed in articoli_categoria:
-            nome = f"{seriale} - {SEDI[sed]}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"fuori_uso_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"⚫ Seleziona {CATEGORIE[categoria]} da segnare como FUORI USO:", reply_markup=reply_markup)
+    ruolo_utente = get_ruolo(user_id)
+    if LIVELLO_RUOLO.get(ruolo_utente, 0) < LIVELLO_RUOLO[ruolo]:
+        if ruolo == 'admin':
+            testo = "❌ Operazione riservata agli amministratori!"
+        elif ruolo_utente == 'in_attesa':
+            testo = "⏳ La tua richiesta di accesso è in attesa di approvazione."
+        else:
+            # Utente sconosciuto (mai registrato o rifiutato) su un vecchio messaggio del bot
+            testo = "❌ Non sei registrato: usa /start per richiedere l'accesso."
+        await query.answer(testo, show_alert=True)
+        return
 
-    # SEGNA FUORI USO - CONFERMA
-    elif data.startswith("fuori_uso_"):
-        if not is_admin(user_id):
-            await query.answer("❌ Solo gli amministratori possono mettere articoli fuori uso!", show_alert=True)
+    # Validazione del valore prima di eseguire l'handler
+    if (argomento is None) != (valore is None):
+        await query.answer("⚠️ Pulsante non valido.", show_alert=True)
+        return
+    if argomento is not None:
+        try:
+            valore = TIPI_ARGOMENTO[argomento][1](valore)
+        except LookupError:
+            await query.answer()
+            await vista_messaggi.modifica(query, "❌ Articolo non più presente in inventario!")
             return
-            
-        seriale = data[10:]
-        update_stato(seriale, "fuori_uso")
-        await query.edit_message_text(f"⚫ {seriale} segnato como FUORI USO ✅")
-
-    # RIPRISTINA
-    elif data.startswith("ripristina_"):
-        seriale = data[11:]
-        update_stato(seriale, "disponibile")
-        await query.edit_message_text(f"🔄 {seriale} ripristinato a DISPONIBILE ✅")
-
-    # APPROVA UTENTE (UNO ALLA VOLTA)
-    elif data.startswith("approva_"):
-        if not is_admin(user_id):
+        except ValueError:
+            await query.answer("⚠️ Pulsante non valido.", show_alert=True)
             return
-            
-        user_id_approvare = int(data[8:])
-        approva_utente(user_id_approvare)
-        
-        try:
-            await context.bot.send_message(
-                user_id_approvare,
-                "✅ ACCESSO APPROVATO! Ora puoi usare tutte le funzioni del bot.\nUsa /start per iniziare."
-            )
-        except:
-            pass
-            
-        # Dopo l'approvazione, mostra se ci sono altre richieste
-        richieste_rimanenti = get_richieste_in_attesa()
-        if richieste_rimanenti:
-            messaggio_aggiuntivo = f"\n\n📋 Ci sono ancora {len(richieste_rimanenti)} richieste in attesa.\nUsa nuovamente '👥 Gestisci Richieste' per continuare."
-        else:
-            messaggio_aggiuntivo = "\n\n✅ Tutte le richieste sono state gestite."
-            
-        await query.edit_message_text(f"✅ Utente {user_id_approvare} approvato!{messaggio_aggiuntivo}")
 
-    # RIFIUTA UTENTE (UNO ALLA VOLTA)
-    elif data.startswith("rifiuta_"):
-        if not is_admin(user_id):
-            return
-            
-        user_id_rifiutare = int(data[8:])
-        conn = sqlite3.connect(DATABASE_NAME)  # ⬅️ USA LA COSTANTE
+    await query.answer()
+    with HANDLER_DURATA.misura(tipo="callback", route=codice):
+        risposta = await handler(update, context, valore)
+    if idempotente and risposta:
+        risposte_callback.set(chiave_callback(query), risposta)
+
+# === RICERCA ARTICOLI (/cerca e inline) ===
+# Azioni rapide proposte nella scheda articolo per ogni stato: (etichetta, codice callback).
+# Il ruolo minimo è quello della route del codice, verificato di nuovo da button_handler.
+AZIONI_RAPIDE = {
+    "disponibile": [("🔴 Usato", "us"), ("⚫ Fuori uso", "fu")],
+    "usato": [("📍 In centrale", "cs"), ("⚫ Fuori uso", "fu"), ("🔄 Ripristina", "rp")],
+    "fuori_uso": [("📍 In centrale", "cs"), ("🔄 Ripristina", "rp")],
+    "usato_centrale": [("↩️ Riporta a Erba", "cx"), ("🔄 Ripristina", "rp")],
+    "fuori_uso_centrale": [("↩️ Riporta a Erba", "cx"), ("🔄 Ripristina", "rp")],
+}
+
+def scheda_articolo(articolo, ruolo):
+    """Testo e pulsanti azione per una riga (id, seriale, categoria, sede, stato)"""
+    articolo_id, seriale, categoria, sede, stato = articolo[:5]
+    testo = (f"🔎 {seriale}\n"
+             f"📦 {CATEGORIE.get(categoria, categoria)}\n"
+             f"🏢 {SEDI.get(sede, sede)}\n"
+             f"Stato: {ETICHETTE_STATI.get(stato, stato)}")
+    pulsanti = [InlineKeyboardButton(etichetta, callback_data=cb(codice, articolo_id))
+                for etichetta, codice in AZIONI_RAPIDE.get(stato, [])
+                if LIVELLO_RUOLO.get(ruolo, 0) >= LIVELLO_RUOLO[ROUTE_CALLBACK[codice][2]]]
+    return testo, InlineKeyboardMarkup([pulsanti]) if pulsanti else None
+
+def riga_risultato(articolo):
+    _, seriale, categoria, sede, stato = articolo
+    return f"{seriale} - {ETICHETTE_STATI.get(stato, stato)} - {SEDI.get(sede, sede)}"
+
+async def cerca_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    ruolo = get_ruolo(user_id)
+    if ruolo not in LIVELLO_RUOLO:
+        await update.message.reply_text("❌ Non sei autorizzato. Usa /start per richiedere l'accesso.")
+        return
+
+    testo = " ".join(context.args)
+    if not testo:
+        await update.message.reply_text("🔎 Uso: /cerca <seriale o parte del seriale>\nEs. /cerca 012")
+        return
+
+    risultati = cerca_articoli(testo)
+    if not risultati:
+        await update.message.reply_text(f"❌ Nessun articolo trovato per \"{testo}\"")
+    elif len(risultati) == 1:
+        scheda, reply_markup = scheda_articolo(risultati[0], ruolo)
+        await update.message.reply_text(scheda, reply_markup=reply_markup)
+    else:
+        keyboard = [[InlineKeyboardButton(riga_risultato(a), callback_data=cb("sa", a[0]))] for a in risultati]
+        intestazione = f"🔎 {len(risultati)} articoli per \"{testo}\""
+        if len(risultati) == RISULTATI_RICERCA_MAX:
+            intestazione += " (primi risultati, affina la ricerca)"
+        await update.message.reply_text(intestazione + ":", reply_markup=InlineKeyboardMarkup(keyboard))
+
+# SCHEDA ARTICOLO DA ELENCO RISULTATI
+async def cb_scheda_articolo(update: Update, context: ContextTypes.DEFAULT_TYPE, articolo):
+    scheda, reply_markup = scheda_articolo(articolo, get_ruolo(update.effective_user.id))
+    await vista_messaggi.modifica(update.callback_query, scheda, reply_markup=reply_markup)
+
+registra_callback("sa", cb_scheda_articolo, argomento="articolo")
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ricerca inline (@nome_bot seriale): una scheda articolo per risultato, con le azioni rapide"""
+    query = update.inline_query
+    ruolo = get_ruolo(query.from_user.id)
+    if ruolo not in LIVELLO_RUOLO or not query.query.strip():
+        await query.answer([], cache_time=5, is_personal=True)
+        return
+
+    risultati = []
+    for articolo in cerca_articoli(query.query):
+        scheda, reply_markup = scheda_articolo(articolo, ruolo)
+        risultati.append(InlineQueryResultArticle(
+            id=str(articolo[0]),
+            title=articolo[1],
+            description=f"{ETICHETTE_STATI.get(articolo[4], articolo[4])} · {SEDI.get(articolo[3], articolo[3])}",
+            input_message_content=InputTextMessageContent(scheda),
+            reply_markup=reply_markup,
+        ))
+    # Cache breve: lo stato degli articoli cambia spesso
+    await query.answer(risultati, cache_time=5, is_personal=True)
+
+# === EXPORT INVENTARIO ===
+# Le righe arrivano dal cursore a blocchi e finiscono in un file temporaneo "spooled":
+# in memoria fino a SOGLIA_SPOOL_EXPORT, poi su disco, quindi la scrittura non cresce con l'inventario.
+# L'invio no: l'InputFile di PTB legge tutto il file in memoria prima dell'upload. Il picco resta
+# limitato dal tetto di Telegram per gli upload dei bot (DIMENSIONE_MAX_EXPORT), controllato prima dell'invio.
+COLONNE_EXPORT = ("id", "seriale", "categoria", "sede", "stato", "data_inserimento", "aggiornato_da", "aggiornato_il")
+SOGLIA_SPOOL_EXPORT = 1024 * 1024
+DIMENSIONE_MAX_EXPORT = 50 * 1024 * 1024
+
+def righe_articoli(blocco=500):
+    """Generatore sulle righe di articoli (COLONNE_EXPORT), letto a blocchi di `blocco` righe"""
+    conn = connetti()
+    try:
         c = conn.cursor()
-        c.execute("DELETE FROM utenti WHERE user_id = ?", (user_id_rifiutare,))
-        conn.commit()
+        c.execute(f"SELECT {', '.join(COLONNE_EXPORT)} FROM articoli ORDER BY seriale")
+        while True:
+            righe = c.fetchmany(blocco)
+            if not righe:
+                break
+            yield from righe
+    finally:
         conn.close()
-        
-        # Dopo il rifiuto, mostra se ci sono altre richieste
-        richieste_rimanenti = get_richieste_in_attesa()
-        if richieste_rimanenti:
-            messaggio_aggiuntivo = f"\n\n📋 Ci sono ancora {len(richieste_rimanenti)} richieste in attesa.\nUsa nuovamente '👥 Gestisci Richieste' para continuare."
-        else:
-            messaggio_aggiuntivo = "\n\n✅ Tutte le richieste sono stata gestite."
-            
-        await query.edit_message_text(f"❌ Utente {user_id_rifiutare} rifiutato!{messaggio_aggiuntivo}")
 
-    # SELEZIONE CATEGORIA PER AGGIUNTA
-    elif data.startswith("nuovo_cat_"):
-        categoria = data[10:]
-        context.user_data['nuova_categoria'] = categoria
-        context.user_data['azione'] = 'aggiungi_sede'
-        
-        keyboard = [
-            [InlineKeyboardButton(SEDI[sede], callback_data=f"nuovo_sede_{sede}")] 
-            for sede in SEDI
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"🏢 Seleziona sede per {CATEGORIE[categoria]}:", reply_markup=reply_markup)
+def _scrivi_csv(righe, file):
+    # utf-8-sig: Excel riconosce l'UTF-8 (emoji e accenti) aprendo il file con doppio clic
+    testo = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(testo)
+    writer.writerow(COLONNE_EXPORT)
+    writer.writerows(righe)
+    testo.flush()
+    testo.detach()
+
+def _scrivi_jsonl(righe, file):
+    testo = io.TextIOWrapper(file, encoding='utf-8', newline='\n')
+    for riga in righe:
+        testo.write(json.dumps(dict(zip(COLONNE_EXPORT, riga)), ensure_ascii=False) + "\n")
+    testo.flush()
+    testo.detach()
+
+def _scrivi_xlsx(righe, file):
+    # write_only: openpyxl scrive le righe man mano invece di tenere il foglio in memoria
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Articoli")
+    ws.append(COLONNE_EXPORT)
+    for riga in righe:
+        ws.append(riga)
+    wb.save(file)
+
+FORMATI_EXPORT = {
+    "csv": _scrivi_csv,
+    "jsonl": _scrivi_jsonl,
+    "xlsx": _scrivi_xlsx,
+}
 
-    # SELEZIONE SEDE PER AGGIUNTA - MODIFICA ANCHE QUI
-    elif data.startswith("nuovo_sede_"):
-        sede = data[11:]
-        categoria = context.user_data['nuova_categoria']
-        
-        context.user_data['azione'] = 'inserisci_numero'
-        context.user_data['categoria_da_aggiungere'] = categoria
-        context.user_data['sede_da_aggiungere'] = sede
-        
-        prefisso = get_prefisso_categoria(categoria)
-        await query.edit_message_text(
-            f"📝 Inserisci NUMERO per {CATEGORIE[categoria]} - {SEDI[sede]}:\n\n"
-            f"Prefisso: {prefisso}\n"
-            f"📌 Formato richiesto: **3 cifre** (es. 001, 123, 999)\n\n"
-            f"Inserisci le 3 cifre:"
-        )
+def esporta_articoli(formato):
+    """Scrive l'inventario nel formato richiesto, restituisce (file temporaneo riavvolto, numero righe, byte)"""
+    conteggio = [0]
 
-    # RIMOZIONE ARTICOLO - SELEZIONE CATEGORIA
-    elif data.startswith("rimuovi_cat_"):
-        categoria = data[12:]
-        articoli = get_articoli_per_stato('disponibile') + get_articoli_per_stato('usato') + get_articoli_per_stato('fuori_uso')
-        articoli_categoria = [a for a in articoli if a[1] == categoria]
-        
-        if not articoli_categoria:
-            await query.edit_message_text(f"❌ Nessun articolo per {CATEGORIE[categoria]}")
-            return
-        
-        keyboard = []
-        for seriale, cat, sede in articoli_categoria:
-            nome = f"{seriale} - {SEDI[sede]}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"elimina_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"➖ Seleziona articolo da ELIMINARE:", reply_markup=reply_markup)
+    def contate(righe):
+        for riga in righe:
+            conteggio[0] += 1
+            yield riga
 
-    # RIMOZIONE ARTICOLO - CONFERMA ELIMINAZIONE
-    elif data.startswith("elimina_"):
-        seriale = data[8:]
-        articolo = get_articolo(seriale)
-        
-        if articolo:
-            delete_articolo(seriale)
-            await query.edit_message_text(f"✅ {seriale} rimosso dall'inventario!")
-        else:
-            await query.edit_message_text(f"❌ {seriale} non trovato!")
-
-    # GESTIONE CENTRALE - MENU PRINCIPALE
-    elif data == "centrale_sposta_usati":
-        # MODIFICA: usa la nuova funzione che esclude quelli già in centrale
-        articoli_usati = get_articoli_per_stato_centrale('usato', escludi_centrale=True)
-        if not articoli_usati:
-            await query.edit_message_text("❌ Nessun articolo usato da spostare in centrale (o tutti già in centrale)")
-            return
+    file = tempfile.SpooledTemporaryFile(max_size=SOGLIA_SPOOL_EXPORT)
+    try:
+        FORMATI_EXPORT[formato](contate(righe_articoli()), file)
+        dimensione = file.tell()
+        file.seek(0)
+    except Exception:
+        file.close()
+        raise
+    return file, conteggio[0], dimensione
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        await update.message.reply_text("❌ Solo gli amministratori possono esportare l'inventario!")
+        return
 
-        keyboard = []
-        for seriale, cat, sed in articoli_usati:
-            nome = f"{seriale} - {SEDI[sed]}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"centrale_sposta_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("📤 Seleziona articolo USATO da spostare in CENTRALE:", reply_markup=reply_markup)
+    formato = context.args[0].lower().lstrip('.') if context.args else "csv"
+    if formato not in FORMATI_EXPORT:
+        await update.message.reply_text(f"📥 Uso: /export [{' | '.join(FORMATI_EXPORT)}] (predefinito: csv)")
+        return
 
-    elif data == "centrale_sposta_fuori_uso":
-        # MODIFICA: usa la nuova funzione che esclude quelli già in centrale
-        articoli_fuori_uso = get_articoli_per_stato_centrale('fuori_uso', escludi_centrale=True)
-        if not articoli_fuori_uso:
-            await query.edit_message_text("❌ Nessun articolo fuori uso da spostare in centrale (o tutti già in centrale)")
+    # Scrittura del file in un thread: il loop continua a servire gli altri utenti
+    file, righe, dimensione = await asyncio.to_thread(esporta_articoli, formato)
+    with file:
+        if dimensione > DIMENSIONE_MAX_EXPORT:
+            # Telegram lo rifiuterebbe comunque: meglio non caricarlo in memoria per l'upload
+            await update.message.reply_text(
+                f"❌ Export di {dimensione / 1024 / 1024:.1f} MB: oltre il limite di "
+                f"{DIMENSIONE_MAX_EXPORT // 1024 // 1024} MB per i file inviati dai bot. Prova /export xlsx.")
             return
+        await update.message.reply_document(
+            document=file,
+            filename=f"inventario_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}",
+            caption=f"📥 Export inventario: {righe} articoli ({formato.upper()})"
+        )
 
-        keyboard = []
-        for seriale, cat, sed in articoli_fuori_uso:
-            nome = f"{seriale} - {SEDI[sed]}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"centrale_sposta_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("📤 Seleziona articolo FUORI USO da spostare in CENTRALE:", reply_markup=reply_markup)
+# === REPORT SQL (/sql) ===
+async def sql_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/sql [N] mostra le N istruzioni più costose e le ultime query lente; /sql azzera riparte da zero"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono vedere le statistiche SQL!")
+        return
 
-    elif data.startswith("centrale_sposta_"):
-        seriale = data[16:]
-        if sposta_in_centrale(seriale):
-            await query.edit_message_text(f"✅ {seriale} spostato in CENTRALE!")
-        else:
-            await query.edit_message_text(f"❌ Impossibile spostare {seriale} in centrale")
+    argomento = context.args[0].lower() if context.args else ""
+    if argomento == "azzera":
+        azzera_statistiche_sql(os.path.basename(DATABASE_NAME))
+        await update.message.reply_text("🗄️ Statistiche SQL azzerate.")
+        return
 
-    elif data == "centrale_inventario":
-        articoli_centrale = get_articoli_in_centrale()
-        if not articoli_centrale:
-            await query.edit_message_text("🏢 **INVENTARIO CENTRALE**\n\n📦 Nessun articolo in centrale al momento")
-            return
+    n = int(argomento) if argomento.isdigit() else 10
+    # Limite di Telegram: 4096 caratteri per messaggio
+    await update.message.reply_text(report_sql(max(1, min(n, 30)), os.path.basename(DATABASE_NAME))[:4000])
+
+# === PROFILAZIONE SU RICHIESTA (/profila, /memoria) ===
+# Nessun costo quando non usate: cProfile è attivo solo per i secondi richiesti,
+# tracemalloc solo tra "/memoria avvia" e "/memoria ferma".
+PROFILO_SECONDI_MAX = 120
+RIGHE_REPORT_PROFILO = 40
+_lock_profilo = asyncio.Lock()
+_snapshot_memoria = None   # riferimento per "/memoria diff"
+
+async def _invia_report(update, testo, nome, didascalia):
+    documento = io.BytesIO(testo.encode('utf-8'))
+    await update.message.reply_document(
+        document=documento,
+        filename=f"{nome}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+        caption=didascalia
+    )
 
-        # Organizza per categoria
-        articoli_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], a[3]) for a in articoli_centrale])
-        
-        msg = "🏢 **INVENTARIO CENTRALE**\n\n"
-        
-        # USATI IN CENTRALE
-        usati_centrale = [a for a in articoli_centrale if a[3] == 'usato_centrale']
-        if usati_centrale:
-            msg += f"🔴 **USATI IN CENTRALE** ({len(usati_centrale)}):\n"
-            usati_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], a[3]) for a in usati_centrale])
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = usati_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, _ in articoli_cat:
-                        msg += f"• {seriale}\n"
-            msg += "\n"
-        
-        # FUORI USO IN CENTRALE
-        fuori_uso_centrale = [a for a in articoli_centrale if a[3] == 'fuori_uso_centrale']
-        if fuori_uso_centrale:
-            msg += f"⚫ **FUORI USO IN CENTRALE** ({len(fuori_uso_centrale)}):\n"
-            fuori_uso_organizzati = organizza_articoli_per_categoria([(a[0], a[1], a[2], a[3]) for a in fuori_uso_centrale])
-            
-            for categoria in ORDINE_CATEGORIE:
-                articoli_cat = fuori_uso_organizzati[categoria]
-                if articoli_cat:
-                    msg += f"\n**{CATEGORIE[categoria]}** ({len(articoli_cat)}):\n"
-                    for seriale, sede, _ in articoli_cat:
-                        msg += f"• {seriale}\n"
-        
-        # RIASSUNTO
-        msg += f"\n📊 **RIASSUNTO CENTRALE:**\n"
-        msg += f"• 🔴 Usati: {len(usati_centrale)}\n"
-        msg += f"• ⚫ Fuori uso: {len(fuori_uso_centrale)}\n"
-        msg += f"• 📦 Totale: {len(articoli_centrale)}"
-        
-        await query.edit_message_text(msg)
+def _report_cprofile(profilo, secondi):
+    uscita = io.StringIO()
+    statistiche = pstats.Stats(profilo, stream=uscita)
+    uscita.write(f"cProfile del loop principale per {secondi}s (i thread di asyncio.to_thread non sono inclusi)\n\n")
+    uscita.write("=== PER TEMPO CUMULATIVO ===\n")
+    statistiche.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(RIGHE_REPORT_PROFILO)
+    uscita.write("\n=== PER TEMPO PROPRIO ===\n")
+    statistiche.sort_stats(pstats.SortKey.TIME).print_stats(RIGHE_REPORT_PROFILO)
+    return uscita.getvalue()
+
+async def profila_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profila [secondi]: cProfile sul processo vivo, report come documento"""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono profilare il bot!")
+        return
+    if _lock_profilo.locked():
+        await update.message.reply_text("⏳ Profilazione già in corso.")
+        return
 
-    elif data == "centrale_ripristina":
-        articoli_centrale = get_articoli_in_centrale()
-        if not articoli_centrale:
-            await query.edit_message_text("❌ Nessun articolo in centrale da ripristinare")
-            return
+    secondi = int(context.args[0]) if context.args and context.args[0].isdigit() else 15
+    secondi = max(1, min(secondi, PROFILO_SECONDI_MAX))
 
-        keyboard = []
-        for seriale, cat, sed, stato in articoli_centrale:
-            tipo = "USATO" if stato == "usato_centrale" else "FUORI USO"
-            nome = f"{seriale} - {tipo}"
-            keyboard.append([InlineKeyboardButton(nome, callback_data=f"centrale_ripristina_{seriale}")])
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("📥 Seleziona articolo da RIPRISTINARE da CENTRALE a ERBA:", reply_markup=reply_markup)
+    # Il lock è libero (controllato sopra): acquire non attende. Lo rilascia il task a fine finestra
+    await _lock_profilo.acquire()
+    # La finestra gira in un task a parte: l'handler termina subito e non tiene occupati
+    # la chat dell'admin né uno dei posti di CONCORRENZA_UPDATE per tutta la durata
+    context.application.create_task(_profila(update, secondi), update=update)
+    await update.message.reply_text(f"⏱️ Profilazione per {secondi}s in corso, il report arriverà qui.")
 
-    elif data.startswith("centrale_ripristina_"):
-        seriale = data[20:]
-        if ripristina_da_centrale(seriale):
-            await query.edit_message_text(f"✅ {seriale} ripristinato da CENTRALE a ERBA!")
-        else:
-            await query.edit_message_text(f"❌ Impossibile ripristinare {seriale}")
+async def _profila(update, secondi):
+    try:
+        # Il profiler segue il thread che lo attiva: qui è quello dell'event loop, dove girano tutti gli handler
+        profilo = cProfile.Profile()
+        profilo.enable()
+        try:
+            await asyncio.sleep(secondi)
+        finally:
+            profilo.disable()
+        testo = await asyncio.to_thread(_report_cprofile, profilo, secondi)
+    finally:
+        _lock_profilo.release()
+
+    await _invia_report(update, testo, "profilo_cpu", f"⏱️ cProfile {secondi}s: funzioni principali")
 
-    # NUOVO: GESTIONE RICOSTRUZIONE DATABASE
-    elif data == "conferma_ricostruzione":
-        if not is_admin(user_id):
-            await query.answer("❌ Solo gli amministratori possono ricostruire il database!", show_alert=True)
+def _statistiche_memoria(snapshot, precedente=None):
+    filtri = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    )
+    snapshot = snapshot.filter_traces(filtri)
+    uscita = io.StringIO()
+    if precedente is None:
+        righe = snapshot.statistics('lineno')
+        totale = sum(riga.size for riga in righe)
+        uscita.write(f"tracemalloc snapshot: {totale / 1024 / 1024:.1f} MB tracciati\n\n")
+    else:
+        righe = snapshot.compare_to(precedente.filter_traces(filtri), 'lineno')
+        crescita = sum(riga.size_diff for riga in righe)
+        uscita.write(f"tracemalloc diff dall'ultimo snapshot: {crescita / 1024:+.1f} KB\n\n")
+    for riga in righe[:RIGHE_REPORT_PROFILO]:
+        uscita.write(f"{riga}\n")
+    return uscita.getvalue()
+
+async def memoria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/memoria avvia | snapshot | diff | ferma"""
+    global _snapshot_memoria
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Solo gli amministratori possono profilare il bot!")
+        return
+
+    azione = context.args[0].lower() if context.args else ""
+    if azione == "avvia":
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+        _snapshot_memoria = None
+        await update.message.reply_text("🧠 tracemalloc attivo. Usa /memoria snapshot, /memoria diff, /memoria ferma.")
+    elif azione == "ferma":
+        tracemalloc.stop()
+        _snapshot_memoria = None
+        await update.message.reply_text("🧠 tracemalloc fermato.")
+    elif azione in ("snapshot", "diff"):
+        if not tracemalloc.is_tracing():
+            await update.message.reply_text("❌ tracemalloc non attivo: prima /memoria avvia")
             return
-            
-        testo_inventario = context.user_data.get('inventario_da_caricare', '')
-        if not testo_inventario:
-            await query.edit_message_text("❌ Nessun testo inventario trovato!")
+        snapshot = tracemalloc.take_snapshot()
+        precedente = _snapshot_memoria if azione == "diff" else None
+        if azione == "diff" and precedente is None:
+            await update.message.reply_text("ℹ️ Nessuno snapshot precedente: salvato questo come riferimento.")
+            _snapshot_memoria = snapshot
+            return
+        _snapshot_memoria = snapshot
+        testo = await asyncio.to_thread(_statistiche_memoria, snapshot, precedente)
+        await _invia_report(update, testo, f"memoria_{azione}", f"🧠 tracemalloc {azione}: siti di allocazione principali")
+    else:
+        stato = "attivo" if tracemalloc.is_tracing() else "spento"
+        await update.message.reply_text(f"🧠 Uso: /memoria avvia | snapshot | diff | ferma (tracemalloc {stato})")
+
+# === ELABORAZIONE CONCORRENTE DEGLI UPDATE ===
+CONCORRENZA_UPDATE = 32  # update elaborati in parallelo al massimo
+
+class ProcessoreUpdatePerChat(BaseUpdateProcessor):
+    """Update di chat diverse in parallelo, update della stessa chat in ordine (lo stato dei wizard è per chat)"""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # Posti globali propri: il semaforo di BaseUpdateProcessor è un dettaglio privato di PTB
+        self._posti = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._lock_chat = {}  # chat_id -> [lock, update in attesa]; la voce sparisce quando non serve più
+        self.in_corso = 0     # update in elaborazione (per /metrics)
+        self._presenti = 0    # update entrati in process_update e non ancora conclusi
+        self.al_termine = None  # funzione(update) chiamata a elaborazione conclusa (usata da replay.py)
+
+    @property
+    def in_attesa(self):
+        """Update fermi sul lock della chat o sui posti globali (per /metrics)"""
+        return self._presenti - self.in_corso
+
+    async def process_update(self, update, coroutine):
+        self._presenti += 1
+        try:
+            await self._attendi_turno(update, coroutine)
+        finally:
+            self._presenti -= 1
+
+    async def _attendi_turno(self, update, coroutine):
+        # Il turno della chat si aspetta PRIMA di occupare uno dei posti globali: una chat che manda
+        # molti tap di fila tiene al massimo un posto, gli altri suoi update restano in fila sul lock
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            # Es. inline query: nessuno stato di chat da proteggere
+            async with self._posti:
+                await self.do_process_update(update, coroutine)
             return
-            
-        # Esegui la ricostruzione
-        successo, messaggio = ricostruisci_database_da_inventario(testo_inventario)
-        
-        # Pulisci i dati temporanei
-        for key in ['azione', 'inventario_da_caricare']:
-            if key in context.user_data:
-                del context.user_data[key]
-                
-        await query.edit_message_text(messaggio)
 
-    elif data == "annulla_ricostruzione":
-        # Pulisci i dati temporanei
-        for key in ['azione', 'inventario_da_caricare']:
-            if key in context.user_data:
-                del context.user_data[key]
-                
-        await query.edit_message_text("❌ Ricostruzione database annullata.")
+        voce = self._lock_chat.setdefault(chat.id, [asyncio.Lock(), 0])
+        voce[1] += 1
+        try:
+            async with voce[0]:
+                async with self._posti:
+                    await self.do_process_update(update, coroutine)
+        finally:
+            voce[1] -= 1
+            if voce[1] == 0:
+                del self._lock_chat[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        self.in_corso += 1
+        try:
+            await coroutine
+        finally:
+            self.in_corso -= 1
+            if self.al_termine is not None:
+                self.al_termine(update)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # === ALLARME BOMBOLE ===
 async def controlla_allarme_bombole(context: ContextTypes.DEFAULT_TYPE):
@@ -1607,90 +2886,236 @@ async def controlla_allarme_bombole(context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
 
-# === SERVER FLASK PER RENDER ===
-app = Flask(__name__)
+# === SERVER WEB PER RENDER (aiohttp sullo stesso event loop del bot) ===
+WEB_PORT = int(os.environ.get('PORT', 10000))
+APP_KEY_APPLICATION = web.AppKey("application", Application)
+web_runner = None
+CHIAVE_SOTTO_APP = "sotto_app_web"   # bot_data: sotto-app da montare sul server web (avvio_unico.py)
 
-@app.route('/')
-def home():
-    return "🤖 Bot Telegram Autoprotettori - ONLINE 🟢 - Keep-alive attivo!"
+async def home(request):
+    return web.Response(text="🤖 Bot Telegram Autoprotettori - ONLINE 🟢 - Keep-alive attivo!")
 
-@app.route('/health')
-def health():
-    return "OK"
+async def health(request):
+    return web.Response(text="OK")
 
-@app.route('/ping')
-def ping():
-    return f"PONG - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+async def ping(request):
+    return web.Response(text=f"PONG - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
 
-@app.route('/status')
-def status():
-    articoli = len(get_tutti_articoli())
+async def status(request):
+    articoli = conta_articoli()
     bombole = conta_bombole_disponibili()
-    return f"Bot Active | Articoli: {articoli} | Bombole: {bombole} | Keep-alive: ✅"
+    return web.Response(text=f"Bot Active | Articoli: {articoli} | Bombole: {bombole} | Keep-alive: ✅")
+
+async def metrics(request):
+    """Metriche in formato Prometheus; se METRICS_TOKEN è impostato serve 'Authorization: Bearer <token>'"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return web.Response(status=401, text="Unauthorized")
+    return web.Response(body=registro.esporta().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def keep_alive_endpoint(request):
+    return web.Response(text=f"KEEP-ALIVE ACTIVE - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+async def backup_now(request):
+    """Endpoint per forzare un backup immediato (condivide il lock col backup programmato)"""
+    eseguito, risultato = await scheduler.esegui_ora('backup')
+    if not eseguito:
+        return web.Response(text="⏳ Backup già in corso")
+    if risultato:
+        return web.Response(text="✅ Backup eseguito con successo!")
+    else:
+        return web.Response(text="❌ Errore durante il backup")
 
-@app.route('/keep-alive')
-def keep_alive_endpoint():
-    return f"KEEP-ALIVE ACTIVE - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+async def telegram_webhook(request):
+    """Riceve gli update da Telegram (modalità webhook) e li mette in coda all'applicazione"""
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403, text="Forbidden")
 
-@app.route('/backup-now')
-def backup_now():
-    """Endpoint per forzare un backup immediato"""
-    if backup_database_to_gist():
-        return "✅ Backup eseguito con successo!"
-    else:
-        return "❌ Errore durante il backup"
+    try:
+        dati = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="Bad Request")
+
+    application = request.app[APP_KEY_APPLICATION]
+    await application.update_queue.put(Update.de_json(dati, application.bot))
+    return web.Response(text="OK")
+
+@web.middleware
+async def traccia_richieste(request, handler):
+    """Ricorda l'ultima richiesta esterna: il keep-alive non pinga se il servizio è già tenuto sveglio"""
+    global ULTIMA_RICHIESTA_WEB
+    if request.remote not in ('127.0.0.1', '::1'):
+        ULTIMA_RICHIESTA_WEB = time.monotonic()
+    return await handler(request)
+
+def crea_web_app(application):
+    app = web.Application(middlewares=[traccia_richieste])
+    app[APP_KEY_APPLICATION] = application
+    app.add_routes([
+        web.get('/', home),
+        web.get('/health', health),
+        web.get('/ping', ping),
+        web.get('/status', status),
+        web.get('/metrics', metrics),
+        web.get('/keep-alive', keep_alive_endpoint),
+        web.get('/backup-now', backup_now),
+        web.post(WEBHOOK_PATH, telegram_webhook),
+    ])
+    return app
+
+async def avvia_web_server(application: Application, sotto_app=None):
+    """Avvia il server web (health-check + webhook) nello stesso loop dell'applicazione.
+    sotto_app: {prefisso: funzione che crea una web.Application} montate sulla stessa porta
+    (vedi avvio_unico.py). Restano in bot_data: il riavvio del keep-alive le rimonta tutte"""
+    global web_runner
+    if sotto_app is not None:
+        application.bot_data[CHIAVE_SOTTO_APP] = sotto_app
+    app = crea_web_app(application)
+    # Una sotto-app già servita è congelata e non si può rimontare: a ogni avvio se ne crea una nuova
+    for prefisso, crea in application.bot_data.get(CHIAVE_SOTTO_APP, {}).items():
+        app.add_subapp(prefisso, crea())
+    # Access log attivo: passa dalla coda del logging ed è campionato (vedi log_strutturato)
+    web_runner = web.AppRunner(app)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, '0.0.0.0', WEB_PORT).start()
+    logger.info("✅ Server web avviato sulla porta %d", WEB_PORT)
+
+async def ferma_web_server(application: Application):
+    """Chiude il server web"""
+    if web_runner:
+        await web_runner.cleanup()
+
+async def avvia_ricezione_update(application: Application):
+    """Imposta il webhook se richiesto, altrimenti (o se fallisce) usa il polling. Restituisce la modalità attiva"""
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_URL:
+            try:
+                await application.bot.set_webhook(
+                    url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                logger.info("✅ Webhook attivo su %s%s", WEBHOOK_URL.rstrip('/'), WEBHOOK_PATH)
+                return 'webhook'
+            except TelegramError as e:
+                logger.error("❌ Impostazione webhook fallita: %s - passo al polling", e)
+        else:
+            logger.warning("⚠️ BOT_MODE=webhook ma WEBHOOK_URL non configurato - passo al polling")
+
+    # start_polling rimuove anche un eventuale webhook rimasto impostato
+    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("✅ Polling attivo")
+    return 'polling'
+
+def crea_sessione_http():
+    """Un'unica sessione HTTP con connection pool per tutte le richieste in uscita del keep-alive"""
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=10),
+        connector=aiohttp.TCPConnector(limit=10, ttl_dns_cache=300)
+    )
+
+def registra_lavori(application: Application, session):
+    """Tutti i lavori periodici sullo stesso scheduler: backup e controlli bloccanti girano in un thread"""
+    scheduler.aggiungi('backup', esegui_backup, INTERVALLO_BACKUP, primo_avvio=10, jitter=30, in_thread=True)
+    scheduler.aggiungi('sistema', campiona_sistema, CAMPIONAMENTO_SISTEMA)
+    scheduler.aggiungi('ore_istanza', battito_istanza, INTERVALLO_BATTITO, primo_avvio=INTERVALLO_BATTITO, in_thread=True)
+    scheduler.aggiungi('integrita', controllo_integrita_periodico, INTERVALLO_INTEGRITA, primo_avvio=INTERVALLO_INTEGRITA, in_thread=True)
+    scheduler.aggiungi('keep_alive', lambda: keep_alive_tick(application, session), KEEPALIVE_TICK, primo_avvio=KEEPALIVE_TICK)
+
+    # Con gli update concorrenti la coda dell'Application si svuota subito: l'attesa vera è nel processore
+    CODA_UPDATE.funzione = lambda: application.update_queue.qsize() + application.update_processor.in_attesa
+    UPDATE_IN_CORSO.funzione = lambda: application.update_processor.in_corso
+
+async def esegui_bot(application: Application):
+    """Ciclo di vita completo: server web + ricezione update fino a SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    session = crea_sessione_http()
+    registra_lavori(application, session)
+
+    await application.initialize()
+    await avvia_web_server(application)
+    await avvia_ricezione_update(application)
+    await application.start()
+    registra_avvio_istanza()
+    scheduler.avvia()
 
-def run_flask():
-    app.run(host='0.0.0.0', port=10000, debug=False)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("🛑 Arresto bot...")
+        await scheduler.ferma()
+        # Ultimo battito: il tempo fino allo spegnimento entra nel conteggio ore
+        battito_istanza()
+        await session.close()
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await vista_messaggi.svuota()
+        await ferma_web_server(application)
+        await application.shutdown()
+        await backup_finale('backup')
 
 # === MAIN ===
-def main():
-    print("🚀 Avvio Bot Autoprotettori Erba...")
+def crea_application(richiesta=None):
+    """Application con tutti gli handler (usata anche da replay.py e avvio_unico.py).
+    richiesta: client HTTP per la Bot API da condividere con un altro bot dello stesso processo"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(ProcessoreUpdatePerChat(CONCORRENZA_UPDATE))
+        .persistence(persistenza)
+        # Latenza ed esito di ogni chiamata Bot API (stesse dimensioni dei pool predefiniti di PTB)
+        .request(richiesta or RichiestaTelegramMisurata(connection_pool_size=256))
+        .get_updates_request(RichiestaTelegramMisurata(connection_pool_size=1))
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    if REGISTRA_UPDATE:
+        builder = builder.update_queue(CodaUpdateRegistrata(RegistratoreUpdate(REGISTRA_UPDATE)))
+    application = builder.build()
     
+    application.add_handler(TypeHandler(Update, registra_contesto_update), group=-2)
+    application.add_handler(TypeHandler(Update, segna_attivita), group=-1)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("cerca", cerca_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("sql", sql_command))
+    application.add_handler(CommandHandler("profila", profila_command))
+    application.add_handler(CommandHandler("memoria", memoria_command))
+    application.add_handler(InlineQueryHandler(inline_query_handler))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
+
+def prepara_database_avvio():
     # 🔄 RIPRISTINO AUTOMATICO ALL'AVVIO
     if not restore_on_startup():
-        print("🔄 Inizializzazione database nuovo...")
+        log_database.info("🔄 Inizializzazione database nuovo...")
         init_db()
     
-    # 🔒 VERIFICA INTEGRITÀ DATABASE
-    print("🔍 Verifica integrità database...")
-    if not check_database_integrity():
-        print("🔄 Ricreazione database di emergenza...")
-        emergency_recreate_database()
-    
-    # Avvia Flask in un thread separato
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    print("✅ Flask server started on port 10000")
-    
-    # 🔥 AVVIA IL SISTEMA KEEP-ALIVE ULTRA-AGGRESSIVO
-    keep_alive_thread = threading.Thread(target=keep_alive_aggressive, daemon=True)
-    keep_alive_thread.start()
-    print("✅ Sistema keep-alive ULTRA-AGGRESSIVO attivato! Ping ogni 5 minuti")
-    
-    # 🔄 AVVIA SCHEDULER BACKUP AUTOMATICO
-    backup_thread = threading.Thread(target=backup_scheduler, daemon=True)
-    backup_thread.start()
-    print("✅ Scheduler backup attivato! Backup ogni 25 minuti")
-    
-    application = Application.builder().token(BOT_TOKEN).build()
+    # 🔒 VERIFICA INTEGRITÀ DATABASE (quick_check + schema, senza scansioni)
+    log_database.info("🔍 Verifica integrità database...")
+    verifica_integrita_avvio()
+
+def main():
+    logger.info("🚀 Avvio Bot Autoprotettori Erba...")
+    prepara_database_avvio()
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application = crea_application()
+    if REGISTRA_UPDATE:
+        logger.info("⏺️ Registrazione update attiva su %s", REGISTRA_UPDATE)
 
-    print("🤖 Bot Autoprotettori Erba Avviato!")
-    print("📍 Server: Render.com")
-    print("🟢 Status: ONLINE con keep-alive ultra-aggressivo")
-    print("💾 Database: SQLite3 con backup automatico")
-    print("👥 Admin configurati:", len(ADMIN_IDS))
-    print("⏰ Ping automatici ogni 5 minuti - Zero spin down! 🚀")
-    print("💾 Backup automatici ogni 25 minuti - Dati al sicuro! 🛡️")
-    print("🏠 Nuova categoria: Seconda Utenza aggiunta!")
-    print("📤 Nuova feature: Ricostruzione database da inventario!")
+    logger.info("🤖 Bot Autoprotettori Erba avviato | admin: %d | keep-alive se inattivo da %ds | backup ogni %d min | modalità update: %s",
+                len(ADMIN_IDS), KEEPALIVE_IDLE_TIMEOUT // 2, INTERVALLO_BACKUP // 60, BOT_MODE)
     
-    application.run_polling()
+    # Server web e bot condividono lo stesso event loop (e la stessa porta in modalità webhook)
+    asyncio.run(esegui_bot(application))
 
 if __name__ == '__main__':
     main()
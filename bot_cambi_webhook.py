@@ -2,17 +2,23 @@
 import logging
 import sqlite3
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
 from datetime import datetime, timedelta
 import asyncio
 import os
-from flask import Flask, request
-import threading
-import requests
+from aiohttp import web
+from scheduler import Scheduler
+from persistenza import PersistenzaSQLite
+from metriche import ConnessioneMisurata, report_sql
+from log_strutturato import configura_logging, registra_contesto_update
+from backup_gist import scrivi_gist, leggi_gist
 import time
 import psutil
 import base64
 import json
+import hmac
+import secrets
+import signal
 from typing import Dict, List, Tuple
 
 # === CONFIGURAZIONE ===
@@ -21,22 +27,26 @@ DATABASE_CAMBI = 'cambi_vvf.db'
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
 GIST_ID_CAMBI = os.environ.get('GIST_ID_CAMBI')
 WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://telegram-bot-cambi.onrender.com')
-WEBHOOK_PORT = 10001
+WEBHOOK_PORT = int(os.environ.get('PORT', 10001))
+WEBHOOK_PATH = '/webhook'
+# Se non configurato genero un segreto per ogni avvio: il webhook viene reimpostato a ogni boot
+WEBHOOK_SECRET_CAMBI = os.environ.get('WEBHOOK_SECRET_CAMBI') or secrets.token_urlsafe(32)
+CAMBI_MODE = os.environ.get('CAMBI_MODE', 'webhook').lower()  # 'webhook' o 'polling'
+# Bot API alternativa (vuoto = Telegram): usata dai test di carico con finto_telegram.py
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '').rstrip('/')
+UPDATE_QUEUE_MAX = int(os.environ.get('UPDATE_QUEUE_MAX', 100))  # update in attesa prima di rispondere 503
 
 # ID unico utilizzatore
 MY_USER_ID = 1816045269
 
-# Configurazione logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+# Configurazione logging (JSON su stdout tramite QueueListener, vedi log_strutturato)
+configura_logging()
+logger = logging.getLogger("bot_cambi")
 
 # === DATABASE SCHEMA COMPLETO ===
 def init_db_cambi():
     """Inizializzazione database completo per gestione cambi e squadre"""
-    conn = sqlite3.connect(DATABASE_CAMBI)
+    conn = sqlite3.connect(DATABASE_CAMBI, factory=ConnessioneMisurata)
     c = conn.cursor()
     
     # Tabella VVF
@@ -160,7 +170,7 @@ init_db_cambi()
 
 # === FUNZIONI UTILITY DATABASE ===
 def get_conn():
-    return sqlite3.connect(DATABASE_CAMBI)
+    return sqlite3.connect(DATABASE_CAMBI, factory=ConnessioneMisurata)
 
 # === SISTEMA "CHI TOCCA" - CALENDARIO INTELLIGENTE ===
 def calcola_squadra_di_turno(tipo_squadra: str, data: datetime) -> str:
@@ -411,6 +421,15 @@ async def help_cambi(update: Update, context: ContextTypes.DEFAULT_TYPE):
 """
     await update.message.reply_text(help_text)
 
+async def sql_cambi(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/sql [N]: istruzioni SQL più costose e ultime query lente"""
+    if update.effective_user.id != MY_USER_ID:
+        await update.message.reply_text("❌ Accesso riservato.")
+        return
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    # Solo il database dei cambi: con avvio_unico.py le statistiche del processo includono anche il bot principale
+    await update.message.reply_text(report_sql(max(1, min(n, 30)), DATABASE_CAMBI)[:4000])
+
 # === GESTIONE BOTTONI INLINE ===
 async def button_handler_cambi(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gestisce tutti i callback dei bottoni inline"""
@@ -556,13 +575,13 @@ def backup_database_cambi():
     if not GITHUB_TOKEN or not GIST_ID_CAMBI:
         return False
     
-    try:
+    def prepara_files():
         with open(DATABASE_CAMBI, 'rb') as f:
             db_content = f.read()
         
         db_base64 = base64.b64encode(db_content).decode('utf-8')
         
-        files = {
+        return {
             'cambi_vvf_backup.json': {
                 'content': json.dumps({
                     'timestamp': datetime.now().isoformat(),
@@ -572,14 +591,10 @@ def backup_database_cambi():
                 })
             }
         }
-        
-        headers = {
-            'Authorization': f'token {GITHUB_TOKEN}',
-            'Accept': 'application/vnd.github.v3+json'
-        }
-        
-        url = f'https://api.github.com/gists/{GIST_ID_CAMBI}'
-        response = requests.patch(url, headers=headers, json={'files': files})
+    
+    try:
+        # Lettura, codifica e upload sotto il lock di backup_gist (un backup alla volta nel processo)
+        response = scrivi_gist(GITHUB_TOKEN, GIST_ID_CAMBI, prepara_files)
         
         if response.status_code == 200:
             logger.info("✅ Backup cambi completato")
@@ -590,90 +605,210 @@ def backup_database_cambi():
         logger.error(f"❌ Errore backup cambi: {e}")
         return False
 
-def backup_scheduler_cambi():
-    """Scheduler backup per database cambi"""
-    while True:
-        time.sleep(1800)  # 30 minuti
-        backup_database_cambi()
+def restore_database_cambi():
+    """Ripristina il database cambi dal Gist (il disco di Render si azzera a ogni deploy)"""
+    if not GITHUB_TOKEN or not GIST_ID_CAMBI:
+        logger.warning("❌ Token o Gist ID cambi non configurati - restore disabilitato")
+        return False
+    
+    try:
+        response = leggi_gist(GITHUB_TOKEN, GIST_ID_CAMBI)
+        if response.status_code != 200:
+            logger.error("❌ Errore recupero Gist cambi: %s", response.status_code)
+            return False
+        
+        backup_file = response.json()['files'].get('cambi_vvf_backup.json')
+        if not backup_file:
+            logger.warning("❌ File di backup cambi non trovato nel Gist")
+            return False
+        
+        backup_content = json.loads(backup_file['content'])
+        with open(DATABASE_CAMBI, 'wb') as f:
+            f.write(base64.b64decode(backup_content['database_base64']))
+        logger.info("✅ Database cambi ripristinato da backup: %s", backup_content['timestamp'])
+        return True
+        
+    except Exception as e:
+        logger.exception("❌ Errore durante restore cambi: %s", e)
+        return False
+
+def prepara_database_cambi():
+    """All'avvio: ripristino dal Gist (squadre, VVF e stato dei wizard), poi schema aggiornato"""
+    restore_database_cambi()
+    init_db_cambi()
+
+INTERVALLO_BACKUP_CAMBI = 1800  # 30 minuti
+JOB_CAMBI = ('backup_cambi',)   # job di questo bot (lo scheduler può essere condiviso, vedi avvio_unico.py)
+scheduler = Scheduler()
+# Stato dei wizard (user_data) salvato nel database: sopravvive a redeploy e riavvii
+persistenza = PersistenzaSQLite(DATABASE_CAMBI)
+
+# === INGRESSO UNICO (aiohttp): health-check + webhook Telegram ===
+APP_KEY_APPLICATION = web.AppKey("application", Application)
+APP_KEY_SCHEDULER = web.AppKey("scheduler", Scheduler)
+
+# Contatori dell'ingresso webhook, esposti su /stats
+METRICHE_INGRESSO = {
+    "ricevuti": 0,
+    "accodati": 0,
+    "rifiutati_segreto": 0,
+    "rifiutati_coda_piena": 0,
+    "json_non_validi": 0,
+    "profondita_max": 0,
+}
+
+async def home_cambi(request):
+    return web.Response(text=f"🤖 Bot Gestione Cambi VVF - {CAMBI_MODE.upper()} 🟢")
+
+async def health_cambi(request):
+    return web.Response(text="OK")
+
+async def stats_cambi(request):
+    """Metriche di backpressure della coda update e stato dei job pianificati"""
+    coda = request.app[APP_KEY_APPLICATION].update_queue
+    return web.json_response({
+        **METRICHE_INGRESSO,
+        "profondita": coda.qsize(),
+        "capacita": coda.maxsize,
+        "jobs": {
+            job.nome: {
+                "esecuzioni": job.esecuzioni,
+                "errori": job.errori,
+                "saltati": job.saltati,
+                "ultimo_avvio": job.ultimo_avvio.isoformat() if job.ultimo_avvio else None,
+                "ultima_durata": job.ultima_durata,
+                "ultimo_esito": job.ultimo_esito,
+            }
+            for job in request.app[APP_KEY_SCHEDULER].jobs.values()
+            if job.nome in JOB_CAMBI
+        },
+    })
 
-# === WEB SERVER FLASK PER WEBHOOK ===
-app_cambi = Flask(__name__)
+async def webhook(request):
+    """Endpoint per ricevere gli update da Telegram"""
+    METRICHE_INGRESSO["ricevuti"] += 1
 
-@app_cambi.route('/')
-def home_cambi():
-    return "🤖 Bot Gestione Cambi VVF - WEBHOOK 🟢"
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET_CAMBI):
+        METRICHE_INGRESSO["rifiutati_segreto"] += 1
+        return web.Response(status=403, text="Forbidden")
 
-@app_cambi.route('/health')
-def health_cambi():
-    return "OK"
+    try:
+        json_data = await request.json()
+    except ValueError:
+        METRICHE_INGRESSO["json_non_validi"] += 1
+        return web.Response(status=400, text="Bad Request")
 
-@app_cambi.route('/webhook', methods=['POST'])
-def webhook():
-    """Endpoint per ricevere gli update da Telegram"""
-    if request.method == "POST":
-        json_data = request.get_json()
-        
-        # Inserisci l'update nella coda dell'applicazione
-        update = Update.de_json(json_data, application.bot)
-        asyncio.run_coroutine_threadsafe(
-            application.update_queue.put(update), 
-            application._get_running_loop()
+    application = request.app[APP_KEY_APPLICATION]
+    try:
+        application.update_queue.put_nowait(Update.de_json(json_data, application.bot))
+    except asyncio.QueueFull:
+        # Coda piena: Telegram ritenta la consegna più tardi, così la pressione resta fuori dal processo
+        METRICHE_INGRESSO["rifiutati_coda_piena"] += 1
+        logger.warning("⚠️ Coda update piena (%d): update rifiutato", application.update_queue.maxsize)
+        return web.Response(status=503, text="Busy", headers={"Retry-After": "1"})
+
+    METRICHE_INGRESSO["accodati"] += 1
+    METRICHE_INGRESSO["profondita_max"] = max(METRICHE_INGRESSO["profondita_max"], application.update_queue.qsize())
+    return web.Response(text="OK")
+
+def crea_web_app_cambi(application: Application, scheduler_lavori: Scheduler = scheduler) -> web.Application:
+    """Web app del bot cambi; avvio_unico.py la monta come sotto-app del server del bot autoprotettori"""
+    app = web.Application()
+    app[APP_KEY_APPLICATION] = application
+    app[APP_KEY_SCHEDULER] = scheduler_lavori
+    app.add_routes([
+        web.get('/', home_cambi),
+        web.get('/health', health_cambi),
+        web.get('/stats', stats_cambi),
+        web.post(WEBHOOK_PATH, webhook),
+    ])
+    return app
+
+def registra_lavori_cambi(scheduler_lavori: Scheduler):
+    """Backup periodico sullo scheduler asyncio (upload bloccante eseguito in un thread)"""
+    scheduler_lavori.aggiungi('backup_cambi', backup_database_cambi, INTERVALLO_BACKUP_CAMBI,
+                              primo_avvio=INTERVALLO_BACKUP_CAMBI, jitter=30, in_thread=True)
+
+async def avvia_ricezione_cambi(application: Application, modalita: str, url_webhook: str):
+    """Webhook su url_webhook oppure polling (l'Application va costruita con la stessa modalità)"""
+    if modalita == 'webhook':
+        await application.bot.set_webhook(
+            url=url_webhook,
+            secret_token=WEBHOOK_SECRET_CAMBI,
+            allowed_updates=Update.ALL_TYPES
         )
-        
-    return "OK"
+        logger.info("✅ Webhook configurato su %s", url_webhook)
+    else:
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("✅ Polling attivo")
 
-def run_flask_cambi():
-    app_cambi.run(host='0.0.0.0', port=WEBHOOK_PORT, debug=False, use_reloader=False)
+async def esegui_bot_cambi(application: Application):
+    """Un solo server sulla porta: in modalità webhook riceve gli update, in polling serve solo l'health-check"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
 
-# === MAIN CON WEBHOOK ===
-def main_cambi():
-    """Funzione principale del bot cambi con WEBHOOK"""
-    print("🚀 Avvio Bot Gestione Cambi VVF con WEBHOOK...")
-    
-    # Configura application globale
-    global application
-    application = Application.builder().token(BOT_TOKEN_CAMBI).build()
+    registra_lavori_cambi(scheduler)
+
+    await application.initialize()
+
+    runner = web.AppRunner(crea_web_app_cambi(application))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', WEBHOOK_PORT).start()
+    logger.info("✅ Server in ascolto sulla porta %d", WEBHOOK_PORT)
+
+    await avvia_ricezione_cambi(application, CAMBI_MODE, f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+    await application.start()
+    scheduler.avvia()
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("🛑 Arresto bot cambi...")
+        await scheduler.ferma()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await runner.cleanup()
+        await application.shutdown()
+
+# === MAIN ===
+def crea_application_cambi(modalita: str = CAMBI_MODE, richiesta=None) -> Application:
+    """Application con tutti gli handler; `richiesta` permette di condividere il pool HTTP con un altro bot"""
+    # Coda limitata: l'ingresso webhook applica backpressure invece di accumulare update in memoria
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN_CAMBI)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_MAX))
+        .persistence(persistenza)
+    )
+    if modalita == 'webhook':
+        builder = builder.updater(None)
+    if richiesta is not None:
+        builder = builder.request(richiesta)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    application = builder.build()
     
     # Aggiungi handler
+    application.add_handler(TypeHandler(Update, registra_contesto_update), group=-2)
     application.add_handler(CommandHandler("start", start_cambi))
+    application.add_handler(CommandHandler("sql", sql_cambi))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message_cambi))
     application.add_handler(CallbackQueryHandler(button_handler_cambi))
-    
-    # Avvia Flask in thread separato
-    flask_thread = threading.Thread(target=run_flask_cambi, daemon=True)
-    flask_thread.start()
-    
-    # Avvia backup scheduler
-    backup_thread = threading.Thread(target=backup_scheduler_cambi, daemon=True)
-    backup_thread.start()
-    
-    # Configura webhook
-    print(f"🔄 Configurazione webhook su {WEBHOOK_URL}/webhook")
-    
-    try:
-        # Imposta il webhook su Telegram
-        application.bot.set_webhook(
-            url=f"{WEBHOOK_URL}/webhook",
-            # secret_token='WEBHOOK_SECRET'  # Opzionale
-        )
-        
-        print("✅ Webhook configurato con successo!")
-        print("🤖 Bot Cambi VVF in ascolto su webhook...")
-        print("📍 Porta:", WEBHOOK_PORT)
-        
-        # Avvia l'applicazione con webhook
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=WEBHOOK_PORT,
-            webhook_url=f"{WEBHOOK_URL}/webhook",
-            secret_token='WEBHOOK_SECRET'  # Opzionale
-        )
-        
-    except Exception as e:
-        print(f"❌ Errore avvio webhook: {e}")
-        # Fallback a polling in caso di errore
-        print("🔄 Fallback a polling...")
-        application.run_polling()
+    return application
+
+def main_cambi():
+    """Funzione principale del bot cambi (webhook o polling secondo CAMBI_MODE)"""
+    logger.info("🚀 Avvio Bot Gestione Cambi VVF in modalità %s...", CAMBI_MODE.upper())
+
+    if CAMBI_MODE not in ('webhook', 'polling'):
+        raise SystemExit(f"❌ CAMBI_MODE non valido: {CAMBI_MODE} (usa 'webhook' o 'polling')")
+
+    prepara_database_cambi()
+    asyncio.run(esegui_bot_cambi(crea_application_cambi()))
 
 if __name__ == '__main__':
     main_cambi()
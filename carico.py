@@ -0,0 +1,256 @@
+# carico.py
+"""
+Test di carico del bot autoprotettori contro la Bot API finta (finto_telegram.py).
+
+Per ogni modalità (polling e/o webhook) avvia bot.py in un processo separato, con un database
+di prova e TELEGRAM_API_URL puntato alla Bot API finta, poi simula N vigili che usano i pulsanti
+in parallelo con flussi realistici:
+- segna usato: "🔴 Segna Usato" -> categoria -> articolo
+- consultazione: "📋 Inventario" / "🟢 Disponibili" / "🔴 Usati"
+- ricerca: /cerca con un pezzo di seriale
+Ogni passo misura la latenza end-to-end (update consegnato -> risposta del bot arrivata alla
+Bot API); alla fine riporta throughput e latenze p50/p95/p99 per passo.
+
+Uso:
+    python carico.py --utenti 20 --durata 30
+    python carico.py --modalita webhook --utenti 50 --pausa 0 --salva carico.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# Prima di importare il bot: lo schema del database di prova viene creato dalle sue migrazioni
+_cartella = tempfile.TemporaryDirectory(prefix="carico_bot_")
+os.environ['DATABASE_NAME'] = os.path.join(_cartella.name, 'import.db')
+os.environ.setdefault('LOG_LIVELLO', 'ERROR')
+
+import bot
+from finto_telegram import TelegramFinto
+
+PORTA_API = 8081
+PORTA_BOT = 10080
+TIMEOUT_AVVIO = 30
+TIMEOUT_RISPOSTA = 15
+PRIMO_UTENTE = 2_000_000
+# Pesi dei flussi: dopo un intervento si segna soprattutto il materiale usato
+FLUSSI = {"segna_usato": 5, "consultazione": 4, "ricerca": 1}
+VISTE_CONSULTAZIONE = ["📋 Inventario", "🟢 Disponibili", "🔴 Usati"]
+
+
+def percentile(valori, q):
+    ordinati = sorted(valori)
+    return ordinati[max(0, math.ceil(q * len(ordinati)) - 1)]
+
+
+# === DATABASE DI PROVA ===
+def prepara_database(percorso, utenti, articoli, seme=42):
+    """Schema del bot, `utenti` vigili approvati e `articoli` articoli (quasi tutti disponibili)"""
+    bot.DATABASE_NAME = percorso
+    bot.init_db()
+    rnd = random.Random(seme)
+    categorie = list(bot.CATEGORIE)
+    righe = []
+    for i in range(articoli):
+        categoria = rnd.choice(categorie)
+        sede = rnd.choice(list(bot.SEDI))
+        stato = "disponibile" if rnd.random() < 0.85 else "usato"
+        righe.append((f"{bot.get_prefisso_categoria(categoria)}_{i:05d}_{sede.upper()}", categoria, sede, stato))
+    conn = sqlite3.connect(percorso)
+    try:
+        with conn:
+            conn.executemany("INSERT INTO articoli (seriale, categoria, sede, stato) VALUES (?, ?, ?, ?)", righe)
+            conn.executemany(
+                "INSERT INTO utenti (user_id, nome, ruolo, data_approvazione) VALUES (?, ?, 'user', CURRENT_TIMESTAMP)",
+                [(PRIMO_UTENTE + i, f"Vigile {i}") for i in range(utenti)])
+    finally:
+        conn.close()
+
+
+async def avvia_bot(modalita, percorso_db, telegram, log):
+    ambiente = dict(
+        os.environ,
+        BOT_TOKEN="123456:TOKEN-FINTO",
+        TELEGRAM_API_URL=telegram.url,
+        DATABASE_NAME=percorso_db,
+        BOT_MODE=modalita,
+        PORT=str(PORTA_BOT),
+        WEBHOOK_URL=f"http://127.0.0.1:{PORTA_BOT}",
+        KEEPALIVE_URL=f"http://127.0.0.1:{PORTA_BOT}",
+        LOG_LIVELLO="WARNING",
+        GITHUB_TOKEN="",
+    )
+    processo = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py"),
+        env=ambiente, stdout=log, stderr=log)
+    # Pronto quando chiama getUpdates (polling) o setWebhook (webhook)
+    attesa_pronto = asyncio.ensure_future(telegram.pronto.wait())
+    attesa_uscita = asyncio.ensure_future(processo.wait())
+    await asyncio.wait({attesa_pronto, attesa_uscita}, timeout=TIMEOUT_AVVIO, return_when=asyncio.FIRST_COMPLETED)
+    attesa_uscita.cancel()
+    if not telegram.pronto.is_set():
+        attesa_pronto.cancel()
+        if processo.returncode is None:
+            processo.kill()
+        raise RuntimeError(f"Il bot non è partito in modalità {modalita} (log: {log.name})")
+    return processo
+
+
+async def ferma_bot(processo):
+    if processo.returncode is not None:
+        return
+    processo.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(processo.wait(), 20)
+    except asyncio.TimeoutError:
+        processo.kill()
+        await processo.wait()
+
+
+# === VIGILI SIMULATI ===
+class Misure:
+    def __init__(self):
+        self.latenze = defaultdict(list)    # passo -> secondi
+        self.timeout = Counter()
+        self.flussi = Counter()
+
+
+class Vigile:
+    def __init__(self, telegram, user_id, misure, pausa, seme):
+        self.telegram = telegram
+        self.user_id = user_id
+        self.misure = misure
+        self.pausa = pausa
+        self.rnd = random.Random(seme)
+
+    async def pensa(self):
+        if self.pausa:
+            await asyncio.sleep(self.rnd.uniform(self.pausa / 2, self.pausa * 1.5))
+
+    async def passo(self, nome, invia):
+        coda = self.telegram.code_chat[self.user_id]
+        while not coda.empty():
+            coda.get_nowait()   # risposte in più del passo precedente
+        inizio = time.perf_counter()
+        invia()
+        try:
+            risposta = await asyncio.wait_for(coda.get(), TIMEOUT_RISPOSTA)
+        except asyncio.TimeoutError:
+            self.misure.timeout[nome] += 1
+            return None
+        self.misure.latenze[nome].append(risposta.istante - inizio)
+        return risposta
+
+    async def segna_usato(self):
+        risposta = await self.passo("menu_segna_usato", lambda: self.telegram.invia_messaggio(self.user_id, "🔴 Segna Usato"))
+        for nome in ("scelta_categoria", "conferma_usato"):
+            if risposta is None or not risposta.pulsanti:
+                return
+            await self.pensa()
+            message_id, data = risposta.messaggio["message_id"], self.rnd.choice(risposta.pulsanti)
+            risposta = await self.passo(nome, lambda: self.telegram.premi_pulsante(self.user_id, message_id, data))
+
+    async def consultazione(self):
+        testo = self.rnd.choice(VISTE_CONSULTAZIONE)
+        await self.passo("consultazione", lambda: self.telegram.invia_messaggio(self.user_id, testo))
+
+    async def ricerca(self):
+        testo = f"/cerca {self.rnd.choice(['BOMB', 'MAS', 'ER', 'SPAL'])}_{self.rnd.randint(0, 99):02d}"
+        await self.passo("ricerca", lambda: self.telegram.invia_messaggio(self.user_id, testo))
+
+    async def esegui(self, scadenza):
+        nomi, pesi = zip(*FLUSSI.items())
+        await asyncio.sleep(self.rnd.uniform(0, self.pausa))
+        while time.perf_counter() < scadenza:
+            flusso = self.rnd.choices(nomi, pesi)[0]
+            self.misure.flussi[flusso] += 1
+            await getattr(self, flusso)()
+            await self.pensa()
+
+
+# === ESECUZIONE ===
+async def prova_modalita(modalita, argomenti):
+    percorso_db = os.path.join(_cartella.name, f"carico_{modalita}.db")
+    prepara_database(percorso_db, argomenti.utenti, argomenti.articoli)
+
+    telegram = TelegramFinto(PORTA_API)
+    await telegram.avvia()
+    log = open(os.path.join(_cartella.name, f"bot_{modalita}.log"), "w")
+    try:
+        processo = await avvia_bot(modalita, percorso_db, telegram, log)
+        try:
+            misure = Misure()
+            vigili = [Vigile(telegram, PRIMO_UTENTE + i, misure, argomenti.pausa, seme=i)
+                      for i in range(argomenti.utenti)]
+            inizio = time.perf_counter()
+            scadenza = inizio + argomenti.durata
+            await asyncio.gather(*(vigile.esegui(scadenza) for vigile in vigili))
+            durata = time.perf_counter() - inizio
+        finally:
+            await ferma_bot(processo)
+    finally:
+        log.close()
+        await telegram.ferma()
+    return riepilogo(modalita, misure, durata, telegram)
+
+
+def riepilogo(modalita, misure, durata, telegram):
+    tutte = [l for latenze in misure.latenze.values() for l in latenze]
+    risultato = {
+        "passi": len(tutte),
+        "passi_al_secondo": round(len(tutte) / durata, 1),
+        "timeout": sum(misure.timeout.values()),
+        "flussi": dict(misure.flussi),
+        "chiamate_api": dict(telegram.chiamate),
+        "latenze": {},
+    }
+    print(f"\n=== {modalita.upper()}: {len(tutte)} passi in {durata:.1f}s = {risultato['passi_al_secondo']} passi/s, "
+          f"timeout {risultato['timeout']} ===")
+    for nome, latenze in sorted(misure.latenze.items()) + [("TUTTI", tutte)]:
+        if not latenze:
+            continue
+        valori = {q: round(percentile(latenze, v) * 1000, 1) for q, v in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))}
+        valori["max"] = round(max(latenze) * 1000, 1)
+        risultato["latenze"][nome] = {"n": len(latenze), **valori}
+        print(f"  {nome:<18} n {len(latenze):>6}  p50 {valori['p50']:>8.1f} ms  p95 {valori['p95']:>8.1f} ms  "
+              f"p99 {valori['p99']:>8.1f} ms  max {valori['max']:>8.1f} ms")
+    print(telegram.riepilogo())
+    return risultato
+
+
+async def esegui_carico(argomenti):
+    modalita = ["polling", "webhook"] if argomenti.modalita == "entrambe" else [argomenti.modalita]
+    return {m: await prova_modalita(m, argomenti) for m in modalita}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test di carico del bot contro una Bot API finta")
+    parser.add_argument("--modalita", choices=["polling", "webhook", "entrambe"], default="entrambe")
+    parser.add_argument("--utenti", type=int, default=20, help="vigili simulati in parallelo")
+    parser.add_argument("--durata", type=float, default=30, help="secondi di carico per modalità")
+    parser.add_argument("--pausa", type=float, default=0.5, help="tempo medio di reazione tra un tap e l'altro (s)")
+    parser.add_argument("--articoli", type=int, default=500, help="articoli nel database di prova")
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati")
+    argomenti = parser.parse_args()
+
+    risultati = {
+        "meta": {"data": datetime.now().isoformat(timespec='seconds'), **vars(argomenti)},
+        "modalita": asyncio.run(esegui_carico(argomenti)),
+    }
+    if argomenti.salva:
+        with open(argomenti.salva, "w", encoding="utf-8") as f:
+            json.dump(risultati, f, ensure_ascii=False, indent=2)
+        print(f"💾 Risultati salvati in {argomenti.salva}")
+
+
+if __name__ == '__main__':
+    main()
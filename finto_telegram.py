@@ -0,0 +1,269 @@
+# finto_telegram.py
+"""
+Bot API di Telegram finta, in locale, per i test di carico (vedi carico.py).
+
+Implementa quello che usano i bot: getMe, getUpdates (long polling), setWebhook/deleteWebhook,
+sendMessage, editMessageText, answerCallbackQuery, sendDocument. I metodi non previsti
+rispondono comunque ok (e vengono contati) per non interrompere un test a metà.
+
+Il bot la raggiunge con TELEGRAM_API_URL=http://127.0.0.1:8081 (base_url dell'Application).
+Gli update si iniettano con invia_update(): finiscono in coda per getUpdates oppure,
+se il bot ha impostato un webhook, vengono inviati in POST come farebbe Telegram.
+Ogni risposta del bot verso una chat viene messa nella coda di quella chat.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiohttp import web
+
+ID_BOT = 100000001
+# Invii webhook paralleli se il bot non indica max_connections (stesso default di Telegram)
+MAX_CONNESSIONI_WEBHOOK = 40
+TENTATIVI_WEBHOOK = 3
+
+
+class RispostaBot:
+    """Una chiamata del bot verso una chat, con l'istante di arrivo (time.perf_counter)"""
+
+    def __init__(self, metodo, parametri, messaggio):
+        self.metodo = metodo
+        self.parametri = parametri
+        self.messaggio = messaggio
+        self.istante = time.perf_counter()
+
+    @property
+    def pulsanti(self):
+        """callback_data dei pulsanti inline presenti nella risposta"""
+        tastiera = self.parametri.get("reply_markup") or {}
+        return [pulsante["callback_data"]
+                for riga in tastiera.get("inline_keyboard", [])
+                for pulsante in riga if "callback_data" in pulsante]
+
+
+class TelegramFinto:
+    def __init__(self, porta=8081):
+        self.porta = porta
+        self._runner = None
+        self._session = None
+        self._id_update = itertools.count(1)
+        self._id_messaggio = defaultdict(lambda: itertools.count(1))
+        self._id_callback = itertools.count(1)
+
+        self._in_attesa = []                # update non ancora confermati da getUpdates
+        self._nuovi_update = asyncio.Event()
+        self.webhook = None                 # (url, segreto) impostati da setWebhook
+        self._invii_webhook = asyncio.Semaphore(MAX_CONNESSIONI_WEBHOOK)
+        self._task_webhook = set()
+
+        self.messaggi = {}                  # (chat, message_id) -> ultimo messaggio del bot
+        self.code_chat = defaultdict(asyncio.Queue)   # chat -> RispostaBot
+        self.pronto = asyncio.Event()       # il bot ha iniziato a ricevere update
+
+        # Statistiche
+        self.chiamate = Counter()
+        self.metodi_sconosciuti = Counter()
+        self.errori_webhook = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.porta}"
+
+    # === CICLO DI VITA ===
+    async def avvia(self):
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.add_routes([web.post('/bot{token}/{metodo}', self._gestisci),
+                        web.get('/bot{token}/{metodo}', self._gestisci)])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.porta).start()
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def ferma(self):
+        for task in self._task_webhook:
+            task.cancel()
+        await asyncio.gather(*self._task_webhook, return_exceptions=True)
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    # === INGRESSO UPDATE ===
+    def _utente(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Vigile {user_id}", "username": f"vigile{user_id}"}
+
+    def invia_messaggio(self, user_id, testo):
+        """Simula un messaggio di testo dell'utente (chat privata: chat id = user id)"""
+        messaggio = {
+            "message_id": next(self._id_messaggio[user_id]),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Vigile {user_id}"},
+            "from": self._utente(user_id),
+            "text": testo,
+        }
+        if testo.startswith('/'):
+            comando = testo.split()[0]
+            messaggio["entities"] = [{"type": "bot_command", "offset": 0, "length": len(comando)}]
+        return self.invia_update({"message": messaggio})
+
+    def premi_pulsante(self, user_id, message_id, data):
+        """Simula il tap su un pulsante inline di un messaggio inviato dal bot"""
+        return self.invia_update({"callback_query": {
+            "id": str(next(self._id_callback)),
+            "from": self._utente(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self.messaggi[(user_id, message_id)],
+        }})
+
+    def invia_update(self, contenuto):
+        update = {"update_id": next(self._id_update), **contenuto}
+        if self.webhook:
+            task = asyncio.get_running_loop().create_task(self._invia_webhook(update))
+            self._task_webhook.add(task)
+            task.add_done_callback(self._task_webhook.discard)
+        else:
+            self._in_attesa.append(update)
+            self._nuovi_update.set()
+        return update["update_id"]
+
+    async def _invia_webhook(self, update):
+        url, segreto = self.webhook
+        intestazioni = {"X-Telegram-Bot-Api-Secret-Token": segreto} if segreto else {}
+        async with self._invii_webhook:
+            for tentativo in range(TENTATIVI_WEBHOOK):
+                try:
+                    async with self._session.post(url, json=update, headers=intestazioni) as risposta:
+                        if risposta.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                # Come Telegram: nuovo tentativo dopo un errore o una risposta non 200 (es. 503 con coda piena)
+                await asyncio.sleep(0.5 * (tentativo + 1))
+        self.errori_webhook += 1
+
+    # === BOT API ===
+    @staticmethod
+    async def _parametri(request):
+        # PTB invia form-urlencoded (o multipart con file): le stringhe così come sono,
+        # oggetti e liste (reply_markup, allowed_updates...) serializzati in JSON
+        if request.content_type == 'application/json':
+            return await request.json()
+        parametri = {}
+        for nome, valore in (await request.post()).items():
+            if isinstance(valore, str):
+                if valore[:1] in ('{', '['):
+                    try:
+                        valore = json.loads(valore)
+                    except ValueError:
+                        pass
+            else:
+                valore = valore.filename
+            parametri[nome] = valore
+        return parametri
+
+    async def _gestisci(self, request):
+        metodo = request.match_info['metodo']
+        parametri = await self._parametri(request)
+        self.chiamate[metodo] += 1
+        gestore = getattr(self, f"_api_{metodo}", None)
+        if gestore is None:
+            self.metodi_sconosciuti[metodo] += 1
+            return web.json_response({"ok": True, "result": True})
+        return web.json_response({"ok": True, "result": await gestore(parametri)})
+
+    async def _api_getMe(self, parametri):
+        return {"id": ID_BOT, "is_bot": True, "first_name": "Bot finto", "username": "bot_finto_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": True}
+
+    async def _api_getUpdates(self, parametri):
+        self.pronto.set()
+        offset = int(parametri.get("offset", 0))
+        if offset:
+            self._in_attesa = [u for u in self._in_attesa if u["update_id"] >= offset]
+        timeout = float(parametri.get("timeout", 0))
+        if not self._in_attesa and timeout:
+            self._nuovi_update.clear()
+            try:
+                await asyncio.wait_for(self._nuovi_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._in_attesa[:int(parametri.get("limit", 100))]
+
+    async def _api_setWebhook(self, parametri):
+        self.webhook = (parametri["url"], parametri.get("secret_token"))
+        self._invii_webhook = asyncio.Semaphore(int(parametri.get("max_connections", MAX_CONNESSIONI_WEBHOOK)))
+        # Update arrivati prima del webhook: Telegram li consegna appena impostato
+        in_attesa, self._in_attesa = self._in_attesa, []
+        for update in in_attesa:
+            self.invia_update({k: v for k, v in update.items() if k != "update_id"})
+        self.pronto.set()
+        return True
+
+    async def _api_deleteWebhook(self, parametri):
+        self.webhook = None
+        if str(parametri.get("drop_pending_updates")).lower() == "true":
+            self._in_attesa = []
+        return True
+
+    async def _api_getWebhookInfo(self, parametri):
+        url = self.webhook[0] if self.webhook else ""
+        return {"url": url, "has_custom_certificate": False, "pending_update_count": len(self._in_attesa)}
+
+    def _messaggio_bot(self, chat_id, message_id, **contenuto):
+        messaggio = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": ID_BOT, "is_bot": True, "first_name": "Bot finto", "username": "bot_finto_bot"},
+            **contenuto,
+        }
+        self.messaggi[(chat_id, message_id)] = messaggio
+        return messaggio
+
+    def _consegna(self, metodo, parametri, chat_id, messaggio):
+        self.code_chat[chat_id].put_nowait(RispostaBot(metodo, parametri, messaggio))
+
+    async def _api_sendMessage(self, parametri):
+        chat_id = int(parametri["chat_id"])
+        contenuto = {"text": parametri["text"]}
+        if "inline_keyboard" in (parametri.get("reply_markup") or {}):
+            contenuto["reply_markup"] = parametri["reply_markup"]
+        messaggio = self._messaggio_bot(chat_id, next(self._id_messaggio[chat_id]), **contenuto)
+        self._consegna("sendMessage", parametri, chat_id, messaggio)
+        return messaggio
+
+    async def _api_editMessageText(self, parametri):
+        if "inline_message_id" in parametri:
+            return True
+        chat_id = int(parametri["chat_id"])
+        contenuto = {"text": parametri["text"], "edit_date": int(time.time())}
+        if parametri.get("reply_markup"):
+            contenuto["reply_markup"] = parametri["reply_markup"]
+        messaggio = self._messaggio_bot(chat_id, int(parametri["message_id"]), **contenuto)
+        self._consegna("editMessageText", parametri, chat_id, messaggio)
+        return messaggio
+
+    async def _api_answerCallbackQuery(self, parametri):
+        return True
+
+    async def _api_sendDocument(self, parametri):
+        chat_id = int(parametri["chat_id"])
+        nome = parametri.get("document") if isinstance(parametri.get("document"), str) else "documento"
+        documento = {"file_id": f"doc{next(self._id_callback)}", "file_unique_id": "u", "file_name": nome}
+        messaggio = self._messaggio_bot(chat_id, next(self._id_messaggio[chat_id]), document=documento)
+        self._consegna("sendDocument", parametri, chat_id, messaggio)
+        return messaggio
+
+    def riepilogo(self):
+        righe = [f"📡 Chiamate Bot API: {sum(self.chiamate.values())}"]
+        righe += [f"  {metodo}: {numero}" for metodo, numero in self.chiamate.most_common()]
+        if self.metodi_sconosciuti:
+            righe.append(f"  ⚠️ metodi non simulati: {dict(self.metodi_sconosciuti)}")
+        if self.errori_webhook:
+            righe.append(f"  ❌ update webhook non consegnati: {self.errori_webhook}")
+        return "\n".join(righe)
+
@@ -0,0 +1,183 @@
+# log_strutturato.py
+"""
+Logging strutturato e non bloccante per i bot.
+
+- nessuna scrittura dal loop asyncio: il logger radice ha solo una QueueHandler,
+  la scrittura su stdout avviene nel thread di un QueueListener
+- una riga JSON per evento (ts, livello, logger, messaggio, eccezione) con update_id,
+  user_id e chat_id dell'update in elaborazione; LOG_FORMATO=testo per la lettura in locale
+- livelli per modulo: LOG_LIVELLI="httpx=WARNING,bot.inventario=DEBUG"
+- campionamento delle sorgenti verbose: LOG_CAMPIONAMENTO="aiohttp.access=20" tiene
+  1 messaggio su 20 sotto WARNING (avvisi ed errori passano sempre)
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+FORMATO_TESTO = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Default pensati per Render: le richieste Bot API di httpx (una per ogni getUpdates) e gli
+# accessi a /health dei ping esterni sono la maggior parte delle righe, ne basta un campione
+LIVELLI_PREDEFINITI = {"httpcore": "WARNING"}
+CAMPIONAMENTO_PREDEFINITO = {"httpx": 50, "aiohttp.access": 20}
+
+CAMPI_CONTESTO = ("update_id", "user_id", "chat_id")
+
+contesto_update = contextvars.ContextVar("contesto_update", default=None)
+
+_listener = None
+
+
+def _leggi_coppie(testo):
+    """'a=1,b=2' -> {'a': '1', 'b': '2'} (voci malformate ignorate)"""
+    coppie = {}
+    for voce in testo.split(','):
+        nome, sep, valore = voce.partition('=')
+        if sep and nome.strip() and valore.strip():
+            coppie[nome.strip()] = valore.strip()
+    return coppie
+
+
+# === CONTESTO UPDATE ===
+async def registra_contesto_update(update, context):
+    """TypeHandler (group -2): i log emessi durante l'update riportano i suoi id"""
+    contesto = {"update_id": getattr(update, 'update_id', None)}
+    utente = getattr(update, 'effective_user', None)
+    chat = getattr(update, 'effective_chat', None)
+    if utente:
+        contesto["user_id"] = utente.id
+    if chat:
+        contesto["chat_id"] = chat.id
+    # Ogni update gira nel proprio task asyncio: il valore non si mescola tra update concorrenti
+    contesto_update.set(contesto)
+
+
+class FiltroContesto(logging.Filter):
+    def filter(self, record):
+        contesto = contesto_update.get()
+        if contesto:
+            for campo, valore in contesto.items():
+                if not hasattr(record, campo):
+                    setattr(record, campo, valore)
+        return True
+
+
+class FiltroCampionamento(logging.Filter):
+    """Tiene 1 record su N per i logger indicati (e i loro figli), solo sotto WARNING"""
+
+    def __init__(self, campionamento):
+        super().__init__()
+        self.campionamento = campionamento
+        self._passi = {}        # nome logger -> N (cache della ricerca per prefisso)
+        self._contatori = {}
+        self.scartati = 0
+
+    def _passo(self, nome):
+        passo = self._passi.get(nome)
+        if passo is None:
+            passo = 1
+            lunghezza = -1
+            for prefisso, n in self.campionamento.items():
+                if (nome == prefisso or nome.startswith(prefisso + '.')) and len(prefisso) > lunghezza:
+                    passo, lunghezza = n, len(prefisso)
+            self._passi[nome] = passo
+        return passo
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        passo = self._passo(record.name)
+        if passo <= 1:
+            return True
+        conteggio = self._contatori.get(record.name, 0)
+        self._contatori[record.name] = conteggio + 1
+        if conteggio % passo == 0:
+            return True
+        self.scartati += 1
+        return False
+
+
+# === FORMATO ===
+class FormatterJSON(logging.Formatter):
+    def format(self, record):
+        voce = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "livello": record.levelname,
+            "logger": record.name,
+            "messaggio": record.getMessage(),
+        }
+        for campo in CAMPI_CONTESTO:
+            valore = getattr(record, campo, None)
+            if valore is not None:
+                voce[campo] = valore
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            voce["eccezione"] = record.exc_text
+        return json.dumps(voce, ensure_ascii=False, default=str)
+
+
+class _QueueHandlerStrutturato(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # A differenza della QueueHandler standard non formatto qui: il messaggio viene solo
+        # risolto (gli argomenti potrebbero cambiare prima della scrittura) e il traceback
+        # resta separato, così il formatter del listener lo mette nel suo campo
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# === CONFIGURAZIONE ===
+def configura_logging():
+    """
+    Sostituisce gli handler del logger radice con la coda verso il listener.
+    Idempotente: se entrambi i bot girano nello stesso processo la configurazione resta una
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    gestore = logging.StreamHandler(sys.stdout)
+    if os.environ.get('LOG_FORMATO', 'json').lower() == 'testo':
+        gestore.setFormatter(logging.Formatter(FORMATO_TESTO))
+    else:
+        gestore.setFormatter(FormatterJSON())
+
+    campionamento = dict(CAMPIONAMENTO_PREDEFINITO)
+    for nome, valore in _leggi_coppie(os.environ.get('LOG_CAMPIONAMENTO', '')).items():
+        if valore.isdigit():
+            campionamento[nome] = int(valore)
+
+    coda = queue.SimpleQueue()
+    gestore_coda = _QueueHandlerStrutturato(coda)
+    gestore_coda.addFilter(FiltroContesto())
+    gestore_coda.addFilter(FiltroCampionamento(campionamento))
+
+    radice = logging.getLogger()
+    radice.handlers[:] = [gestore_coda]
+    radice.setLevel(os.environ.get('LOG_LIVELLO', 'INFO').upper())
+
+    livelli = dict(LIVELLI_PREDEFINITI)
+    livelli.update(_leggi_coppie(os.environ.get('LOG_LIVELLI', '')))
+    for nome, livello in livelli.items():
+        try:
+            logging.getLogger(nome).setLevel(livello.upper())
+        except ValueError:
+            logging.getLogger(__name__).warning("Livello di log non valido per %s: %s", nome, livello)
+
+    _listener = logging.handlers.QueueListener(coda, gestore, respect_handler_level=True)
+    _listener.start()
+    # Allo spegnimento il listener svuota la coda prima di chiudere
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,415 @@
+# metriche.py
+"""
+Metriche in formato Prometheus (text exposition 0.0.4) senza dipendenze esterne.
+
+- Contatore, Gauge e Istogramma con etichette; ogni metrica accetta al massimo
+  `max_serie` combinazioni di etichette, le successive finiscono nella serie "altro"
+  (cardinalità limitata anche se arriva un valore imprevisto)
+- ConnessioneMisurata: connessione sqlite3 che misura ogni execute e commit; tiene le
+  statistiche per database e istruzione (report_sql) e registra le query lente con il loro piano
+- RichiestaTelegramMisurata: HTTPXRequest che misura latenza ed esito delle chiamate Bot API
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+MAX_SERIE = 100
+ETICHETTA_FUORI_LIMITE = "altro"
+
+# Secondi: dalle query SQLite (sotto il millisecondo) alle chiamate HTTP lente
+BUCKET_LATENZA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(valore):
+    return str(valore).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatta_etichette(nomi, valori, extra=None):
+    coppie = list(zip(nomi, valori))
+    if extra:
+        coppie.append(extra)
+    if not coppie:
+        return ""
+    return "{" + ",".join(f'{nome}="{_escape(valore)}"' for nome, valore in coppie) + "}"
+
+
+def _formatta_numero(valore):
+    if valore == float("inf"):
+        return "+Inf"
+    if float(valore).is_integer():
+        return str(int(valore))
+    return repr(float(valore))
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nome, descrizione, etichette=(), max_serie=MAX_SERIE):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self.max_serie = max_serie
+        self._serie = {}
+        self._lock = threading.Lock()    # aggiornate anche dai thread (job in_thread, export)
+
+    def _chiave(self, etichette):
+        chiave = tuple(str(etichette.get(nome, "")) for nome in self.etichette)
+        if chiave not in self._serie and len(self._serie) >= self.max_serie:
+            chiave = (ETICHETTA_FUORI_LIMITE,) * len(self.etichette)
+        return chiave
+
+    def _intestazione(self):
+        return [f"# HELP {self.nome} {self.descrizione}", f"# TYPE {self.nome} {self.tipo}"]
+
+
+class Contatore(_Metrica):
+    tipo = "counter"
+
+    def inc(self, valore=1, **etichette):
+        with self._lock:
+            chiave = self._chiave(etichette)
+            self._serie[chiave] = self._serie.get(chiave, 0) + valore
+
+    def esporta(self):
+        with self._lock:
+            serie = list(self._serie.items())
+        return self._intestazione() + [
+            f"{self.nome}{_formatta_etichette(self.etichette, chiave)} {_formatta_numero(valore)}"
+            for chiave, valore in serie]
+
+
+class Gauge(_Metrica):
+    tipo = "gauge"
+
+    def __init__(self, nome, descrizione, etichette=(), max_serie=MAX_SERIE, funzione=None):
+        super().__init__(nome, descrizione, etichette, max_serie)
+        # Letto al momento dello scrape: restituisce un numero, oppure {valori etichette: numero}
+        self.funzione = funzione
+
+    def set(self, valore, **etichette):
+        with self._lock:
+            self._serie[self._chiave(etichette)] = valore
+
+    def esporta(self):
+        if self.funzione is not None:
+            try:
+                valore = self.funzione()
+            except Exception:
+                valore = None
+            if isinstance(valore, dict):
+                serie = list(valore.items())[:self.max_serie]
+            else:
+                serie = [] if valore is None else [((), valore)]
+        else:
+            with self._lock:
+                serie = list(self._serie.items())
+        return self._intestazione() + [
+            f"{self.nome}{_formatta_etichette(self.etichette, chiave)} {_formatta_numero(valore)}"
+            for chiave, valore in serie]
+
+
+class Istogramma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome, descrizione, etichette=(), max_serie=MAX_SERIE, bucket=BUCKET_LATENZA):
+        super().__init__(nome, descrizione, etichette, max_serie)
+        self.bucket = tuple(sorted(bucket))
+
+    def osserva(self, valore, **etichette):
+        with self._lock:
+            chiave = self._chiave(etichette)
+            serie = self._serie.get(chiave)
+            if serie is None:
+                # [conteggi per bucket (non cumulativi), somma, totale]
+                serie = self._serie[chiave] = [[0] * len(self.bucket), 0.0, 0]
+            for indice, limite in enumerate(self.bucket):
+                if valore <= limite:
+                    serie[0][indice] += 1
+                    break
+            serie[1] += valore
+            serie[2] += 1
+
+    @contextmanager
+    def misura(self, **etichette):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(time.perf_counter() - inizio, **etichette)
+
+    def esporta(self):
+        with self._lock:
+            serie = [(chiave, (list(valori[0]), valori[1], valori[2])) for chiave, valori in self._serie.items()]
+        righe = self._intestazione()
+        for chiave, (conteggi, somma, totale) in serie:
+            cumulativo = 0
+            for limite, conteggio in zip(self.bucket, conteggi):
+                cumulativo += conteggio
+                righe.append(f"{self.nome}_bucket"
+                             f"{_formatta_etichette(self.etichette, chiave, ('le', _formatta_numero(limite)))} {cumulativo}")
+            righe.append(f"{self.nome}_bucket{_formatta_etichette(self.etichette, chiave, ('le', '+Inf'))} {totale}")
+            righe.append(f"{self.nome}_sum{_formatta_etichette(self.etichette, chiave)} {_formatta_numero(somma)}")
+            righe.append(f"{self.nome}_count{_formatta_etichette(self.etichette, chiave)} {totale}")
+        return righe
+
+
+class Registro:
+    def __init__(self):
+        self._metriche = {}
+
+    def _registra(self, metrica):
+        if metrica.nome in self._metriche:
+            raise ValueError(f"Metrica già registrata: {metrica.nome}")
+        self._metriche[metrica.nome] = metrica
+        return metrica
+
+    def contatore(self, nome, descrizione, etichette=(), **opzioni):
+        return self._registra(Contatore(nome, descrizione, etichette, **opzioni))
+
+    def gauge(self, nome, descrizione, etichette=(), **opzioni):
+        return self._registra(Gauge(nome, descrizione, etichette, **opzioni))
+
+    def istogramma(self, nome, descrizione, etichette=(), **opzioni):
+        return self._registra(Istogramma(nome, descrizione, etichette, **opzioni))
+
+    def esporta(self):
+        """Testo per l'endpoint /metrics"""
+        righe = []
+        for metrica in self._metriche.values():
+            righe.extend(metrica.esporta())
+        return "\n".join(righe) + "\n"
+
+
+registro = Registro()
+
+# === SQL ===
+SQL_DURATA = registro.istogramma(
+    "sql_query_durata_secondi", "Durata di execute/executemany per database e istruzione (verbo + tabella)",
+    ("database", "istruzione"))
+
+_RE_TABELLA = {
+    "SELECT": re.compile(r"\bFROM\s+([\w\"]+)", re.IGNORECASE),
+    "DELETE": re.compile(r"\bFROM\s+([\w\"]+)", re.IGNORECASE),
+    "INSERT": re.compile(r"\bINTO\s+([\w\"]+)", re.IGNORECASE),
+    "UPDATE": re.compile(r"^\s*UPDATE\s+(?:OR\s+\w+\s+)?([\w\"]+)", re.IGNORECASE),
+    "PRAGMA": re.compile(r"^\s*PRAGMA\s+(\w+)", re.IGNORECASE),
+}
+
+
+@lru_cache(maxsize=512)
+def etichetta_sql(sql):
+    """'SELECT articoli', 'UPDATE utenti', 'PRAGMA quick_check'...: valori in numero limitato, non il testo SQL"""
+    parole = sql.split(None, 1)
+    if not parole:
+        return "vuota"
+    verbo = parole[0].upper()
+    espressione = _RE_TABELLA.get(verbo)
+    if espressione is None:
+        return verbo
+    trovato = espressione.search(sql)
+    return f"{verbo} {trovato.group(1).strip(chr(34)).lower()}" if trovato else verbo
+
+
+# === TRACCIAMENTO SQL ===
+# Statistiche per database e istruzione (testo normalizzato) e registro delle query lente con EXPLAIN QUERY PLAN.
+# Con i due bot nello stesso processo (avvio_unico.py) ognuno vede solo le istruzioni del proprio database
+SOGLIA_QUERY_LENTA = float(os.environ.get('SQL_SOGLIA_LENTA_MS', 50)) / 1000
+MAX_ISTRUZIONI_TRACCIATE = 500
+ALTRE_ISTRUZIONI = "(altre istruzioni)"
+
+_statistiche_sql = {}   # (database, sql normalizzato) -> [conteggio, tempo totale, tempo massimo, istruzioni SQLite]
+_lock_statistiche_sql = threading.Lock()
+query_lente = deque(maxlen=20)   # (database, quando, durata, sql, piano, istruzioni SQLite eseguite)
+
+_RE_SEGNAPOSTI = re.compile(r"\?(?:\s*,\s*\?)+")
+_VERBI_EXPLAIN = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+@lru_cache(maxsize=1024)
+def normalizza_sql(sql):
+    """Spazi compattati e liste IN (?, ?, ?) di lunghezza variabile ridotte a una sola forma"""
+    return _RE_SEGNAPOSTI.sub("?, ...", " ".join(sql.split()))
+
+
+def _registra_sql(database, sql, durata, istruzioni):
+    chiave = (database, normalizza_sql(sql))
+    with _lock_statistiche_sql:
+        voce = _statistiche_sql.get(chiave)
+        if voce is None:
+            if len(_statistiche_sql) >= MAX_ISTRUZIONI_TRACCIATE:
+                chiave = (database, ALTRE_ISTRUZIONI)
+            voce = _statistiche_sql.setdefault(chiave, [0, 0.0, 0.0, 0])
+        voce[0] += 1
+        voce[1] += durata
+        voce[2] = max(voce[2], durata)
+        voce[3] += istruzioni
+
+
+def _piano_query(connessione, sql, parametri):
+    """EXPLAIN QUERY PLAN su un cursore non misurato (niente ricorsione nelle statistiche)"""
+    if sql.split(None, 1)[0].upper() not in _VERBI_EXPLAIN:
+        return ""
+    try:
+        cursore = sqlite3.Cursor(connessione)
+        righe = cursore.execute("EXPLAIN QUERY PLAN " + sql, parametri).fetchall()
+        cursore.close()
+    except sqlite3.Error as e:
+        return f"(piano non disponibile: {e})"
+    return " | ".join(riga[3] for riga in righe)
+
+
+def _registra_query_lenta(connessione, sql, parametri, durata, istruzioni):
+    piano = _piano_query(connessione, sql, parametri)
+    database = getattr(connessione, "database", None)
+    query_lente.append((database, datetime.now(), durata, normalizza_sql(sql), piano, istruzioni))
+    logger.warning("🐢 Query lenta %.1f ms su %s: %s | piano: %s | istruzioni SQLite: %d", durata * 1000,
+                   database, normalizza_sql(sql)[:300], piano or "-", istruzioni)
+
+
+def _misura_sql(connessione, sql, parametri, esegui):
+    connessione.istruzioni = 0
+    inizio = time.perf_counter()
+    try:
+        return esegui()
+    finally:
+        durata = time.perf_counter() - inizio
+        istruzioni = getattr(connessione, "istruzioni", 0)
+        database = getattr(connessione, "database", None)
+        SQL_DURATA.osserva(durata, database=database, istruzione=etichetta_sql(sql))
+        _registra_sql(database, sql, durata, istruzioni)
+        if durata >= SOGLIA_QUERY_LENTA:
+            _registra_query_lenta(connessione, sql, parametri, durata, istruzioni)
+
+
+def report_sql(n=10, database=None):
+    """
+    Testo per il comando admin: le N istruzioni con più tempo totale e le ultime query lente
+    del database indicato (nome del file, es. 'cambi_vvf.db'); None = tutti i database del processo
+    """
+    with _lock_statistiche_sql:
+        voci = sorted(((sql, voce) for (db, sql), voce in _statistiche_sql.items() if database in (None, db)),
+                      key=lambda voce: voce[1][1], reverse=True)
+    totale = sum(voce[1][1] for voce in voci)
+    lente = [voce[1:] for voce in list(query_lente) if database in (None, voce[0])]
+
+    msg = (f"🗄️ TOP {n} ISTRUZIONI SQL {database or 'di tutti i database'} "
+           f"(tempo totale {totale * 1000:.0f} ms, {len(voci)} istruzioni distinte)\n\n")
+    for sql, (conteggio, tempo, massimo, istruzioni) in voci[:n]:
+        msg += (f"• {tempo * 1000:.1f} ms in {conteggio} esecuzioni "
+                f"(media {tempo / conteggio * 1000:.2f} ms, max {massimo * 1000:.1f} ms")
+        if istruzioni > conteggio:
+            # Più istruzioni SQLite che execute: trigger o BEGIN impliciti
+            msg += f", {istruzioni / conteggio:.1f} istruzioni SQLite ciascuna"
+        msg += f")\n  {sql[:120]}\n"
+
+    msg += f"\n🐢 QUERY LENTE (soglia {SOGLIA_QUERY_LENTA * 1000:g} ms): {len(lente)}\n"
+    for quando, durata, sql, piano, _ in lente[-5:]:
+        msg += f"• {quando.strftime('%H:%M:%S')} {durata * 1000:.1f} ms: {sql[:100]}\n"
+        if piano:
+            msg += f"  ↳ {piano[:150]}\n"
+    return msg
+
+
+def azzera_statistiche_sql(database=None):
+    """Riparte da zero per un database (None = tutti)"""
+    with _lock_statistiche_sql:
+        for chiave in [chiave for chiave in _statistiche_sql if database in (None, chiave[0])]:
+            del _statistiche_sql[chiave]
+        rimaste = [voce for voce in query_lente if database not in (None, voce[0])]
+        query_lente.clear()
+        query_lente.extend(rimaste)
+
+
+def conta_sql(database=None):
+    """Totale execute misurati finora (per differenza prima/dopo un'operazione, es. nel benchmark)"""
+    with _lock_statistiche_sql:
+        return sum(voce[0] for (db, _), voce in _statistiche_sql.items() if database in (None, db))
+
+
+class CursoreMisurato(sqlite3.Cursor):
+    def execute(self, sql, parametri=()):
+        return _misura_sql(self.connection, sql, parametri, lambda: super(CursoreMisurato, self).execute(sql, parametri))
+
+    def executemany(self, sql, parametri):
+        parametri = parametri if isinstance(parametri, (list, tuple)) else list(parametri)
+        # Per il piano di una query lenta basta il primo gruppo di parametri
+        connessione = self.connection
+        # Il trace costa una callback Python per riga (e per trigger): sospeso durante i caricamenti massivi
+        connessione.set_trace_callback(None)
+        try:
+            return _misura_sql(connessione, sql, parametri[0] if parametri else (),
+                               lambda: super(CursoreMisurato, self).executemany(sql, parametri))
+        finally:
+            if isinstance(connessione, ConnessioneMisurata):
+                connessione.set_trace_callback(connessione._traccia)
+
+
+class ConnessioneMisurata(sqlite3.Connection):
+    """Da passare come factory a sqlite3.connect: tutte le query passano da CursoreMisurato"""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        # Nome del file: etichetta delle statistiche (i due bot possono condividere il processo)
+        self.database = os.path.basename(os.fsdecode(database))
+        self.istruzioni = 0
+        # SQLite chiama il trace per ogni istruzione eseguita, comprese quelle dei trigger e i
+        # BEGIN impliciti: il conteggio per execute mostra quanto lavoro nasconde un'istruzione
+        self.set_trace_callback(self._traccia)
+
+    def _traccia(self, sql):
+        self.istruzioni += 1
+
+    def cursor(self, factory=CursoreMisurato):
+        return super().cursor(factory)
+
+    # Connection.execute non passa da self.cursor(): va reindirizzato esplicitamente
+    def execute(self, sql, parametri=()):
+        return self.cursor().execute(sql, parametri)
+
+    def executemany(self, sql, parametri):
+        return self.cursor().executemany(sql, parametri)
+
+    def commit(self):
+        # Il COMMIT (scrittura su disco) è spesso la parte più lenta di una modifica
+        _misura_sql(self, "COMMIT", (), super().commit)
+
+
+# === TELEGRAM BOT API ===
+TELEGRAM_DURATA = registro.istogramma(
+    "telegram_api_durata_secondi", "Latenza delle chiamate Bot API per metodo", ("metodo",))
+TELEGRAM_RICHIESTE = registro.contatore(
+    "telegram_api_richieste_totali", "Chiamate Bot API per metodo ed esito (2xx/4xx/5xx/errore_rete)", ("metodo", "esito"))
+
+
+def metodo_bot_api(url):
+    # .../bot<token>/sendMessage -> sendMessage; il token non finisce mai nelle etichette
+    if "/file/bot" in url:
+        return "download_file"
+    return url.rsplit("/", 1)[-1] or "sconosciuto"
+
+
+class RichiestaTelegramMisurata(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, **timeout):
+        metodo = metodo_bot_api(url)
+        inizio = time.perf_counter()
+        try:
+            codice, contenuto = await super().do_request(url, method, request_data, **timeout)
+        except TelegramError:
+            TELEGRAM_RICHIESTE.inc(metodo=metodo, esito="errore_rete")
+            raise
+        finally:
+            TELEGRAM_DURATA.osserva(time.perf_counter() - inizio, metodo=metodo)
+        TELEGRAM_RICHIESTE.inc(metodo=metodo, esito=f"{codice // 100}xx")
+        return codice, contenuto
@@ -0,0 +1,209 @@
+# persistenza.py
+"""
+Persistenza SQLite per lo stato dei wizard (context.user_data / context.chat_data) dei bot.
+
+- lo stato vive nella tabella stato_conversazioni dello stesso database del bot,
+  quindi segue anche i backup su Gist e sopravvive ai redeploy
+- caricamento pigro: all'avvio non si legge nulla, i dati di un utente/chat
+  vengono letti alla prima update che lo riguarda (refresh_user_data / refresh_chat_data)
+- scrittura differita: le modifiche segnalate da PTB vengono accodate e scritte
+  in un thread con un'unica transazione per lotto
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+TIPO_UTENTE = 'user'
+TIPO_CHAT = 'chat'
+
+
+class PersistenzaSQLite(BasePersistence):
+    def __init__(self, percorso_db, update_interval=5):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.percorso_db = percorso_db
+        self._caricati = set()          # (tipo, id) già letti dal database
+        self._in_sospeso = {}           # (tipo, id) -> JSON da scrivere, None = da cancellare
+        self._in_scrittura = {}         # lotto che il thread sta scrivendo in questo momento
+        self._salvati = {}              # (tipo, id) -> ultimo JSON presente nel database
+        self._task_scrittura = None
+
+        # Statistiche
+        self.letture = 0
+        self.lotti_scritti = 0
+        self.righe_scritte = 0
+
+    def _crea_tabella(self):
+        # Creata all'initialize dell'Application, cioè dopo l'eventuale ripristino del database
+        conn = sqlite3.connect(self.percorso_db)
+        try:
+            conn.execute('''CREATE TABLE IF NOT EXISTS stato_conversazioni
+                         (tipo TEXT NOT NULL,
+                          id INTEGER NOT NULL,
+                          dati TEXT NOT NULL,
+                          aggiornato_il TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                          PRIMARY KEY (tipo, id))''')
+            conn.commit()
+        finally:
+            conn.close()
+
+    # === LETTURA PIGRA ===
+    def _carica(self, tipo, id_, dati):
+        """Riempie `dati` dal database la prima volta che l'utente/chat si presenta"""
+        chiave = (tipo, id_)
+        if chiave in self._caricati:
+            return
+        self._caricati.add(chiave)
+        if chiave in self._in_sospeso:
+            # Scrittura non ancora avvenuta: la copia in memoria è già la più recente
+            return
+        conn = sqlite3.connect(self.percorso_db)
+        try:
+            row = conn.execute("SELECT dati FROM stato_conversazioni WHERE tipo = ? AND id = ?",
+                               (tipo, id_)).fetchone()
+        finally:
+            conn.close()
+        self.letture += 1
+        if row:
+            self._salvati[chiave] = row[0]
+            # I valori già presenti (impostati in questa sessione) hanno la precedenza
+            salvati = json.loads(row[0])
+            salvati.update(dati)
+            dati.update(salvati)
+
+    async def get_user_data(self):
+        self._crea_tabella()
+        return {}
+
+    async def get_chat_data(self):
+        self._crea_tabella()
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        self._carica(TIPO_UTENTE, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        self._carica(TIPO_CHAT, chat_id, chat_data)
+
+    # === SCRITTURA DIFFERITA ===
+    def _accoda(self, tipo, id_, dati):
+        chiave = (tipo, id_)
+        self._caricati.add(chiave)
+        if dati:
+            try:
+                testo = json.dumps(dati, ensure_ascii=False, sort_keys=True)
+            except (TypeError, ValueError) as e:
+                logger.error("Stato %s %s non serializzabile, non salvato: %s", tipo, id_, e)
+                return
+        else:
+            # Wizard concluso: niente righe vuote nel database
+            testo = None
+        if self._ultimo_valore(chiave) == testo:
+            # PTB segnala ogni utente che ha ricevuto update, anche se i dati non sono cambiati
+            return
+        self._in_sospeso[chiave] = testo
+        if self._task_scrittura is None or self._task_scrittura.done():
+            self._task_scrittura = asyncio.get_running_loop().create_task(self._scrivi_in_sospeso())
+
+    def _ultimo_valore(self, chiave):
+        """Ultimo JSON destinato al database: in coda, in scrittura o già salvato (None = nessuna riga)"""
+        for livello in (self._in_sospeso, self._in_scrittura, self._salvati):
+            if chiave in livello:
+                return livello[chiave]
+        return None
+
+    async def _scrivi_in_sospeso(self):
+        # PTB chiama update_* per tutti gli utenti modificati nello stesso giro:
+        # il task parte dopo di loro e scrive tutto in un solo lotto
+        while self._in_sospeso:
+            lotto, self._in_sospeso = self._in_sospeso, {}
+            # Finché il lotto è in scrittura _salvati non è aggiornato: il confronto in _accoda usa il lotto
+            self._in_scrittura = lotto
+            try:
+                await asyncio.to_thread(self._scrivi_lotto, lotto)
+            except sqlite3.Error as e:
+                logger.error("Scrittura stato conversazioni fallita, riprovo al prossimo giro: %s", e)
+                # Rimetto in coda solo le chiavi non aggiornate nel frattempo
+                for chiave, valore in lotto.items():
+                    self._in_sospeso.setdefault(chiave, valore)
+                return
+            finally:
+                self._in_scrittura = {}
+
+    def _scrivi_lotto(self, lotto):
+        conn = sqlite3.connect(self.percorso_db)
+        try:
+            with conn:
+                conn.executemany(
+                    '''INSERT INTO stato_conversazioni (tipo, id, dati, aggiornato_il)
+                       VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                       ON CONFLICT(tipo, id) DO UPDATE SET dati = excluded.dati,
+                                                           aggiornato_il = excluded.aggiornato_il''',
+                    [(tipo, id_, dati) for (tipo, id_), dati in lotto.items() if dati is not None])
+                conn.executemany(
+                    "DELETE FROM stato_conversazioni WHERE tipo = ? AND id = ?",
+                    [chiave for chiave, dati in lotto.items() if dati is None])
+        finally:
+            conn.close()
+        for chiave, dati in lotto.items():
+            if dati is None:
+                self._salvati.pop(chiave, None)
+            else:
+                self._salvati[chiave] = dati
+        self.lotti_scritti += 1
+        self.righe_scritte += len(lotto)
+
+    async def update_user_data(self, user_id, data):
+        self._accoda(TIPO_UTENTE, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._accoda(TIPO_CHAT, chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._accoda(TIPO_UTENTE, user_id, None)
+
+    async def drop_chat_data(self, chat_id):
+        self._accoda(TIPO_CHAT, chat_id, None)
+
+    async def flush(self):
+        """Chiamato da PTB allo spegnimento: attende il lotto in corso e scrive il resto"""
+        if self._task_scrittura is not None:
+            await asyncio.gather(self._task_scrittura, return_exceptions=True)
+        if self._in_sospeso:
+            lotto, self._in_sospeso = self._in_sospeso, {}
+            self._scrivi_lotto(lotto)
+
+    def riepilogo(self):
+        """Testo per lo Status Server"""
+        return (f"🧭 **STATO WIZARD:** {len(self._caricati)} utenti/chat in memoria, "
+                f"{len(self._in_sospeso)} in attesa di scrittura | "
+                f"letture {self.letture}, lotti {self.lotti_scritti}, righe {self.righe_scritte}")
+
+    # === NON USATI (niente bot_data, callback_data né ConversationHandler) ===
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
@@ -0,0 +1,89 @@
+# registrazione.py
+"""
+Registrazione degli update in arrivo, da rigiocare con replay.py.
+
+Attiva solo con REGISTRA_UPDATE=percorso.jsonl: ogni update messo nella coda dell'Application
+(polling o webhook) diventa una riga JSON con l'istante di arrivo:
+    {"t": 12.3456, "ts": "2026-10-19T21:04:05.123+00:00", "update": {...}}
+dove "t" sono i secondi dall'avvio della registrazione. Il file è in append: a ogni riavvio
+"t" riparte da zero e il replay tratta il salto come l'inizio di una nuova sessione.
+La scrittura avviene in un thread, il loop si limita ad accodare.
+
+Attenzione: il file contiene i dati degli utenti (id, nomi, testi) come li invia Telegram.
+"""
+import asyncio
+import atexit
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from telegram import Update
+
+
+class RegistratoreUpdate:
+    def __init__(self, percorso):
+        self.percorso = percorso
+        self.registrati = 0
+        self._inizio = time.monotonic()
+        self._coda = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._scrivi, name="registratore-update", daemon=True)
+        self._thread.start()
+        atexit.register(self.chiudi)
+
+    def registra(self, update):
+        self.registrati += 1
+        self._coda.put((time.monotonic() - self._inizio, time.time(), update.to_dict()))
+
+    def _scrivi(self):
+        with open(self.percorso, "a", encoding="utf-8") as f:
+            while True:
+                voce = self._coda.get()
+                if voce is None:
+                    break
+                t, ts, dati = voce
+                f.write(json.dumps({
+                    "t": round(t, 4),
+                    "ts": datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='milliseconds'),
+                    "update": dati,
+                }, ensure_ascii=False) + "\n")
+                if self._coda.empty():
+                    f.flush()
+
+    def chiudi(self):
+        if self._thread.is_alive():
+            self._coda.put(None)
+            self._thread.join(timeout=5)
+
+
+class CodaUpdateRegistrata(asyncio.Queue):
+    """update_queue dell'Application che registra ogni Update accodato (stessa semantica di asyncio.Queue)"""
+
+    def __init__(self, registratore, maxsize=0):
+        super().__init__(maxsize)
+        self.registratore = registratore
+
+    def put_nowait(self, item):
+        # Prima l'inserimento: un update rifiutato per coda piena non finisce nella registrazione
+        super().put_nowait(item)
+        if isinstance(item, Update):
+            self.registratore.registra(item)
+
+
+def leggi_registrazione(percorso):
+    """(istante relativo, dati update) con le sessioni successive messe in fila una dopo l'altra"""
+    voci = []
+    base = 0.0
+    precedente = 0.0
+    with open(percorso, encoding="utf-8") as f:
+        for riga in f:
+            if not riga.strip():
+                continue
+            voce = json.loads(riga)
+            if voce["t"] < precedente:
+                # Nuova sessione (riavvio del bot): riparte subito dopo la precedente
+                base += precedente
+            precedente = voce["t"]
+            voci.append((base + voce["t"], voce["update"]))
+    return voci
@@ -0,0 +1,215 @@
+# replay.py
+"""
+Rigioca una registrazione di update (vedi registrazione.py, REGISTRA_UPDATE) contro il bot.
+
+Gli update vengono messi nella coda dell'Application agli istanti registrati (divisi per
+--velocita; 0 = tutti subito) e passano dagli handler veri, su un database di prova. Le chiamate
+Bot API vanno alla Bot API finta (finto_telegram.py): nessun messaggio arriva agli utenti veri.
+Per ogni update misura la latenza dall'accodamento alla fine dell'elaborazione, per tipo
+(pulsante della tastiera, callback, comando, inline).
+
+Database di prova:
+- --db copia.db: copia di un database reale (es. il backup scaricato dal Gist), consigliato
+  perché i callback della registrazione si riferiscono agli id degli articoli veri
+- altrimenti un database nuovo in cui gli utenti della registrazione risultano approvati
+
+Confronto tra versioni: si salva l'esecuzione sulla versione di riferimento e si rigioca la stessa
+registrazione sulla nuova con --confronta.
+    python replay.py intervento.jsonl --db backup.db --salva prima.json
+    python replay.py intervento.jsonl --db backup.db --velocita 10 --confronta prima.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime
+
+# Prima di importare il bot: database di prova, Bot API finta e nessuna nuova registrazione
+PORTA_API = 8082
+_cartella = tempfile.TemporaryDirectory(prefix="replay_bot_")
+os.environ['DATABASE_NAME'] = os.path.join(_cartella.name, 'replay.db')
+os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{PORTA_API}"
+os.environ['BOT_TOKEN'] = "123456:TOKEN-FINTO"
+os.environ['REGISTRA_UPDATE'] = ""
+os.environ.setdefault('LOG_LIVELLO', 'ERROR')
+
+from telegram import Update
+
+import bot
+from finto_telegram import TelegramFinto
+from registrazione import leggi_registrazione
+
+TIMEOUT_FINE = 120          # secondi di attesa per gli update ancora in elaborazione dopo l'ultimo invio
+DIFFERENZA_MINIMA_MS = 1.0  # sotto questa differenza assoluta una variazione è rumore
+
+
+def percentile(valori, q):
+    ordinati = sorted(valori)
+    return ordinati[max(0, math.ceil(q * len(ordinati)) - 1)]
+
+
+def prepara_database(copia, voci):
+    if copia:
+        shutil.copyfile(copia, bot.DATABASE_NAME)
+        # Un backup vecchio potrebbe avere uno schema precedente
+        bot.init_db()
+        return
+    # Database nuovo (già creato dall'import del bot): approvo chi compare nella registrazione
+    utenti = set()
+    for _, dati in voci:
+        for campo in ("message", "callback_query", "inline_query", "edited_message"):
+            mittente = (dati.get(campo) or {}).get("from")
+            if mittente:
+                utenti.add((mittente["id"], mittente.get("first_name", "")))
+    conn = sqlite3.connect(bot.DATABASE_NAME)
+    try:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO utenti (user_id, nome, ruolo, data_approvazione) "
+                             "VALUES (?, ?, 'user', CURRENT_TIMESTAMP)", sorted(utenti))
+    finally:
+        conn.close()
+
+
+def tipo_update(update):
+    if update.callback_query:
+        return f"callback {(update.callback_query.data or '').split(':')[0]}"
+    if update.inline_query:
+        return "inline"
+    if update.message and update.message.text:
+        testo = update.message.text.strip()
+        if testo.startswith('/'):
+            return f"comando {testo.split()[0]}"
+        return f"pulsante {testo}" if testo in bot.ROUTE_PULSANTI else "testo libero"
+    return "altro"
+
+
+async def rigioca(voci, velocita):
+    telegram = TelegramFinto(PORTA_API)
+    await telegram.avvia()
+    application = bot.crea_application()
+
+    accodati = {}                   # id(update) -> (istante di accodamento, tipo)
+    latenze = defaultdict(list)     # tipo -> secondi
+
+    def al_termine(update):
+        voce = accodati.pop(id(update), None)
+        if voce is not None:
+            latenze[voce[1]].append(time.perf_counter() - voce[0])
+
+    application.update_processor.al_termine = al_termine
+    await application.initialize()
+    await application.start()
+    try:
+        inizio = time.perf_counter()
+        for istante, dati in voci:
+            if velocita:
+                ritardo = inizio + istante / velocita - time.perf_counter()
+                if ritardo > 0:
+                    await asyncio.sleep(ritardo)
+            update = Update.de_json(dati, application.bot)
+            accodati[id(update)] = (time.perf_counter(), tipo_update(update))
+            await application.update_queue.put(update)
+
+        limite = time.perf_counter() + TIMEOUT_FINE
+        while accodati and time.perf_counter() < limite:
+            await asyncio.sleep(0.05)
+        durata = time.perf_counter() - inizio
+    finally:
+        await application.stop()
+        await bot.vista_messaggi.svuota()
+        await application.shutdown()
+        await telegram.ferma()
+
+    tutte = [l for valori in latenze.values() for l in valori]
+    risultato = {
+        "update": len(voci),
+        "non_conclusi": len(accodati),
+        "durata_s": round(durata, 2),
+        "update_al_secondo": round(len(tutte) / durata, 1) if durata else 0,
+        "chiamate_api": dict(telegram.chiamate),
+        "latenze": {},
+    }
+    print(f"\n▶️ {len(voci)} update rigiocati in {durata:.1f}s ({risultato['update_al_secondo']} update/s), "
+          f"non conclusi {len(accodati)}")
+    for tipo, valori in sorted(latenze.items()) + [("TUTTI", tutte)]:
+        if not valori:
+            continue
+        risultato["latenze"][tipo] = {
+            "n": len(valori),
+            "p50_ms": round(percentile(valori, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(valori, 0.95) * 1000, 2),
+            "max_ms": round(max(valori) * 1000, 2),
+        }
+        m = risultato["latenze"][tipo]
+        print(f"  {tipo[:28]:<28} n {m['n']:>6}  p50 {m['p50_ms']:>9.2f} ms  p95 {m['p95_ms']:>9.2f} ms  max {m['max_ms']:>9.2f} ms")
+    print(telegram.riepilogo())
+    return risultato
+
+
+def confronta(attuale, precedente):
+    print(f"\n📈 Confronto con {precedente['meta']['data']} ({precedente['meta'].get('versione') or 'versione ignota'})")
+    for tipo, ora in attuale["latenze"].items():
+        prima = precedente["latenze"].get(tipo)
+        if not prima:
+            continue
+        righe = []
+        for campo in ("p50_ms", "p95_ms"):
+            differenza = ora[campo] - prima[campo]
+            percento = differenza / prima[campo] * 100 if prima[campo] else 0
+            segno = "⚪" if abs(differenza) < DIFFERENZA_MINIMA_MS else "🔴" if differenza > 0 else "🟢"
+            righe.append(f"{segno} {campo[:3]} {prima[campo]:.2f} -> {ora[campo]:.2f} ms ({percento:+.0f}%)")
+        print(f"  {tipo[:28]:<28} " + "   ".join(righe))
+
+
+def versione_codice():
+    """Commit corrente, se la cartella è un repository git (per riconoscere le esecuzioni salvate)"""
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".git", "HEAD")) as f:
+            riferimento = f.read().strip()
+        if riferimento.startswith("ref: "):
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".git", riferimento[5:])) as f:
+                return f.read().strip()[:12]
+        return riferimento[:12]
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rigioca una registrazione di update contro il bot")
+    parser.add_argument("registrazione", help="file JSONL prodotto con REGISTRA_UPDATE")
+    parser.add_argument("--db", help="copia di un database reale da usare come base (non viene modificata)")
+    parser.add_argument("--velocita", type=float, default=1.0,
+                        help="1 = tempi originali, 10 = dieci volte più veloce, 0 = tutti subito")
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati")
+    parser.add_argument("--confronta", help="file JSON di un replay precedente")
+    argomenti = parser.parse_args()
+
+    voci = leggi_registrazione(argomenti.registrazione)
+    prepara_database(argomenti.db, voci)
+    risultato = {
+        "meta": {
+            "data": datetime.now().isoformat(timespec='seconds'),
+            "versione": versione_codice(),
+            "registrazione": os.path.basename(argomenti.registrazione),
+            "velocita": argomenti.velocita,
+        },
+        **asyncio.run(rigioca(voci, argomenti.velocita)),
+    }
+
+    if argomenti.salva:
+        with open(argomenti.salva, "w", encoding="utf-8") as f:
+            json.dump(risultato, f, ensure_ascii=False, indent=2)
+        print(f"💾 Risultati salvati in {argomenti.salva}")
+    if argomenti.confronta:
+        with open(argomenti.confronta, encoding="utf-8") as f:
+            confronta(risultato, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+# scheduler.py
+"""
+Scheduler asyncio unico per i lavori periodici dei bot (backup, keep-alive, controlli integrità).
+
+Ogni job ha:
+- un lock proprio: un'esecuzione manuale (es. /backup-now) non si sovrappone a quella programmata
+- jitter casuale per non far partire tutto nello stesso istante
+- politica per le esecuzioni perse ('salta' = riallinea alla griglia, 'recupera' = esegue subito una volta)
+- statistiche di ultima esecuzione/durata/esito consultabili dallo Status Server
+"""
+import asyncio
+import inspect
+import logging
+import random
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, nome, funzione, intervallo, primo_avvio=0.0, jitter=0.0, recupero='salta', in_thread=False):
+        if recupero not in ('salta', 'recupera'):
+            raise ValueError(f"Politica di recupero non valida: {recupero}")
+        self.nome = nome
+        self.funzione = funzione
+        self.intervallo = intervallo
+        self.primo_avvio = primo_avvio
+        self.jitter = jitter
+        self.recupero = recupero
+        self.in_thread = in_thread      # funzioni bloccanti (requests, sqlite pesante) girano in un thread
+        self.lock = asyncio.Lock()
+
+        # Statistiche
+        self.esecuzioni = 0
+        self.errori = 0
+        self.saltati = 0
+        self.ultimo_avvio = None
+        self.ultima_durata = None
+        self.ultimo_esito = None
+        self.ultimo_errore = None
+        self.prossima = None
+
+    async def _chiama(self):
+        if self.in_thread:
+            return await asyncio.to_thread(self.funzione)
+        risultato = self.funzione()
+        if inspect.isawaitable(risultato):
+            risultato = await risultato
+        return risultato
+
+    async def esegui(self):
+        """Esegue il job sotto lock registrando durata ed esito; le eccezioni non fermano lo scheduler"""
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            inizio = loop.time()
+            self.ultimo_avvio = datetime.now()
+            try:
+                risultato = await self._chiama()
+                # I job che restituiscono False (es. backup fallito) contano come esito negativo
+                self.ultimo_esito = risultato is not False
+                self.ultimo_errore = None
+                return risultato
+            except Exception as e:
+                self.errori += 1
+                self.ultimo_esito = False
+                self.ultimo_errore = str(e)
+                logger.exception("Job %s fallito", self.nome)
+                return None
+            finally:
+                self.esecuzioni += 1
+                self.ultima_durata = loop.time() - inizio
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = []
+
+    def aggiungi(self, nome, funzione, intervallo, **opzioni):
+        """Registra un job periodico (vedi Job per le opzioni)"""
+        if nome in self.jobs:
+            raise ValueError(f"Job già registrato: {nome}")
+        self.jobs[nome] = Job(nome, funzione, intervallo, **opzioni)
+        return self.jobs[nome]
+
+    async def esegui_ora(self, nome):
+        """
+        Esecuzione manuale. Se il job è già in corso non ne parte un secondo:
+        restituisce (False, None); altrimenti (True, risultato)
+        """
+        job = self.jobs[nome]
+        if job.lock.locked():
+            return False, None
+        return True, await job.esegui()
+
+    async def _ciclo(self, job):
+        loop = asyncio.get_running_loop()
+        # Griglia fissa: la prossima esecuzione si calcola dalla precedente programmata, non dalla fine del job
+        scadenza = loop.time() + job.primo_avvio
+        while True:
+            ritardo = random.uniform(0, job.jitter) if job.jitter else 0.0
+            job.prossima = datetime.now().timestamp() + max(0.0, scadenza - loop.time()) + ritardo
+            await asyncio.sleep(max(0.0, scadenza - loop.time()) + ritardo)
+
+            if job.lock.locked():
+                # Esecuzione manuale in corso: questa conta come già fatta
+                job.saltati += 1
+            else:
+                await job.esegui()
+
+            scadenza += job.intervallo
+            adesso = loop.time()
+            if scadenza < adesso:
+                persi = int((adesso - scadenza) // job.intervallo) + 1
+                if job.recupero == 'salta':
+                    job.saltati += persi
+                    scadenza += persi * job.intervallo
+                else:
+                    # 'recupera': una sola esecuzione immediata, le altre vengono accorpate
+                    job.saltati += persi - 1
+                    scadenza = adesso
+
+    def avvia(self):
+        """Avvia tutti i job registrati nel loop corrente"""
+        for job in self.jobs.values():
+            self._tasks.append(asyncio.create_task(self._ciclo(job), name=f"job-{job.nome}"))
+        logger.info("Scheduler avviato con %d job: %s", len(self.jobs), ", ".join(self.jobs))
+
+    async def ferma(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def riepilogo(self):
+        """Testo per lo Status Server con ultima esecuzione, durata ed esito di ogni job"""
+        msg = "⏱️ **JOB PIANIFICATI:**\n"
+        for job in self.jobs.values():
+            if job.ultimo_avvio is None:
+                stato = "⏳ mai eseguito"
+            else:
+                icona = "✅" if job.ultimo_esito else "❌"
+                stato = f"{icona} {job.ultimo_avvio.strftime('%H:%M:%S')} ({job.ultima_durata:.2f}s)"
+            if job.lock.locked():
+                stato += " 🔄 in corso"
+            msg += f"• {job.nome}: {stato} | run {job.esecuzioni}, errori {job.errori}, saltati {job.saltati}"
+            if job.prossima:
+                msg += f" | prossimo {datetime.fromtimestamp(job.prossima).strftime('%H:%M:%S')}"
+            msg += "\n"
+            if job.ultimo_errore:
+                msg += f"  ↳ {job.ultimo_errore[:100]}\n"
+        return msg
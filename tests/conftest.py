@@ -0,0 +1,16 @@
+# conftest.py
+"""
+Il bot legge la configurazione e crea lo schema all'import: prima di importarlo
+database temporaneo, token finto e log ridotti (come benchmark.py).
+"""
+import os
+import sys
+import tempfile
+
+_cartella = tempfile.TemporaryDirectory(prefix="test_bot_")
+os.environ['DATABASE_NAME'] = os.path.join(_cartella.name, 'test.db')
+os.environ.setdefault('BOT_TOKEN', '123456:TOKEN-FINTO')
+os.environ.setdefault('LOG_LIVELLO', 'ERROR')
+os.environ['GITHUB_TOKEN'] = ''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
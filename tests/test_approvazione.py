@@ -0,0 +1,27 @@
+# test_approvazione.py
+import sqlite3
+
+import bot
+
+
+def richiesta(user_id):
+    conn = sqlite3.connect(bot.DATABASE_NAME)
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO utenti (user_id, nome, ruolo) VALUES (?, 'Prova', 'in_attesa')", (user_id,))
+    conn.close()
+    bot.invalida_ruolo(user_id)
+
+
+def test_rifiuto_dopo_approvazione_non_cancella():
+    richiesta(9001)
+    assert bot.approva_utente(9001)
+    assert not bot.rifiuta_utente(9001)
+    assert bot.get_ruolo(9001) == 'user'
+
+
+def test_approvazione_dopo_rifiuto():
+    richiesta(9002)
+    assert bot.rifiuta_utente(9002)
+    assert not bot.rifiuta_utente(9002)
+    assert not bot.approva_utente(9002)
+    assert bot.get_ruolo(9002) is None
@@ -0,0 +1,62 @@
+# test_backup_gist.py
+import threading
+import time
+from types import SimpleNamespace
+
+import backup_gist
+
+
+class SessioneFinta:
+    """Conta le richieste contemporanee e le copie del database in memoria (rilasciate a fine upload)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.richieste = self.richieste_max = 0
+        self.copie = self.copie_max = 0
+
+    def prepara_files(self):
+        with self.lock:
+            self.copie += 1
+            self.copie_max = max(self.copie_max, self.copie)
+        time.sleep(0.02)
+        return {"backup.json": {"content": "x"}}
+
+    def _richiesta(self, upload):
+        with self.lock:
+            self.richieste += 1
+            self.richieste_max = max(self.richieste_max, self.richieste)
+        time.sleep(0.02)
+        with self.lock:
+            self.richieste -= 1
+            if upload:
+                self.copie -= 1
+        return SimpleNamespace(status_code=200, request=SimpleNamespace(body=b"..."))
+
+    def patch(self, *args, **kwargs):
+        return self._richiesta(upload=True)
+
+    post = patch
+
+    def get(self, *args, **kwargs):
+        return self._richiesta(upload=False)
+
+
+def test_lettura_e_upload_un_backup_alla_volta(monkeypatch):
+    sessione = SessioneFinta()
+    monkeypatch.setattr(backup_gist, "sessione", sessione)
+    risposte = []
+
+    def backup(gist_id):
+        risposte.append(backup_gist.scrivi_gist("token", gist_id, sessione.prepara_files))
+
+    thread = [threading.Thread(target=backup, args=(gist_id,)) for gist_id in ("a", "b", None, "c")]
+    thread.append(threading.Thread(target=backup_gist.leggi_gist, args=("token", "a")))
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+
+    assert sessione.copie_max == 1
+    assert sessione.richieste_max == 1
+    # La copia base64 inviata non resta agganciata alla risposta
+    assert all(r.request.body is None for r in risposte)
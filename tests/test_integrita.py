@@ -0,0 +1,25 @@
+# test_integrita.py
+import bot
+
+SPAZZATURA = b"non sono un database SQLite" * 200
+
+
+def test_database_e_backup_corrotti(tmp_path, monkeypatch):
+    database = tmp_path / "corrotto.db"
+    database.write_bytes(SPAZZATURA)
+    monkeypatch.setattr(bot, "DATABASE_NAME", str(database))
+    restore = []
+
+    def restore_corrotto():
+        restore.append(True)
+        database.write_bytes(SPAZZATURA)
+        return True
+
+    monkeypatch.setattr(bot, "restore_database_from_gist", restore_corrotto)
+
+    assert bot.verifica_integrita_avvio()
+    # Un solo restore: al secondo fallimento si riparte da un database nuovo
+    assert restore == [True]
+    messi_da_parte = sorted(p.name.split("-")[0] for p in tmp_path.iterdir() if p != database)
+    assert messi_da_parte == ["corrotto.db.backup", "corrotto.db.corrotto"]
+    assert bot.STATO_INTEGRITA["schema"]["ok"]
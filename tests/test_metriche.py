@@ -0,0 +1,19 @@
+# test_metriche.py
+import sqlite3
+
+from metriche import ConnessioneMisurata, azzera_statistiche_sql, conta_sql, report_sql
+
+
+def test_statistiche_sql_per_database(tmp_path):
+    bot = sqlite3.connect(tmp_path / "bot.db", factory=ConnessioneMisurata)
+    cambi = sqlite3.connect(str(tmp_path / "cambi.db"), timeout=1, factory=ConnessioneMisurata)
+    bot.execute("CREATE TABLE articoli (seriale TEXT)")
+    cambi.execute("CREATE TABLE cambi (data TEXT)")
+    cambi.execute("SELECT * FROM cambi")
+
+    assert (conta_sql("bot.db"), conta_sql("cambi.db")) == (1, 2)
+    assert "articoli" not in report_sql(database="cambi.db")
+    azzera_statistiche_sql("cambi.db")
+    assert (conta_sql("bot.db"), conta_sql("cambi.db")) == (1, 0)
+    bot.close()
+    cambi.close()
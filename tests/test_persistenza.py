@@ -0,0 +1,62 @@
+# test_persistenza.py
+import asyncio
+import json
+import sqlite3
+import threading
+
+from persistenza import PersistenzaSQLite, TIPO_UTENTE
+
+
+def leggi(percorso, id_):
+    conn = sqlite3.connect(percorso)
+    try:
+        row = conn.execute("SELECT dati FROM stato_conversazioni WHERE tipo = ? AND id = ?",
+                           (TIPO_UTENTE, id_)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def test_ritorno_al_valore_salvato_durante_la_scrittura(tmp_path):
+    percorso = str(tmp_path / "stato.db")
+
+    async def prova():
+        persistenza = PersistenzaSQLite(percorso)
+        await persistenza.get_user_data()
+        await persistenza.update_user_data(1, {"azione": "a"})
+        await persistenza.flush()
+
+        # Il lotto con "b" resta in scrittura finché il test non lo sblocca
+        in_scrittura, sblocca = threading.Event(), threading.Event()
+        scrivi = persistenza._scrivi_lotto
+
+        def scrivi_lento(lotto):
+            in_scrittura.set()
+            sblocca.wait(5)
+            scrivi(lotto)
+
+        persistenza._scrivi_lotto = scrivi_lento
+        await persistenza.update_user_data(1, {"azione": "b"})
+        await asyncio.to_thread(in_scrittura.wait, 5)
+        # Torna al valore già nel database mentre "b" non è ancora stato scritto
+        await persistenza.update_user_data(1, {"azione": "a"})
+        sblocca.set()
+        await persistenza.flush()
+
+    asyncio.run(prova())
+    assert leggi(percorso, 1) == {"azione": "a"}
+
+
+def test_stato_svuotato_cancella_la_riga(tmp_path):
+    percorso = str(tmp_path / "stato.db")
+
+    async def prova():
+        persistenza = PersistenzaSQLite(percorso)
+        await persistenza.get_user_data()
+        await persistenza.update_user_data(1, {"azione": "a"})
+        await persistenza.flush()
+        await persistenza.update_user_data(1, {})
+        await persistenza.flush()
+
+    asyncio.run(prova())
+    assert leggi(percorso, 1) is None
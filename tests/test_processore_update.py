@@ -0,0 +1,72 @@
+# test_processore_update.py
+import asyncio
+
+from telegram import Chat, Update
+
+from bot import ProcessoreUpdatePerChat
+
+
+class UpdateFinto(Update):
+    """Update con la sola chat: basta a ProcessoreUpdatePerChat per scegliere il turno"""
+
+    def __init__(self, update_id, chat_id):
+        super().__init__(update_id)
+        self._chat = Chat(chat_id, Chat.PRIVATE)
+
+    @property
+    def effective_chat(self):
+        return self._chat
+
+
+def test_chat_occupata_non_blocca_le_altre():
+    async def prova():
+        processore = ProcessoreUpdatePerChat(2)
+        sblocca = asyncio.Event()
+        conclusi = []
+
+        async def lento(nome):
+            await sblocca.wait()
+            conclusi.append(nome)
+
+        async def veloce(nome):
+            conclusi.append(nome)
+
+        # La chat 1 manda più tap di quanti sono i posti globali, tutti fermi sul primo
+        occupata = [asyncio.create_task(processore.process_update(UpdateFinto(i, 1), lento(f"a{i}")))
+                    for i in range(5)]
+        await asyncio.sleep(0.01)
+        # Uno in elaborazione, gli altri quattro in fila sul lock della chat
+        assert (processore.in_corso, processore.in_attesa) == (1, 4)
+        await asyncio.wait_for(processore.process_update(UpdateFinto(10, 2), veloce("b")), 1)
+        assert conclusi == ["b"]
+
+        sblocca.set()
+        await asyncio.gather(*occupata)
+        assert conclusi == ["b", "a0", "a1", "a2", "a3", "a4"]
+        assert processore.in_corso == 0
+        assert processore.in_attesa == 0
+        assert not processore._lock_chat
+
+    asyncio.run(prova())
+
+
+def test_posti_globali_rispettati():
+    async def prova():
+        processore = ProcessoreUpdatePerChat(2)
+        sblocca = asyncio.Event()
+        massimo = []
+
+        async def lento():
+            massimo.append(processore.in_corso)
+            await sblocca.wait()
+
+        # Chat tutte diverse: il limite viene solo dai posti globali
+        tasks = [asyncio.create_task(processore.process_update(UpdateFinto(i, i), lento())) for i in range(6)]
+        await asyncio.sleep(0.01)
+        assert processore.in_corso == 2
+        assert processore.in_attesa == 4
+        sblocca.set()
+        await asyncio.gather(*tasks)
+        assert max(massimo) == 2
+
+    asyncio.run(prova())
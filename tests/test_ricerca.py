@@ -0,0 +1,78 @@
+# test_ricerca.py
+import sqlite3
+
+import pytest
+
+import bot
+
+SERIALI = ["2aUT_001", "2AUX_002", "2b_003", "BOMB_010", "@x_1", "[y_2", "MAS_99"]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def articoli():
+    conn = sqlite3.connect(bot.DATABASE_NAME)
+    with conn:
+        conn.execute("DELETE FROM articoli")
+        conn.executemany("INSERT INTO articoli (seriale, categoria, sede, stato) VALUES (?, 'bombola', 'erba', 'disponibile')",
+                         [(s,) for s in SERIALI])
+    conn.close()
+
+
+def seriali(testo):
+    return [r[1] for r in bot.cerca_articoli(testo)]
+
+
+@pytest.mark.parametrize("testo", ["2a", "2A", "2au", "2AU", " 2aU "])
+def test_prefisso_con_maiuscole_miste(testo):
+    assert seriali(testo) == ["2aUT_001", "2AUX_002"]
+
+
+def test_prefisso_di_un_carattere():
+    assert seriali("2") == ["2aUT_001", "2AUX_002", "2b_003"]
+
+
+def test_prefisso_che_finisce_con_chiocciola():
+    assert seriali("@") == ["@x_1"]
+
+
+def test_frammento_interno():
+    assert seriali("omb") == ["BOMB_010"]
+
+
+def test_usa_l_indice_nocase():
+    conn = sqlite3.connect(bot.DATABASE_NAME)
+    piano = conn.execute("""EXPLAIN QUERY PLAN SELECT id FROM articoli
+                            WHERE seriale COLLATE NOCASE >= ? AND seriale COLLATE NOCASE < ?
+                            ORDER BY seriale COLLATE NOCASE LIMIT 10""", ("2a", "2b")).fetchall()
+    conn.close()
+    assert "idx_articoli_seriale_nocase" in " ".join(str(r[-1]) for r in piano)
+
+
+class CursoreSenzaTrigram:
+    """Cursore di un SQLite senza tokenizer trigram (< 3.34)"""
+
+    def __init__(self, cursore):
+        self.cursore = cursore
+
+    def execute(self, sql, *parametri):
+        if "tokenize='trigram'" in sql:
+            raise sqlite3.OperationalError("no such tokenizer: trigram")
+        return self.cursore.execute(sql, *parametri)
+
+
+def test_senza_trigram_resta_la_ricerca_per_prefisso(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "DATABASE_NAME", str(tmp_path / "senza_fts.db"))
+    monkeypatch.setattr(bot, "FTS_DISPONIBILE", True)
+    conn = sqlite3.connect(bot.DATABASE_NAME)
+    c = conn.cursor()
+    for numero, _, migrazione in bot.MIGRAZIONI:
+        migrazione(CursoreSenzaTrigram(c) if numero == 3 else c)
+    conn.execute("INSERT INTO articoli (seriale, categoria, sede, stato) VALUES ('BOMB_010', 'bombola', 'erba', 'disponibile')")
+    conn.commit()
+    oggetti = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'articoli_fts%'")}
+    conn.close()
+
+    assert oggetti == set()
+    assert seriali("bom") == ["BOMB_010"]
+    assert seriali("omb") == []
+    assert not bot.FTS_DISPONIBILE
@@ -0,0 +1,49 @@
+# test_vista_messaggi.py
+import asyncio
+from types import SimpleNamespace
+
+from bot import VistaMessaggi
+
+
+class QueryFinta:
+    def __init__(self, errore=None):
+        self.message = SimpleNamespace(chat_id=1, message_id=1)
+        self.inline_message_id = None
+        self.testi = []
+        self.errore = errore
+
+    async def edit_message_text(self, testo, reply_markup=None):
+        if self.errore:
+            raise self.errore
+        self.testi.append(testo)
+
+
+def test_svuota_invia_le_modifiche_in_attesa():
+    async def prova():
+        vista = VistaMessaggi(finestra=60)
+        query = QueryFinta()
+        await vista.modifica(query, "uno")
+        await vista.modifica(query, "due")
+        await vista.modifica(query, "tre")
+        assert query.testi == ["uno"]
+
+        await vista.svuota()
+        assert query.testi == ["uno", "tre"]
+        assert vista.accorpate == 1
+        assert not vista._task and not vista._timer
+
+    asyncio.run(prova())
+
+
+def test_errore_della_modifica_accorpata_viene_loggato(caplog):
+    async def prova():
+        vista = VistaMessaggi(finestra=0.01)
+        query = QueryFinta()
+        await vista.modifica(query, "uno")
+        query.errore = RuntimeError("rete giù")
+        await vista.modifica(query, "due")
+        await asyncio.sleep(0.05)
+        assert not vista._task
+
+    asyncio.run(prova())
+    assert any("accorpata fallita" in r.getMessage() for r in caplog.records)
@@ -0,0 +1,46 @@
+# test_web_server.py
+import asyncio
+import socket
+
+import aiohttp
+from aiohttp import web
+
+import bot
+
+
+def porta_libera():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_riavvio_del_server_rimonta_le_sotto_app(monkeypatch):
+    monkeypatch.setattr(bot, "WEB_PORT", porta_libera())
+
+    async def health(request):
+        return web.Response(text="OK sotto")
+
+    def crea_sotto_app():
+        app = web.Application()
+        app.add_routes([web.get('/health', health)])
+        return app
+
+    async def stato(percorso):
+        async with aiohttp.ClientSession() as sessione:
+            async with sessione.get(f"http://127.0.0.1:{bot.WEB_PORT}{percorso}") as risposta:
+                return risposta.status, await risposta.text()
+
+    async def prova():
+        application = bot.crea_application()
+        await bot.avvia_web_server(application, sotto_app={"/cambi": crea_sotto_app})
+        try:
+            assert await stato("/cambi/health") == (200, "OK sotto")
+            # Come il self-heal del keep-alive: riavvio senza argomenti
+            await bot.ferma_web_server(application)
+            await bot.avvia_web_server(application)
+            assert await stato("/cambi/health") == (200, "OK sotto")
+            assert (await stato("/health"))[0] == 200
+        finally:
+            await bot.ferma_web_server(application)
+
+    asyncio.run(prova())